@@ -0,0 +1,95 @@
+"""
+Compare the compiled `.mfignore` matcher against the previous list of
+per-line lambdas, with a few hundred rules over a large synthetic tree.
+
+    python bench/bench_ignore.py [--rules 300] [--files 1000000]
+
+The tree only exists in memory; this measures matching, not I/O.
+"""
+
+from os import path
+import sys
+import random
+from time import time
+from itertools import imap
+
+import argparse
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..'))
+from magicfolder.checksum import IgnoreRules
+
+def legacy_parse_ignore_file(f):
+    def rule(line):
+        if line.startswith('*'):
+            return lambda p: p.endswith(line[1:])
+        elif line.endswith('*'):
+            return lambda p: p.startswith(line[:-1])
+        else:
+            return lambda p: p == line
+
+    rules = []
+    for line in imap(str.strip, f):
+        rules.append(rule(line))
+
+    def skip(p):
+        for r in rules:
+            if r(p):
+                return True
+        else:
+            return False
+
+    return skip
+
+def make_rules(n, rnd):
+    rules = []
+    for c in range(n):
+        kind = c % 3
+        word = 'w%05d' % rnd.randrange(100000)
+        if kind == 0:
+            rules.append('*.' + word)
+        elif kind == 1:
+            rules.append(word + '*')
+        else:
+            rules.append(word)
+    return rules
+
+def make_tree(n_files, per_dir, rnd):
+    """ Return ``(dirs, files)`` as lists of relative paths. """
+    dirs = []
+    files = []
+    for c in xrange(n_files):
+        if c % per_dir == 0:
+            dirs.append('d%03d/d%05d' % (c // per_dir // 100, c // per_dir))
+        ext = 'w%05d' % rnd.randrange(100000)
+        files.append('%s/file%07d.%s' % (dirs[-1], c, ext))
+    return dirs, files
+
+def measure(label, func, dirs, files):
+    t0 = time()
+    n = sum(1 for p in dirs if func(p, True))
+    n += sum(1 for p in files if func(p, False))
+    elapsed = time() - t0
+    entries = len(dirs) + len(files)
+    print "%-10s %8d entries  %7.2f s  %9.0f entries/s  (%d skipped)" % (
+        label, entries, elapsed, entries / elapsed, n)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rules', type=int, default=300)
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--per-dir', type=int, default=1000)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    rules = make_rules(args.rules, rnd)
+    dirs, files = make_tree(args.files, args.per_dir, rnd)
+
+    legacy_skip = legacy_parse_ignore_file(rules)
+    def legacy(file_path, is_dir):
+        return legacy_skip(file_path[file_path.rfind('/') + 1:])
+
+    measure('lambdas', legacy, dirs, files)
+    measure('compiled', IgnoreRules(rules), dirs, files)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Measure the rate of 'file_meta' messages through a pipe, one pickle per
+message versus batched messages.
+
+    python bench/bench_messages.py [--files 1000000]
+"""
+
+import os
+from os import path
+import sys
+from hashlib import sha1
+from time import time
+
+import argparse
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..'))
+from magicfolder.picklemsg import Remote
+from magicfolder.checksum import FileItem
+
+def run(n_files, batching):
+    """ Send `n_files` messages to a child process; return the time until
+    the child has read them all. """
+    read_fd, write_fd = os.pipe()
+    done_read_fd, done_write_fd = os.pipe()
+    if os.fork() == 0:
+        os.close(write_fd)
+        receiver = Remote(os.fdopen(read_fd, 'rb'), open(os.devnull, 'wb'))
+        while receiver.recv()[0] != 'done':
+            pass
+        os.write(done_write_fd, 'x')
+        os._exit(0)
+
+    os.close(read_fd)
+    items = [FileItem('folder/file %d' % i, sha1(str(i)).hexdigest(), i, None)
+             for i in xrange(n_files)]
+    sender = Remote(open(os.devnull, 'rb'), os.fdopen(write_fd, 'wb'))
+    sender.batching = batching
+
+    t0 = time()
+    for i in items:
+        sender.send_batched('file_meta', i)
+    sender.send('done')
+    os.read(done_read_fd, 1)
+    duration = time() - t0
+    os.wait()
+    return duration
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=1000000)
+    args = parser.parse_args()
+
+    for batching in (False, True):
+        duration = run(args.files, batching)
+        print "%-10s %7.2f s  %9d messages/s" % (
+            "batched" if batching else "unbatched",
+            duration, args.files / duration)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Measure file transfer throughput through a pipe, with pickled messages
+versus framed messages, against a plain copy through the pipe.
+
+    python bench/bench_transfer.py [--megabytes 512]
+"""
+
+import os
+from os import path
+import sys
+import tempfile
+from time import time
+
+import argparse
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..'))
+from magicfolder.picklemsg import Remote, FRAME_VERSION, MAX_CHUNK_SIZE
+
+class NullFile(object):
+    def write(self, data):
+        pass
+
+def run(src_path, mode):
+    """ Send the file at `src_path` to a child process; return the time
+    until the child has read it all. """
+    read_fd, write_fd = os.pipe()
+    done_read_fd, done_write_fd = os.pipe()
+    if os.fork() == 0:
+        os.close(write_fd)
+        in_file = os.fdopen(read_fd, 'rb')
+        if mode == 'pipe':
+            while in_file.read(MAX_CHUNK_SIZE):
+                pass
+        else:
+            receiver = Remote(in_file, open(os.devnull, 'wb'))
+            if mode == 'framed':
+                receiver.set_framing(FRAME_VERSION)
+            receiver.recv_file(NullFile())
+        os.write(done_write_fd, 'x')
+        os._exit(0)
+
+    os.close(read_fd)
+    out_file = os.fdopen(write_fd, 'wb')
+    t0 = time()
+    with open(src_path, 'rb') as src_file:
+        if mode == 'pipe':
+            while True:
+                data = src_file.read(MAX_CHUNK_SIZE)
+                if not data:
+                    break
+                out_file.write(data)
+        else:
+            sender = Remote(open(os.devnull, 'rb'), out_file)
+            if mode == 'framed':
+                sender.set_framing(FRAME_VERSION)
+            sender.send_file(src_file)
+    out_file.close()
+    os.read(done_read_fd, 1)
+    duration = time() - t0
+    os.wait()
+    return duration
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=int, default=512)
+    args = parser.parse_args()
+
+    fd, src_path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for c in xrange(args.megabytes):
+                f.write(block)
+        for mode in ['pipe', 'pickled', 'framed']:
+            duration = run(src_path, mode)
+            print "%-8s %7.2f s  %8.1f MB/s" % (
+                mode, duration, args.megabytes / duration)
+    finally:
+        os.unlink(src_path)
+
+if __name__ == '__main__':
+    main()
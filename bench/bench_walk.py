@@ -0,0 +1,72 @@
+"""
+Compare the tree walker against the previous ``os.walk`` + ``os.stat``
+implementation on a synthetic tree.
+
+    python bench/bench_walk.py [--files 1000000] [--per-dir 1000] [TREE]
+
+The tree is created on the first run and reused afterwards.
+"""
+
+import os
+from os import path
+import sys
+import tempfile
+from time import time
+
+import argparse
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..'))
+from magicfolder.checksum import walk_repo
+
+def make_tree(root_path, n_files, per_dir):
+    os.mkdir(path.join(root_path, '.mf'))
+    for i in xrange(n_files):
+        dir_path = path.join(root_path, 'd%04d' % (i // per_dir / 100),
+                             'd%04d' % (i // per_dir))
+        if i % per_dir == 0 and not path.isdir(dir_path):
+            os.makedirs(dir_path)
+        with open(path.join(dir_path, 'f%07d' % i), 'wb') as f:
+            f.write('x' * (i % 7))
+
+def legacy_walk(root_path, skip):
+    for parent_path, dir_names, file_names in os.walk(root_path):
+        parent_rel_path = parent_path[len(root_path):]
+        if parent_rel_path == '':
+            dir_names.remove('.mf')
+        dir_names[:] = sorted(d for d in dir_names if not skip(d))
+        for name in sorted(file_names):
+            if skip(name):
+                continue
+            file_path = (parent_rel_path + '/' + name)[1:]
+            file_stat = os.stat(path.join(root_path, file_path))
+            yield file_path, file_stat.st_size, file_stat.st_mtime
+
+def measure(label, walk, root_path):
+    t0 = time()
+    n = 0
+    for entry in walk(root_path, lambda *args: False):
+        n += 1
+    elapsed = time() - t0
+    print "%-10s %8d files  %7.2f s  %9.0f files/s" % (
+        label, n, elapsed, n / elapsed)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tree', nargs='?',
+                        default=path.join(tempfile.gettempdir(),
+                                          'mf-bench-walk'))
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--per-dir', type=int, default=1000)
+    args = parser.parse_args()
+
+    if not path.isdir(args.tree):
+        os.mkdir(args.tree)
+        print "creating %d files in %s ..." % (args.files, args.tree)
+        make_tree(args.tree, args.files, args.per_dir)
+
+    for c in range(2):
+        measure('os.walk', legacy_walk, args.tree)
+        measure('walk_repo', walk_repo, args.tree)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Maintenance commands for server archives, run on the server host.
+"""
+
+import os
+from os import path
+import tempfile
+import argparse
+
+from checksum import read_version_file
+from blobdb import DEFAULT_PACK_THRESHOLD
+from server import Archive, dump_fileitems, write_config
+
+def migrate_manifests(archive, binary=True):
+    """
+    Rewrite all version snapshots in the binary (or text) manifest
+    format, and make it the format for new versions. Version deltas are
+    left as they are. Each file is replaced atomically, so an interrupted
+    migration leaves a readable archive; run it again to finish.
+    """
+    versions_path = path.join(archive.root_path, 'versions')
+    converted = 0
+    with archive.lock(): # syncs can't commit meanwhile
+        names = [v for v in os.listdir(versions_path) if v.isdigit()]
+        for name in sorted(names, key=int):
+            version_path = path.join(versions_path, name)
+            with open(version_path, 'rb') as f:
+                bag = list(read_version_file(f))
+            fd, tmp_path = tempfile.mkstemp(dir=versions_path)
+            with os.fdopen(fd, 'wb') as f:
+                dump_fileitems(f, bag, binary)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, version_path)
+            converted += 1
+
+        archive.config['manifest_format'] = 'binary' if binary else 'text'
+        write_config(archive.root_path, archive.config)
+    return converted
+
+def repack(archive, max_size=None):
+    """ Move small loose blobs into a new pack. `max_size` defaults to
+    the ``pack_threshold`` setting. """
+    if max_size is None:
+        max_size = archive.config.get('pack_threshold',
+                                      DEFAULT_PACK_THRESHOLD)
+    return archive.data_pool.repack(max_size)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root_path",
+        help="path of the server archive")
+    subparsers = parser.add_subparsers(dest='subcmd')
+
+    migrate_parser = subparsers.add_parser('migrate-manifests',
+        help="convert version files to another manifest format")
+    migrate_parser.add_argument("--text",
+        action="store_false", dest="binary", default=True,
+        help="convert back to the text format")
+
+    repack_parser = subparsers.add_parser('repack',
+        help="move small blobs into a packfile")
+    repack_parser.add_argument("--max-size",
+        type=int, default=None,
+        help="pack blobs smaller than this many bytes")
+
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = parse_args()
+    archive = Archive(args.root_path)
+
+    if args.subcmd == 'migrate-manifests':
+        n = migrate_manifests(archive, args.binary)
+        print "converted %d versions" % n
+    elif args.subcmd == 'repack':
+        n = repack(archive, args.max_size)
+        print "packed %d blobs" % n
+    else:
+        raise ValueError('bad param')
@@ -1,10 +1,18 @@
 import os
 from os import path
 import tempfile
+import fcntl
+import heapq
+import errno
+import struct
+from binascii import hexlify, unhexlify
 from hashlib import sha1
-from contextlib import contextmanager
+from contextlib import contextmanager, closing
+from functools import partial
+from operator import itemgetter
 
 from checksum import CHUNK_SIZE
+from compression import compressor, decompressor
 
 class ChecksumWrapper(object):
     def __init__(self, orig_file):
@@ -25,41 +33,761 @@ class ChecksumWrapper(object):
     def __exit__(self, *exc_info):
         self.close()
 
+class CompressingWriter(object):
+    """ Write-only file object that compresses into `orig_file`. """
+
+    def __init__(self, orig_file, settings):
+        self.orig_file = orig_file
+        self.stream = compressor(settings, sync_flush=False)
+
+    def write(self, data):
+        self.orig_file.write(self.stream.compress(data))
+
+    def close(self):
+        self.orig_file.write(self.stream.flush())
+
+class DecompressingReader(object):
+    """ Read-only file object over a compressed blob. Seeking backwards
+    decompresses again from the start. """
+
+    def __init__(self, orig_file, codec):
+        self.orig_file = orig_file
+        self.codec = codec
+        self._rewind()
+
+    def _rewind(self):
+        self.orig_file.seek(0)
+        self.stream = decompressor(self.codec)
+        self.buffer = ''
+        self.buffer_offset = 0
+        self.position = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.buffer_offset < size:
+            data = self.orig_file.read(CHUNK_SIZE)
+            if not data:
+                break
+            self.buffer = (self.buffer[self.buffer_offset:] +
+                           self.stream.decompress(data))
+            self.buffer_offset = 0
+        if size < 0:
+            size = len(self.buffer) - self.buffer_offset
+        data = self.buffer[self.buffer_offset:self.buffer_offset + size]
+        self.buffer_offset += len(data)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset):
+        if offset < self.position:
+            self._rewind()
+        while self.position < offset:
+            if not self.read(min(offset - self.position, CHUNK_SIZE)):
+                break
+
+    def close(self):
+        self.orig_file.close()
+
+class ChunkedReader(object):
+    """ Read-only file object over a list of chunk blobs. """
+
+    def __init__(self, blob_db, chunks):
+        self.blob_db = blob_db
+        self.chunks = chunks
+        self.index = 0 # chunk to open next
+        self.current = None
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.current is None:
+                if self.index >= len(self.chunks):
+                    break
+                self._open_next_chunk()
+            data = self.current.read(size)
+            if not data:
+                self.current.close()
+                self.current = None
+                continue
+            parts.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(parts)
+
+    def seek(self, offset):
+        self.close()
+        self.index = 0
+        for chunk_checksum, size in self.chunks:
+            if offset < size:
+                break
+            offset -= size
+            self.index += 1
+        if offset and self.index < len(self.chunks):
+            self._open_next_chunk()
+            self.current.seek(offset)
+
+    def _open_next_chunk(self):
+        chunk_checksum = self.chunks[self.index][0]
+        self.current = self.blob_db.open_blob(chunk_checksum)
+        assert self.current is not None, "chunk %s not found" % chunk_checksum
+        self.index += 1
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+INDEX_LOG_MERGE = 10000 # log entries that trigger a rewrite of the index
+DIGEST_SIZE = 20
+
+class ObjectIndex(object):
+    """
+    Existence index for a `BlobDB`: a file of sorted binary SHA-1
+    digests, plus a ``.log`` file where new digests are appended. Both
+    are read into memory on first use; the log is merged into the sorted
+    file once it grows past `INDEX_LOG_MERGE` entries.
+
+    The index is authoritative: a digest that's not in it is not looked
+    up in the store. Every blob write goes through a temp file in
+    `store_path`, so it bumps the folder's mtime; writers that keep the
+    index then touch the sorted file. A store folder newer than the
+    sorted file (or a missing sorted file) means blobs were written by a
+    release that doesn't know about the index, and the index is rebuilt
+    by listing the store. Answering a query costs a single stat of
+    `store_path`; the index files are only read again if it changed.
+    """
+
+    def __init__(self, index_path, store_path, list_checksums):
+        self.index_path = index_path
+        self.log_path = index_path + '.log'
+        self.store_path = store_path
+        self.list_checksums = list_checksums
+        self._sorted = None
+        self._sorted_inode = None
+        self._log = None
+        self._store_mtime = None
+
+    def _refresh(self):
+        store_mtime = os.stat(self.store_path).st_mtime
+        if self._sorted is None or store_mtime != self._store_mtime:
+            self._load()
+
+    def _load(self):
+        with open(self.log_path, 'ab+') as log_file:
+            # writers append to the log under this lock after their blob
+            # is in place, so a rebuild can't miss a blob or lose an entry
+            fcntl.flock(log_file, fcntl.LOCK_EX)
+            store_mtime = os.stat(self.store_path).st_mtime
+            try:
+                stale = path.getmtime(self.index_path) < store_mtime
+            except OSError:
+                stale = True
+            if stale:
+                self._write_sorted(sorted(unhexlify(c)
+                                          for c in self.list_checksums()))
+                log_file.truncate(0)
+
+            inode = os.stat(self.index_path).st_ino
+            if inode != self._sorted_inode:
+                with open(self.index_path, 'rb') as f:
+                    self._sorted = f.read()
+                self._sorted_inode = inode
+
+            log_file.seek(0)
+            log_data = log_file.read()
+            self._log = set(log_data[i:i + DIGEST_SIZE] for i in
+                            xrange(0, len(log_data) // DIGEST_SIZE *
+                                      DIGEST_SIZE, DIGEST_SIZE))
+            if len(self._log) >= INDEX_LOG_MERGE:
+                self._merge_log()
+                log_file.truncate(0)
+            self._store_mtime = store_mtime
+
+    def _write_sorted(self, digests):
+        fd, temp_path = tempfile.mkstemp(dir=path.dirname(self.index_path))
+        with os.fdopen(fd, 'wb') as f:
+            for digest in digests:
+                f.write(digest)
+        os.rename(temp_path, self.index_path)
+
+    def _merge_log(self):
+        new_digests = sorted(d for d in self._log if not self._bsearch(d)[0])
+        old_digests = (self._sorted[i:i + DIGEST_SIZE]
+                       for i in xrange(0, len(self._sorted), DIGEST_SIZE))
+        self._write_sorted(heapq.merge(old_digests, new_digests))
+        with open(self.index_path, 'rb') as f:
+            self._sorted = f.read()
+        self._sorted_inode = os.stat(self.index_path).st_ino
+        self._log = set()
+
+    def _bsearch(self, digest, lo=0):
+        """ Return ``(found, position)`` of `digest` in the sorted file,
+        searching from entry `lo` on. If `lo` is given, the search
+        gallops forward from it first, so it's quick when `digest` is
+        close by. """
+        data = self._sorted
+        n = len(data) // DIGEST_SIZE
+        hi = n
+        if lo:
+            step = 1
+            while (lo + step < n and
+                   data[(lo + step) * DIGEST_SIZE:
+                        (lo + step + 1) * DIGEST_SIZE] < digest):
+                lo += step
+                step *= 2
+            hi = min(lo + step + 1, n)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[mid * DIGEST_SIZE:(mid + 1) * DIGEST_SIZE] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = data[lo * DIGEST_SIZE:(lo + 1) * DIGEST_SIZE] == digest
+        return found, lo
+
+    def __contains__(self, checksum):
+        self._refresh()
+        digest = unhexlify(checksum)
+        return digest in self._log or self._bsearch(digest)[0]
+
+    def contains_many(self, checksums):
+        """ Return the set of `checksums` that are in the index. """
+        self._refresh()
+        found = set()
+        position = 0
+        for digest in sorted(set(unhexlify(c) for c in checksums)):
+            if digest in self._log:
+                found.add(digest)
+                continue
+            # the queries are sorted, so each search starts where the
+            # previous one ended
+            is_present, position = self._bsearch(digest, position)
+            if is_present:
+                found.add(digest)
+        return set(hexlify(d) for d in found)
+
+    def add(self, checksum):
+        """ Record a blob that was just moved into the store. """
+        digest = unhexlify(checksum)
+        with open(self.log_path, 'ab') as log_file:
+            fcntl.flock(log_file, fcntl.LOCK_EX)
+            if self._log is None or digest not in self._log:
+                log_file.write(digest)
+            # moving the blob in bumped the store's mtime; mark the index
+            # as up to date with it
+            try:
+                os.utime(self.index_path, None)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        if self._log is not None:
+            self._log.add(digest)
+            self._store_mtime = os.stat(self.store_path).st_mtime
+
+PACK_MAGIC = 'MFPACK\x00\x01'
+PACK_CODECS = [None, 'zlib', 'bz2'] # codec ids in pack indexes
+DEFAULT_PACK_THRESHOLD = 256 * 1024 # bytes
+PACK_MERGE_FACTOR = 2 # see `BlobDB.repack`
+
+_pack_entry = struct.Struct('>20sQQB') # digest, offset, length, codec id
+
+class PackedReader(object):
+    """ Read-only file object over the stored bytes of one blob in a
+    pack. """
+
+    def __init__(self, pack_file, offset, length):
+        self.pack_file = pack_file
+        self.offset = offset
+        self.length = length
+        self.seek(0)
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        data = self.pack_file.read(size)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset):
+        self.position = min(offset, self.length)
+        self.pack_file.seek(self.offset + self.position)
+
+    def close(self):
+        self.pack_file.close()
+
+class Pack(object):
+    """
+    A packfile: the stored bytes of many blobs, concatenated in a
+    ``.pack`` file, and a ``.idx`` file with an entry for each blob,
+    sorted by digest. Packs are written once by `write_pack` and never
+    modified, only merged into bigger ones and deleted; the index is
+    renamed into place last and deleted first, so a pack without an
+    index is an incomplete one.
+    """
+
+    def __init__(self, pack_path):
+        self.pack_path = pack_path
+        with open(pack_path + '.idx', 'rb') as f:
+            data = f.read()
+        assert data.startswith(PACK_MAGIC), "bad pack index %s" % pack_path
+        self._entries = data[len(PACK_MAGIC):]
+
+    def __len__(self):
+        return len(self._entries) // _pack_entry.size
+
+    def _entry(self, i):
+        return _pack_entry.unpack_from(self._entries, i * _pack_entry.size)
+
+    def lookup(self, checksum):
+        """ Return ``(offset, length, codec)`` of a blob, or None. """
+        digest = unhexlify(checksum)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self):
+            entry_digest, offset, length, codec_id = self._entry(lo)
+            if entry_digest == digest:
+                return offset, length, PACK_CODECS[codec_id]
+        return None
+
+    def open(self, offset, length):
+        return PackedReader(open(self.pack_path + '.pack', 'rb'),
+                            offset, length)
+
+    def data_size(self):
+        """ Total stored size of the blobs in the pack. """
+        return sum(self._entry(i)[2] for i in xrange(len(self)))
+
+    def iter_blobs(self):
+        """ Yield ``(checksum, codec, open_data)`` for each blob, like
+        `write_pack` takes them. """
+        for i in xrange(len(self)):
+            digest, offset, length, codec_id = self._entry(i)
+            yield (hexlify(digest), PACK_CODECS[codec_id],
+                   partial(self.open, offset, length))
+
+    def iter_checksums(self):
+        for i in xrange(len(self)):
+            yield hexlify(self._entry(i)[0])
+
+    def delete(self):
+        os.unlink(self.pack_path + '.idx')
+        os.unlink(self.pack_path + '.pack')
+
+def write_pack(pack_folder, blobs):
+    """
+    Write a pack from `blobs`, a list of ``(checksum, codec, open_data)``
+    where `open_data` opens the blob's stored bytes, and return its path
+    (without extension).
+    """
+    blobs = sorted(blobs, key=itemgetter(0))
+    name_hash = sha1()
+    entries = []
+    fd, temp_path = tempfile.mkstemp(dir=pack_folder)
+    with os.fdopen(fd, 'wb') as pack_file:
+        pack_file.write(PACK_MAGIC)
+        offset = len(PACK_MAGIC)
+        for checksum, codec, open_data in blobs:
+            length = 0
+            with closing(open_data()) as f:
+                while True:
+                    data = f.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    pack_file.write(data)
+                    length += len(data)
+            entries.append(_pack_entry.pack(unhexlify(checksum), offset,
+                                            length,
+                                            PACK_CODECS.index(codec)))
+            offset += length
+            name_hash.update(checksum)
+        pack_file.flush()
+        os.fsync(pack_file.fileno())
+
+    pack_path = path.join(pack_folder, 'pack-' + name_hash.hexdigest())
+    os.rename(temp_path, pack_path + '.pack')
+    fd, temp_path = tempfile.mkstemp(dir=pack_folder)
+    with os.fdopen(fd, 'wb') as idx_file:
+        idx_file.write(PACK_MAGIC)
+        for entry in entries:
+            idx_file.write(entry)
+        idx_file.flush()
+        os.fsync(idx_file.fileno())
+    os.rename(temp_path, pack_path + '.idx')
+    return pack_path
+
 class BlobDB(object):
-    def __init__(self, db_path):
+    """
+    Content-addressed blob store. Each blob is a file named after its
+    SHA-1 under a two-hex-digit bucket folder. A blob may instead be
+    stored as a "recipe", a list of chunk blobs to be concatenated (see
+    `write_recipe`).
+
+    If `index_path` is given, an `ObjectIndex` stored there answers
+    existence queries, so they don't need a stat call for each blob.
+
+    Small blobs can be moved into packfiles (see `Pack` and `repack`)
+    under ``pack/``; reading and existence checks look there after the
+    loose blob files.
+
+    With `compression` settings (see the `compression` module), new
+    blobs are stored compressed, in a file with the codec name as
+    extension. Checksums are always those of the uncompressed contents,
+    and blobs stored either way can be read.
+    """
+
+    def __init__(self, db_path, index_path=None, compression=None):
         self.db_path = db_path
+        self.compression = compression
+        self.pack_folder = path.join(db_path, 'pack')
+        self._packs = []
+        self._packs_mtime = None
+        if index_path is None:
+            self.index = None
+        else:
+            self.index = ObjectIndex(index_path, db_path,
+                                     self.iter_checksums)
+
+    def blob_path(self, checksum, codec=None):
+        blob_path = path.join(self.db_path, checksum[:2], checksum[2:])
+        if codec is not None:
+            blob_path += '.' + codec
+        return blob_path
+
+    def _find_blob(self, checksum):
+        """ Return ``(path, codec)`` of a loose blob, or None. """
+        for codec in PACK_CODECS:
+            blob_path = self.blob_path(checksum, codec)
+            if path.isfile(blob_path):
+                return blob_path, codec
+        return None
+
+    def packs(self, reload=False):
+        """ Return the list of packs, reloaded if new ones appeared. """
+        try:
+            mtime = os.stat(self.pack_folder).st_mtime
+        except OSError:
+            return []
+        if reload or mtime != self._packs_mtime:
+            self._packs = [Pack(path.join(self.pack_folder, name[:-4]))
+                           for name in sorted(os.listdir(self.pack_folder))
+                           if name.endswith('.idx')]
+            self._packs_mtime = mtime
+        return self._packs
+
+    def _find_packed(self, checksum, reload=False):
+        """ Return ``(pack, offset, length, codec)`` of a packed blob, or
+        None. """
+        for pack in self.packs(reload):
+            found = pack.lookup(checksum)
+            if found is not None:
+                return (pack,) + found
+        return None
+
+    def _open_stored(self, checksum):
+        """ Open the stored bytes of a blob; return ``(file, codec)``, or
+        None if it's not a loose or packed blob. """
+        for codec in PACK_CODECS:
+            try:
+                return open(self.blob_path(checksum, codec), 'rb'), codec
+            except IOError, e:
+                # the file may also have been packed since we looked
+                if e.errno != errno.ENOENT:
+                    raise
+        packed = self._open_packed(checksum)
+        if packed is None:
+            # a pack written within the mtime resolution of the last one
+            # would go unnoticed
+            packed = self._open_packed(checksum, reload=True)
+        return packed
+
+    def _open_packed(self, checksum, reload=False):
+        packed = self._find_packed(checksum, reload)
+        if packed is None:
+            return None
+        pack, offset, length, codec = packed
+        try:
+            return pack.open(offset, length), codec
+        except IOError, e:
+            # merged into another pack since we listed them
+            if e.errno != errno.ENOENT or reload:
+                raise
+            return self._open_packed(checksum, reload=True)
+
+    def open_blob(self, checksum):
+        """ Open a blob that's not stored as a recipe, or return None. """
+        stored = self._open_stored(checksum)
+        if stored is None:
+            return None
+        f, codec = stored
+        if codec is None:
+            return f
+        return DecompressingReader(f, codec)
+
+    def recipe_path(self, checksum):
+        return path.join(self.db_path, 'recipes', checksum[:2], checksum[2:])
 
     @contextmanager
     def write_file(self, checksum=None):
         fd, temp_path = tempfile.mkstemp(dir=self.db_path)
-        with os.fdopen(fd, 'wb') as temp_file:
-            with ChecksumWrapper(temp_file) as wrapper:
-                yield wrapper
-            if checksum is not None:
-                assert checksum == wrapper.final_hash
-            else:
-                checksum = wrapper.final_hash
+        codec = None
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                if self.compression is None:
+                    out_file = temp_file
+                else:
+                    codec = self.compression['codec']
+                    out_file = CompressingWriter(temp_file, self.compression)
+                with ChecksumWrapper(out_file) as wrapper:
+                    yield wrapper
+                if out_file is not temp_file:
+                    out_file.close()
+                if checksum is not None:
+                    assert checksum == wrapper.final_hash
+                else:
+                    checksum = wrapper.final_hash
+        except:
+            os.unlink(temp_path)
+            raise
+        self._store(temp_path, checksum, codec)
 
+    def _store(self, temp_path, checksum, codec):
+        """ Move a finished blob file into place. """
         bucket_path = path.join(self.db_path, checksum[:2])
-        blob_path = path.join(bucket_path, checksum[2:])
-
         if not path.isdir(bucket_path):
-            os.makedirs(bucket_path)
+            try:
+                os.makedirs(bucket_path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        os.rename(temp_path, self.blob_path(checksum, codec))
+        if self.index is not None:
+            self.index.add(checksum)
+
+    def partial_path(self, checksum):
+        return path.join(self.db_path, 'partial', checksum)
+
+    def partial_size(self, checksum):
+        """ Number of bytes of blob `checksum` received by an upload that
+        was cut off, or 0. """
+        try:
+            return os.stat(self.partial_path(checksum)).st_size
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+    @contextmanager
+    def write_partial(self, checksum, restart=False):
+        """
+        Receive blob `checksum` into ``partial/<checksum>``, after the
+        bytes that an upload which was cut off left there (none if
+        `restart` is set). Yields ``(file, offset)``, where `offset` is
+        the number of bytes already there. If the transfer fails, the
+        partial file is kept for the next attempt; one that doesn't add
+        up to `checksum` is thrown away.
+        """
+        partial_path = self.partial_path(checksum)
+        if not path.isdir(path.dirname(partial_path)):
+            try:
+                os.makedirs(path.dirname(partial_path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        partial_file = open(partial_path, 'ab+')
+        try:
+            fcntl.flock(partial_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            partial_file.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            # another session is receiving the same blob
+            with self.write_file(checksum) as bf:
+                yield bf, 0
+            return
+
+        with partial_file:
+            if restart:
+                partial_file.truncate(0)
+            wrapper = ChecksumWrapper(partial_file)
+            partial_file.seek(0)
+            while True:
+                data = partial_file.read(CHUNK_SIZE)
+                if not data:
+                    break
+                wrapper.sha1_hash.update(data)
+            offset = partial_file.tell()
+            partial_file.seek(0, 2)
+            yield wrapper, offset
+            wrapper.close()
+            partial_file.flush()
+            if wrapper.final_hash != checksum:
+                os.unlink(partial_path)
+            assert wrapper.final_hash == checksum, (
+                "partial upload doesn't match blob %s" % checksum)
+
+            if self.compression is None:
+                self._store(partial_path, checksum, None)
+            else:
+                partial_file.seek(0)
+                with self.write_file(checksum) as bf:
+                    while True:
+                        data = partial_file.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        bf.write(data)
+                os.unlink(partial_path)
+
+    def write_recipe(self, checksum, chunks):
+        """
+        Store blob `checksum` as the concatenation of `chunks`, a list of
+        ``(chunk_checksum, size)`` for blobs that are already stored. The
+        chunks are read back to verify `checksum`.
+        """
+        sha1_hash = sha1()
+        reader = ChunkedReader(self, chunks)
+        while True:
+            data = reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            sha1_hash.update(data)
+        assert sha1_hash.hexdigest() == checksum, (
+            "chunks don't add up to blob %s" % checksum)
+
+        recipe_path = self.recipe_path(checksum)
+        if not path.isdir(path.dirname(recipe_path)):
+            os.makedirs(path.dirname(recipe_path))
+        fd, temp_path = tempfile.mkstemp(dir=self.db_path)
+        with os.fdopen(fd, 'wb') as temp_file:
+            for chunk_checksum, size in chunks:
+                temp_file.write('%s %d\n' % (chunk_checksum, size))
+        os.rename(temp_path, recipe_path)
+        if self.index is not None:
+            self.index.add(checksum)
 
-        os.rename(temp_path, blob_path)
+    def read_recipe(self, checksum):
+        """ Return the chunk list of a chunked blob, or None. """
+        recipe_path = self.recipe_path(checksum)
+        if not path.isfile(recipe_path):
+            return None
+        with open(recipe_path, 'rb') as f:
+            return [(chunk_checksum, int(size))
+                    for chunk_checksum, size in (line.split() for line in f)]
 
     @contextmanager
     def read_file(self, checksum):
-        # TODO: write tests for this method
-        bucket_path = path.join(self.db_path, checksum[:2])
-        blob_path = path.join(bucket_path, checksum[2:])
-        assert path.isfile(blob_path)
-        f = open(blob_path, 'rb')
+        f = self.open_blob(checksum)
+        if f is None:
+            chunks = self.read_recipe(checksum)
+            assert chunks is not None, "blob %s not found" % checksum
+            f = ChunkedReader(self, chunks)
         yield f
         f.close()
 
+    @contextmanager
+    def read_compressed(self, checksum, codec):
+        """ Yield the stored, still compressed contents of a blob if it's
+        stored compressed with `codec`, else None. """
+        blob_path = self.blob_path(checksum, codec)
+        if path.isfile(blob_path):
+            f = open(blob_path, 'rb')
+        else:
+            f = None
+            packed = self._open_packed(checksum)
+            if packed is not None:
+                if packed[1] == codec:
+                    f = packed[0]
+                else:
+                    packed[0].close()
+        yield f
+        if f is not None:
+            f.close()
+
+    def repack(self, max_size=DEFAULT_PACK_THRESHOLD):
+        """
+        Move loose blobs smaller than `max_size` bytes (as stored) into a
+        new pack. Return the number of blobs packed.
+
+        Existing packs, smallest first, are merged into the new one for
+        as long as each is less than `PACK_MERGE_FACTOR` times the size
+        of what's merged so far. Pack sizes then grow geometrically, so
+        there are only logarithmically many packs to look blobs up in.
+        """
+        blobs = []
+        for bucket in os.listdir(self.db_path):
+            bucket_path = path.join(self.db_path, bucket)
+            if len(bucket) != 2 or not path.isdir(bucket_path):
+                continue
+            for name in os.listdir(bucket_path):
+                blob_path = path.join(bucket_path, name)
+                if path.getsize(blob_path) >= max_size:
+                    continue
+                codec = name.split('.')[1] if '.' in name else None
+                blobs.append((bucket + name.split('.')[0], codec, blob_path))
+        if not blobs:
+            return 0
+
+        if not path.isdir(self.pack_folder):
+            os.makedirs(self.pack_folder)
+        merged_size = sum(path.getsize(blob[2]) for blob in blobs)
+        merged_packs = []
+        packs = [(pack.data_size(), pack)
+                 for pack in self.packs(reload=True)]
+        for data_size, pack in sorted(packs, key=itemgetter(0)):
+            if data_size >= merged_size * PACK_MERGE_FACTOR:
+                break
+            merged_packs.append(pack)
+            merged_size += data_size
+
+        # a blob may be both loose and packed; keep one copy
+        contents = {}
+        for pack in merged_packs:
+            for checksum, codec, open_data in pack.iter_blobs():
+                contents[checksum] = (checksum, codec, open_data)
+        for checksum, codec, blob_path in blobs:
+            contents[checksum] = (checksum, codec,
+                                  partial(open, blob_path, 'rb'))
+        pack_path = write_pack(self.pack_folder, contents.values())
+
+        for pack in merged_packs:
+            if pack.pack_path != pack_path:
+                pack.delete()
+        for checksum, codec, blob_path in blobs:
+            os.unlink(blob_path)
+        return len(blobs)
+
+    def _is_stored(self, checksum):
+        return (self._find_blob(checksum) is not None or
+                path.isfile(self.recipe_path(checksum)) or
+                self._find_packed(checksum) is not None)
+
     def __contains__(self, checksum):
         assert isinstance(checksum, str)
         assert len(checksum) == 40
-        hash_path = path.join(self.db_path, checksum[:2], checksum[2:])
-        return path.isfile(hash_path)
+        if self.index is not None:
+            return checksum in self.index
+        return self._is_stored(checksum)
+
+    def contains_many(self, checksums):
+        """ Return the set of `checksums` that are stored. """
+        if self.index is not None:
+            return self.index.contains_many(checksums)
+        return set(c for c in set(checksums) if self._is_stored(c))
+
+    def iter_checksums(self):
+        """ List the checksums of all stored blobs. """
+        for folder in (self.db_path, path.join(self.db_path, 'recipes')):
+            if not path.isdir(folder):
+                continue
+            for bucket in os.listdir(folder):
+                if len(bucket) != 2:
+                    continue
+                for name in os.listdir(path.join(folder, bucket)):
+                    yield bucket + name.split('.')[0]
+        for pack in self.packs():
+            for checksum in pack.iter_checksums():
+                yield checksum
@@ -1,101 +1,375 @@
 import os
 from os import path
+import stat
 from collections import namedtuple
 from hashlib import sha1
-import cPickle as pickle
-from itertools import imap, ifilterfalse
+from itertools import imap
+from operator import itemgetter
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from contextlib import contextmanager
 import re
 import json
+from time import time
+
+from scancache import ScanCache
+import manifest
+from journal import Journal, changed_paths
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 FileItem = namedtuple('FileItem', 'path checksum size time')
 
+FileEntry = namedtuple('FileEntry', 'path size time inode')
+
 CHUNK_SIZE = 64 * 1024 # 64 KB
 
-def repo_files(root_path, skip):
+HASH_WINDOW = 4 # pending files per hashing worker
+
+def _scan_dir(dir_path):
+    """
+    List `dir_path` as ``(name, is_dir, stat_result)`` tuples. Symlinks to
+    directories are left out, like `os.walk` does; `stat_result` is None
+    for directories. Each file costs at most one stat call.
+    """
+    if scandir is not None:
+        for entry in scandir(dir_path):
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    yield entry.name, True, None
+            else:
+                yield entry.name, False, entry.stat()
+
+    else:
+        for name in os.listdir(dir_path):
+            entry_path = path.join(dir_path, name)
+            entry_stat = os.lstat(entry_path)
+            if stat.S_ISLNK(entry_stat.st_mode):
+                entry_stat = os.stat(entry_path)
+                if stat.S_ISDIR(entry_stat.st_mode):
+                    continue
+            if stat.S_ISDIR(entry_stat.st_mode):
+                yield name, True, None
+            else:
+                yield name, False, entry_stat
+
+def walk_repo(root_path, skip, rel_path=''):
+    """
+    Yield a `FileEntry` for each file under `root_path` (or only under
+    its `rel_path` subfolder), sorted by path. Size, time and inode come
+    from the directory scan, so no further `os.stat` is needed.
+    ``skip(path, is_dir)`` prunes files and whole folders.
+    """
     assert not root_path.endswith('/')
-    for parent_path, dir_names, file_names in os.walk(root_path):
-        parent_rel_path = parent_path[len(root_path):]
-        if parent_rel_path == '':
-            dir_names.remove('.mf')
-        dir_names[:] = ifilterfalse(skip, dir_names)
-        for name in ifilterfalse(skip, file_names):
-            yield (parent_rel_path + '/' + name)[1:]
+
+    def children(rel_prefix):
+        dir_path = path.join(root_path, rel_prefix)
+        entries = []
+        for name, is_dir, entry_stat in _scan_dir(dir_path):
+            if is_dir:
+                if rel_prefix == '' and name == '.mf':
+                    continue
+                if not skip(rel_prefix + name, True):
+                    entries.append((rel_prefix + name + '/', entry_stat))
+            elif not skip(rel_prefix + name, False):
+                entries.append((rel_prefix + name, entry_stat))
+        # a folder sorts as "name/", so the walk comes out in path order
+        entries.sort(key=itemgetter(0))
+        return iter(entries)
+
+    stack = [children(rel_path + '/' if rel_path else '')]
+    while stack:
+        for entry_path, entry_stat in stack[-1]:
+            if entry_stat is None:
+                stack.append(children(entry_path))
+                break
+            yield FileEntry(entry_path, entry_stat.st_size,
+                            entry_stat.st_mtime, entry_stat.st_ino)
+        else:
+            stack.pop()
+
+def repo_files(root_path, skip):
+    for entry in walk_repo(root_path, skip):
+        yield entry.path
+
+GLOB_CHARS = re.compile(r'[*?[]')
+
+def glob_to_regex(pattern):
+    """
+    Translate a glob to a regex source string. ``*`` and ``?`` stay
+    within one path segment, ``**`` crosses segments.
+    """
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+            continue
+        elif c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[' and ']' in pattern[i+2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i+1:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            out.append('[' + chars + ']')
+            i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+class _RuleSet(object):
+    """ Rules applying to one kind of entry (files or folders). """
+
+    def __init__(self):
+        self.names = set()
+        self.prefixes = []
+        self.suffixes = []
+        self.globs = []
+
+    def add(self, pattern):
+        if '/' in pattern:
+            self.globs.append(glob_to_regex(pattern.lstrip('/')))
+        elif (pattern.startswith('*') and
+              GLOB_CHARS.search(pattern[1:]) is None):
+            self.suffixes.append(pattern[1:])
+        elif (pattern.endswith('*') and
+              GLOB_CHARS.search(pattern[:-1]) is None):
+            self.prefixes.append(pattern[:-1])
+        elif GLOB_CHARS.search(pattern) is not None:
+            self.globs.append('(?:.*/)?' + glob_to_regex(pattern))
+        else:
+            self.names.add(pattern)
+
+    def compile(self):
+        self.names = frozenset(self.names)
+        self.prefixes = tuple(self.prefixes)
+        self.suffixes = tuple(self.suffixes)
+        if self.globs:
+            self.regex = re.compile('(?:%s)\\Z' % '|'.join(self.globs))
+        else:
+            self.regex = None
+
+    def match(self, file_path):
+        name = file_path[file_path.rfind('/') + 1:]
+        return (name in self.names or
+                name.startswith(self.prefixes) or
+                name.endswith(self.suffixes) or
+                (self.regex is not None and
+                 self.regex.match(file_path) is not None))
+
+class IgnoreRules(object):
+    """
+    Compiled ``.mfignore`` rules, one pattern per line:
+
+    * ``name``, ``*suffix`` and ``prefix*`` match the base name of any
+      file or folder; they are indexed in a set and in tuples for
+      `str.startswith` / `str.endswith`.
+    * other patterns with ``*``, ``?`` or ``[...]`` are globs on the base
+      name.
+    * a pattern containing ``/`` is anchored at the repository root and
+      matched against the whole path, e.g. ``/build`` or ``docs/*.pdf``.
+    * a trailing ``/`` restricts the pattern to folders.
+
+    All globs for one kind of entry are combined into a single regex.
+    Calling the object with ``(path, is_dir)`` tells whether to skip an
+    entry; ignored folders are never descended into.
+    """
+
+    def __init__(self, patterns):
+        self.file_rules = _RuleSet()
+        self.dir_rules = _RuleSet()
+        for pattern in patterns:
+            if not pattern:
+                continue
+            if pattern.endswith('/'):
+                self.dir_rules.add(pattern.rstrip('/'))
+            else:
+                self.file_rules.add(pattern)
+                self.dir_rules.add(pattern)
+        self.file_rules.compile()
+        self.dir_rules.compile()
+
+    def __call__(self, file_path, is_dir=False):
+        if is_dir:
+            return self.dir_rules.match(file_path)
+        else:
+            return self.file_rules.match(file_path)
 
 def parse_ignore_file(f):
-    def rule(line):
-        if line.startswith('*'):
-            return lambda p: p.endswith(line[1:])
-        elif line.endswith('*'):
-            return lambda p: p.startswith(line[:-1])
+    return IgnoreRules(imap(str.strip, f))
+
+def hash_file(file_path):
+    """ Return the hex SHA-1 digest and the byte count of a file. """
+    sha1_hash = sha1()
+    size_count = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            sha1_hash.update(data)
+            size_count += len(data)
+    return sha1_hash.hexdigest(), size_count
+
+class _Done(object):
+    """ An already-computed result, quacking like an `AsyncResult`. """
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+def _hash_file_item(file_full_path, file_path, file_size, file_time):
+    file_checksum, size_count = hash_file(file_full_path)
+    assert size_count == file_size
+    return FileItem(file_path, file_checksum, file_size, file_time)
+
+class _Hasher(object):
+    """
+    Turn `FileEntry` objects into `FileItem` objects, taking checksums
+    from the cache when size and time match and hashing the other files
+    on a pool of `workers` threads.
+    """
+
+    def __init__(self, root_path, cache, use_cache, workers):
+        self.root_path = root_path
+        self.cache = cache
+        self.use_cache = use_cache
+        if workers > 1:
+            self.pool = ThreadPool(workers)
         else:
-            return lambda p: p == line
+            self.pool = None
+        self.window = HASH_WINDOW * workers
+
+    def lookup(self, entry):
+        file_path, file_size, file_time = entry.path, entry.size, entry.time
+        file_full_path = path.join(self.root_path, file_path)
 
-    rules = []
-    for line in imap(str.strip, f):
-        rules.append(rule(line))
+        if self.use_cache:
+            cached = self.cache.get(file_path)
+            if cached is not None and cached[1:] == (file_size, file_time):
+                return _Done(FileItem(file_path, *cached))
 
-    def skip(p):
-        for r in rules:
-            if r(p):
-                return True
+        args = (file_full_path, file_path, file_size, file_time)
+        if self.pool is None:
+            return _Done(_hash_file_item(*args))
         else:
-            return False
+            return self.pool.apply_async(_hash_file_item, args)
 
-    return skip
+    def file_items(self, entries):
+        """ Yield a `FileItem` per entry, in order, recording each one in
+        the cache. At most `window` files are in flight. """
+        pending = deque()
+        for entry in entries:
+            pending.append(self.lookup(entry))
+            while pending and (len(pending) > self.window or
+                               pending[0].ready()):
+                file_item = pending.popleft().get()
+                yield file_item
+                self.cache.put(*file_item)
 
-def repo_file_events(root_path, use_cache=False):
+        while pending:
+            file_item = pending.popleft().get()
+            yield file_item
+            self.cache.put(*file_item)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+
+def load_ignore_rules(root_path):
     ignore_path = path.join(root_path, '.mfignore')
     if path.isfile(ignore_path):
         with open(ignore_path, 'r') as f:
-            skip = parse_ignore_file(f)
+            return parse_ignore_file(f)
     else:
-        skip = lambda p: False
+        return IgnoreRules([])
 
-    cache_path = path.join(root_path, '.mf/cache')
+def _rescan_path(root_path, skip, hasher, cache, file_path):
+    """ Bring the cache entries at and below `file_path` up to date. """
+    parts = file_path.split('/')
+    ignored = (parts[0] == '.mf' or
+               any(skip('/'.join(parts[:c]), True)
+                   for c in range(1, len(parts))))
 
-    if use_cache and path.isfile(cache_path):
-        with open(cache_path, 'rb') as f:
-            cache = pickle.load(f)
-    else:
-        cache = {}
+    full_path = path.join(root_path, file_path)
+    entries = []
+    if ignored or path.islink(full_path) and path.isdir(full_path):
+        pass
+    elif path.isdir(full_path):
+        if not skip(file_path, True):
+            entries = walk_repo(root_path, skip, file_path)
+    elif path.isfile(full_path):
+        if not skip(file_path, False):
+            file_stat = os.stat(full_path)
+            entries = [FileEntry(file_path, file_stat.st_size,
+                                 file_stat.st_mtime, file_stat.st_ino)]
 
-    new_cache = {}
+    seen = set(file_item.path for file_item in hasher.file_items(entries))
+    for old_path in cache.paths_under(file_path):
+        if old_path not in seen:
+            cache.remove(old_path)
 
-    for file_path in repo_files(root_path, skip):
-        file_full_path = path.join(root_path, file_path)
-        file_stat = os.stat(file_full_path)
-        file_size = file_stat.st_size
-        file_time = file_stat.st_mtime
+def repo_file_events(root_path, use_cache=False, workers=1):
+    """
+    Yield a `FileItem` for each file in the working tree at `root_path`,
+    sorted by path. Every item is recorded in the `.mf/cache.db`
+    `ScanCache`. Files that are not in the cache (or whose size and time
+    changed) are hashed by a pool of `workers` threads; at most
+    `HASH_WINDOW * workers` files are in flight.
 
-        file_item = None
+    If a watcher (``mf watch``) has been journaling changes since the
+    previous scan, only the journaled paths are looked at, and the rest
+    of the listing comes from the cache. Otherwise, or if the last full
+    scan is older than `journal.FULL_SCAN_INTERVAL`, the whole tree is
+    walked.
+    """
+    skip = load_ignore_rules(root_path)
+    cache = ScanCache(path.join(root_path, '.mf/cache.db'),
+                      legacy_path=path.join(root_path, '.mf/cache'))
+    journal = Journal(path.join(root_path, '.mf'))
+    watcher_id, changed = changed_paths(journal, cache, use_cache)
+    hasher = _Hasher(root_path, cache, use_cache, workers)
 
-        if file_path in cache:
-            cached_item = cache[file_path]
-            if (file_size, file_time) == (cached_item.size, cached_item.time):
-                file_item = cached_item
+    try:
+        if changed is None:
+            cache.begin_scan()
+            for file_item in hasher.file_items(walk_repo(root_path, skip)):
+                yield file_item
+            cache.finish_scan()
+            cache.set_meta('full_scan_time', time())
+            if cache.needs_compaction():
+                cache.compact_in_background()
 
-        if file_item is None:
-            sha1_hash = sha1()
-            size_count = 0
-            with open(file_full_path, 'rb') as f:
-                while True:
-                    data = f.read(CHUNK_SIZE)
-                    if not data:
-                        break
-                    sha1_hash.update(data)
-                    size_count += len(data)
-            assert size_count == file_size
-            file_checksum = sha1_hash.hexdigest()
-
-            file_item = FileItem(file_path, file_checksum,
-                                 file_size, file_time)
+        else:
+            cache.begin_scan(incremental=True)
+            for file_path in sorted(changed):
+                _rescan_path(root_path, skip, hasher, cache, file_path)
+            for row in cache.items():
+                yield FileItem(*row)
 
-        yield file_item
-        new_cache[file_path] = file_item
+        cache.set_meta('journal_id', watcher_id)
+        cache.checkpoint()
+        journal.commit()
 
-    with open(cache_path, 'wb') as f:
-        pickle.dump(new_cache, f, protocol=2)
+    finally:
+        hasher.close()
+        cache.close()
 
 file_item_pattern = re.compile(r'^(?P<checksum>"[0-9a-f]{40}")\s*'
                                r'(?P<size>\d+)\s*'
@@ -123,11 +397,29 @@ def file_item_to_string(file_item):
                            jstr_dump(file_item.path))
 
 def read_version_file(fh):
+    """ Iterate over a version file, text or binary manifest. `fh` must
+    be seekable. """
+    header = fh.read(len(manifest.MAGIC))
+    fh.seek(0)
+    if manifest.is_manifest(header):
+        return (FileItem(p, c, s, None) for p, c, s in
+                manifest.iter_manifest(fh))
     return imap(string_to_file_item, fh)
 
 @contextmanager
-def write_version_file(fh):
-    def write_file_item(file_item):
-        fh.write(file_item_to_string(file_item) + '\n')
+def write_version_file(fh, binary=False):
+    """ Yield a function that writes file items to `fh`, in path
+    order. """
+    if binary:
+        writer = manifest.ManifestWriter(fh)
+        def write_file_item(file_item):
+            writer.write(file_item.path, file_item.checksum, file_item.size)
+
+        yield write_file_item
+        writer.close()
+
+    else:
+        def write_file_item(file_item):
+            fh.write(file_item_to_string(file_item) + '\n')
 
-    yield write_file_item
+        yield write_file_item
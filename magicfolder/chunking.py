@@ -0,0 +1,90 @@
+from hashlib import sha1
+
+MIN_CHUNK_SIZE = 256 * 1024 # 256 KB
+AVG_CHUNK_BITS = 20 # 1 MB on average
+MAX_CHUNK_SIZE = 4 * 1024 * 1024 # 4 MB
+
+CHUNKED_FILE_SIZE = 8 * 1024 * 1024 # smaller files are sent whole
+
+READ_SIZE = MAX_CHUNK_SIZE
+
+# The "gear" table must be identical on all hosts, so derive it from
+# sha1 instead of a random number generator.
+GEAR = [int(sha1('magicfolder gear %d' % c).hexdigest()[:8], 16)
+        for c in range(256)]
+
+def _cut_points(buf, start):
+    """
+    Yield the end offsets of content-defined chunks in `buf`, starting at
+    `start`, using a gear rolling hash. The last chunk in `buf` is only
+    cut when it reaches `MAX_CHUNK_SIZE`.
+    """
+    gear = GEAR
+    mask = (1 << AVG_CHUNK_BITS) - 1
+    # the hash only depends on the last 32 bytes, so skip the rest of
+    # the minimum chunk size
+    skip = MIN_CHUNK_SIZE - 32
+    buf_len = len(buf)
+
+    while True:
+        offset = start + skip
+        end = min(start + MAX_CHUNK_SIZE, buf_len)
+        h = 0
+        while offset < end:
+            h = ((h << 1) + gear[buf[offset]]) & 0xffffffff
+            offset += 1
+            if not h & mask and offset - start >= MIN_CHUNK_SIZE:
+                break
+        else:
+            if end - start < MAX_CHUNK_SIZE:
+                return # out of data; wait for more
+        yield offset
+        start = offset
+
+def iter_chunks(f):
+    """
+    Split the contents of file `f` into content-defined chunks. Yields
+    ``(offset, size, checksum)`` tuples; the checksums are hex SHA-1
+    digests, like those of whole files.
+    """
+    buf = bytearray()
+    buf_offset = 0 # file offset of buf[0]
+    eof = False
+
+    while not eof:
+        data = f.read(READ_SIZE)
+        if data:
+            buf.extend(data)
+            if len(buf) < 2 * MAX_CHUNK_SIZE:
+                continue
+        else:
+            eof = True
+
+        start = 0
+        for end in _cut_points(buf, 0):
+            yield (buf_offset + start, end - start,
+                   sha1(buffer(buf, start, end - start)).hexdigest())
+            start = end
+
+        if eof and start < len(buf):
+            yield (buf_offset + start, len(buf) - start,
+                   sha1(buffer(buf, start)).hexdigest())
+            start = len(buf)
+
+        del buf[:start]
+        buf_offset += start
+
+class FileSlice(object):
+    """ File object reading `size` bytes of `f`, starting at `offset`. """
+
+    def __init__(self, f, offset, size):
+        f.seek(offset)
+        self.f = f
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
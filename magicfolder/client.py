@@ -1,18 +1,40 @@
 import os
 from os import path
+import sys
+import errno
+import tempfile
+import threading
+import fcntl
+from Queue import Queue
 from subprocess import Popen, PIPE
 import logging
 from time import time
 from contextlib import contextmanager
+from itertools import count
+from collections import Counter
+from hashlib import sha1
 
 import argparse
 
 import picklemsg
-from checksum import FileItem, repo_file_events
+from compression import DEFAULT_COMPRESSION_LEVEL
+from checksum import (FileItem, repo_file_events, load_ignore_rules,
+                      hash_file, CHUNK_SIZE)
+from manifest import ManifestWriter, iter_manifest
+from merkle import build_tree, find_changes
+from chunking import iter_chunks, FileSlice
+from delta import block_size_for, signatures, iter_delta, apply_delta
+from blobdb import ChecksumWrapper
 from uilib import ColorfulUi, DummyUi, pretty_bytes
 
 UI_UPDATE_TIME = 0.5 # half a second
 
+DEFAULT_HASH_WORKERS = 4
+DEFAULT_WRITERS = 4
+WRITER_BUFFER_SIZE = 32 * 1024 * 1024 # 32 MB
+
+FICLONE = 0x40049409 # Linux ioctl that makes a copy-on-write clone
+
 log = logging.getLogger('magicfolder.client')
 
 def cooldown(interval):
@@ -30,6 +52,40 @@ def cooldown(interval):
         return wrapper
     return decorator
 
+def reflink(src_file, dst_file):
+    """ Make `dst_file` a copy-on-write clone of `src_file`, if the
+    platform and filesystem can; return whether it worked. """
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
+def diff_sorted(old_items, new_items):
+    """
+    Compare two streams of file items, both sorted by path. Yields
+    ``(old, new)`` for each path where they differ; `old` or `new` is
+    None if the path is missing on that side.
+    """
+    old_items = iter(old_items)
+    new_items = iter(new_items)
+    old = next(old_items, None)
+    new = next(new_items, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old.path < new.path):
+            yield old, None
+            old = next(old_items, None)
+        elif old is None or new.path < old.path:
+            yield None, new
+            new = next(new_items, None)
+        else:
+            if old != new:
+                yield old, new
+            old = next(old_items, None)
+            new = next(new_items, None)
+
 def client_init(root_path, remote_url):
     os.mkdir(path.join(root_path, '.mf'))
     with open(path.join(root_path, '.mf', 'remote'), 'wb') as f:
@@ -48,40 +104,498 @@ class WorkingTree(object):
         with open(path.join(self.root_path, '.mf', 'last_sync'), 'wb') as f:
             f.write("%d\n" % new_value)
 
+        mf_path = path.join(self.root_path, '.mf')
+        current = path.basename(self.manifest_path(new_value))
+        for name in os.listdir(mf_path):
+            if name.startswith('manifest-') and name != current:
+                os.unlink(path.join(mf_path, name))
+
+    def manifest_path(self, version):
+        return path.join(self.root_path, '.mf', 'manifest-%d' % version)
+
+    def has_manifest(self):
+        """ Tell whether we have the file list of version `last_sync`,
+        saved by the previous sync. """
+        return path.isfile(self.manifest_path(self.last_sync))
+
+    def iter_manifest(self):
+        """ Iterate over the file items of version `last_sync`, sorted
+        by path. """
+        with open(self.manifest_path(self.last_sync), 'rb') as f:
+            for file_path, checksum, size in iter_manifest(f):
+                yield FileItem(file_path, checksum, size, None)
+
+    def save_manifest(self, version, tree):
+        """ Save the file list of `version`, given as a ``path -> file
+        item`` dict. Call this before `update_last_sync`. """
+        manifest_path = self.manifest_path(version)
+        with open(manifest_path + '.tmp', 'wb') as f:
+            writer = ManifestWriter(f)
+            for file_path in sorted(tree):
+                file_item = tree[file_path]
+                writer.write(file_path, file_item.checksum, file_item.size)
+            writer.close()
+        os.rename(manifest_path + '.tmp', manifest_path)
+
     def _get_remote_url(self):
         with open(path.join(self.root_path, '.mf', 'remote'), 'rb') as f:
             return f.read().strip()
 
-    def iter_files(self, use_cache):
-        return repo_file_events(self.root_path, use_cache)
+    def iter_files(self, use_cache, workers=1):
+        return repo_file_events(self.root_path, use_cache, workers)
 
     def open_read(self, file_item):
         file_path = path.join(self.root_path, file_item.path)
         return open(file_path, 'rb')
 
-    def open_write(self, file_item):
+    @property
+    def partial_folder(self):
+        return path.join(self.root_path, '.mf', 'partial')
+
+    def partial_downloads(self):
+        """ Return ``{checksum: size}`` of the downloads that were cut
+        off, kept in ``.mf/partial``. """
+        if not path.isdir(self.partial_folder):
+            return {}
+        partials = {}
+        for name in os.listdir(self.partial_folder):
+            size = path.getsize(path.join(self.partial_folder, name))
+            if len(name) == 40 and size:
+                partials[name] = size
+        return partials
+
+    def clear_partial_downloads(self):
+        if path.isdir(self.partial_folder):
+            for name in os.listdir(self.partial_folder):
+                os.unlink(path.join(self.partial_folder, name))
+
+    def open_write(self, file_item, offset=0):
+        """
+        Open a `PartialDownload` for `file_item`, keeping the first
+        `offset` bytes that an earlier download left in
+        ``.mf/partial/<checksum>``.
+        """
+        if not path.isdir(self.partial_folder):
+            try:
+                os.mkdir(self.partial_folder)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        partial_path = path.join(self.partial_folder, file_item.checksum)
+        partial_file = open(partial_path, 'ab+')
+        try:
+            fcntl.flock(partial_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            partial_file.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES) or offset:
+                raise
+            # the same contents are being written to another path; this
+            # copy can't be resumed
+            for n in count(1):
+                temp_path = '%s.%d' % (partial_path, n)
+                try:
+                    fd = os.open(temp_path,
+                                 os.O_RDWR | os.O_CREAT | os.O_EXCL, 0666)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                else:
+                    return PartialDownload(self, file_item,
+                                           os.fdopen(fd, 'ab+'), temp_path)
+        assert os.fstat(partial_file.fileno()).st_size >= offset, (
+            "partial download of %r is too short" % file_item.path)
+        partial_file.truncate(offset)
+        return PartialDownload(self, file_item, partial_file, partial_path,
+                               resumable=True)
+
+    @contextmanager
+    def replace_file(self, file_item):
+        """ Write a new version of a file next to the old one, then
+        replace the old one if the content matches `file_item`. """
+        file_path = path.join(self.root_path, file_item.path)
+        fd, temp_path = tempfile.mkstemp(dir=path.dirname(file_path),
+                                         prefix='.mf-tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                with ChecksumWrapper(temp_file) as wrapper:
+                    yield wrapper
+            assert wrapper.final_hash == file_item.checksum, (
+                "checksum mismatch for %r" % file_item.path)
+            if path.isfile(file_path):
+                os.chmod(temp_path, os.stat(file_path).st_mode & 07777)
+            os.rename(temp_path, file_path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+    def copy_to_temp(self, source_path, file_item):
+        """
+        Copy the local file at `source_path` to a temporary file, by
+        reflink where possible, then by reading it. Returns the
+        temporary path, or None if the file is gone or its contents
+        don't match `file_item`. Files are copied, never hard-linked, so
+        that editing one later doesn't change the other.
+        """
+        copies_path = path.join(self.root_path, '.mf', 'copies')
+        if not path.isdir(copies_path):
+            os.mkdir(copies_path)
+        fd, temp_path = tempfile.mkstemp(dir=copies_path)
+        try:
+            with open(path.join(self.root_path, source_path), 'rb') as src:
+                with os.fdopen(fd, 'wb') as temp_file:
+                    if reflink(src, temp_file):
+                        checksum = hash_file(temp_path)[0]
+                    else:
+                        with ChecksumWrapper(temp_file) as wrapper:
+                            while True:
+                                data = src.read(CHUNK_SIZE)
+                                if not data:
+                                    break
+                                wrapper.write(data)
+                        checksum = wrapper.final_hash
+        except (IOError, OSError):
+            log.debug("Can't copy %r", source_path, exc_info=True)
+            checksum = None
+        if checksum != file_item.checksum:
+            os.unlink(temp_path)
+            return None
+        return temp_path
+
+    def move_into_place(self, temp_path, file_item):
+        """ Move a file made by `copy_to_temp`, or a finished download, to
+        its path. """
         file_path = path.join(self.root_path, file_item.path)
         folder_path = path.dirname(file_path)
-        if not path.isdir(folder_path):
-            os.makedirs(folder_path)
-        return open(file_path, 'wb')
+        while True:
+            # another thread may create the folder, or remove it as it
+            # becomes empty, at the same time
+            if not path.isdir(folder_path):
+                try:
+                    os.makedirs(folder_path)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            try:
+                os.rename(temp_path, file_path)
+                return
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
 
     def remove_file(self, file_item):
         os.unlink(path.join(self.root_path, file_item.path))
         folder = path.dirname(file_item.path)
 
         while folder:
-            folder_abs = path.join(self.root_path, folder)
-            if os.listdir(folder_abs):
-                break
-            os.rmdir(folder_abs)
+            try:
+                os.rmdir(path.join(self.root_path, folder))
+            except OSError, e:
+                # not empty, or removed by another thread
+                if e.errno in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                    break
+                raise
             folder = path.dirname(folder)
 
+class PartialDownload(object):
+    """
+    File object that downloads `file_item` to `partial_path`, after any
+    bytes already there. `close` checks the checksum and moves the file
+    to its path; `abort` keeps what was written, for a later sync to
+    resume from, if the download is `resumable`.
+    """
+
+    def __init__(self, wt, file_item, partial_file, partial_path,
+                 resumable=False):
+        self.wt = wt
+        self.file_item = file_item
+        self.partial_file = partial_file
+        self.partial_path = partial_path
+        self.resumable = resumable
+        self.sha1_hash = sha1()
+        partial_file.seek(0)
+        while True:
+            data = partial_file.read(CHUNK_SIZE)
+            if not data:
+                break
+            self.sha1_hash.update(data)
+        partial_file.seek(0, 2)
+
+    def write(self, data):
+        self.partial_file.write(data)
+        self.sha1_hash.update(data)
+
+    def close(self):
+        self.partial_file.close()
+        if self.sha1_hash.hexdigest() != self.file_item.checksum:
+            os.unlink(self.partial_path)
+            assert False, "checksum mismatch for %r" % self.file_item.path
+        file_path = path.join(self.wt.root_path, self.file_item.path)
+        if path.isfile(file_path):
+            os.chmod(self.partial_path, os.stat(file_path).st_mode & 07777)
+        self.wt.move_into_place(self.partial_path, self.file_item)
+
+    def abort(self):
+        self.partial_file.close()
+        if not self.resumable:
+            os.unlink(self.partial_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class _PooledFile(object):
+    """ File object returned by `WriterPool.open_write`. """
+
+    def __init__(self, pool, file_item, offset):
+        self.pool = pool
+        self.file_item = file_item
+        self.offset = offset
+
+    def write(self, data):
+        self.pool._put(self.file_item, ('data', data), len(data))
+
+    def close(self):
+        self.pool._put(self.file_item, ('close', None))
+
+    def __enter__(self):
+        self.pool._put(self.file_item, ('open', (self.file_item,
+                                                 self.offset)))
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool._put(self.file_item, ('abort', None))
+
+class WriterPool(object):
+    """
+    Writes downloaded files to the working tree from `n_workers`
+    threads, so the receive loop doesn't wait for the disk. All
+    operations on a path go to the same worker, in order; removals of
+    other paths, such as a file where a new folder goes, must be waited
+    for (see `wait`) before writing. At most `WRITER_BUFFER_SIZE` bytes
+    of file data wait in the queues.
+    """
+
+    def __init__(self, wt, n_workers):
+        self.wt = wt
+        self.queues = [Queue() for n in range(n_workers)]
+        self.buffered = 0
+        self.buffer_cond = threading.Condition()
+        self.errors = []
+        self.threads = [threading.Thread(target=self._worker, args=(q,))
+                        for q in self.queues]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def _worker(self, queue):
+        local_file = None
+        while True:
+            op, size = queue.get()
+            try:
+                if op is None:
+                    break
+                if self.errors:
+                    continue # drain the queue
+                kind, value = op
+                if kind == 'open':
+                    local_file = self.wt.open_write(*value)
+                elif kind == 'data':
+                    local_file.write(value)
+                elif kind == 'close':
+                    local_file.close()
+                    local_file = None
+                elif kind == 'abort':
+                    local_file.abort()
+                    local_file = None
+                elif kind == 'remove':
+                    self.wt.remove_file(value)
+            except:
+                self.errors.append(sys.exc_info())
+            finally:
+                if size:
+                    with self.buffer_cond:
+                        self.buffered -= size
+                        self.buffer_cond.notify_all()
+                queue.task_done()
+
+    def _raise_error(self):
+        if self.errors:
+            error = self.errors[0]
+            raise error[0], error[1], error[2]
+
+    def _put(self, file_item, op, size=0):
+        self._raise_error()
+        with self.buffer_cond:
+            while self.buffered and self.buffered + size > WRITER_BUFFER_SIZE:
+                self.buffer_cond.wait()
+            self.buffered += size
+        queue = self.queues[hash(file_item.path) % len(self.queues)]
+        queue.put((op, size))
+
+    def open_write(self, file_item, offset=0):
+        return _PooledFile(self, file_item, offset)
+
+    def remove_file(self, file_item):
+        self._put(file_item, ('remove', file_item))
+
+    def wait(self):
+        """ Wait until all queued operations are done. """
+        for queue in self.queues:
+            queue.join()
+        self._raise_error()
+
+    def close(self):
+        for queue in self.queues:
+            queue.put((None, 0))
+        for t in self.threads:
+            t.join()
+        self._raise_error()
+
+    def abort(self):
+        """ Finish the queued operations, after an error in the sync, so
+        that partial downloads are kept. Errors are only logged. """
+        try:
+            self.close()
+        except:
+            log.exception("Error while writing files")
+
+def configure_remote(remote, accepted):
+    """ Set up `remote` for the capabilities the server `accepted`. """
+    remote.batching = 'batching' in accepted
+    if 'compression' in accepted:
+        remote.set_compression(accepted['compression'])
+    if 'framing' in accepted:
+        remote.set_framing(accepted['framing'])
+
+class ChannelPool(object):
+    """
+    Blob channels: extra connections to the server (``mf-server
+    --blobs``) that move blobs in parallel with each other. Each transfer
+    is split between the channels, balanced by size, and each channel
+    runs in its own thread.
+    """
+
+    def __init__(self, remotes, capabilities):
+        self.remotes = remotes
+        offered = dict((k, v) for k, v in capabilities.iteritems()
+                       if k in ('compression', 'framing'))
+        for remote in remotes:
+            if offered:
+                remote.send('capabilities', offered)
+                msg, payload = remote.recv()
+                assert msg == 'capabilities'
+                configure_remote(remote, payload)
+
+    def _partition(self, file_items):
+        """ Split `file_items` in a list for each channel; the biggest
+        go first, each to the channel with the fewest bytes so far. """
+        shares = [[] for remote in self.remotes]
+        loads = [0] * len(self.remotes)
+        for i in sorted(file_items, key=lambda i: -i.size):
+            n = loads.index(min(loads))
+            shares[n].append(i)
+            loads[n] += i.size
+        return shares, loads
+
+    def _run(self, transfer, file_items, print_line, label):
+        """ Call ``transfer(remote, share, progress)`` for each channel,
+        in parallel, showing each channel's progress. Returns the number
+        of bytes moved. """
+        shares, loads = self._partition(file_items)
+        done = [0] * len(self.remotes)
+        errors = []
+        def worker(n):
+            def progress(n_bytes):
+                done[n] += n_bytes
+            try:
+                transfer(self.remotes[n], shares[n], progress)
+            except:
+                errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(len(self.remotes))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            while t.is_alive():
+                print_line("%s via %d streams: %s" % (
+                    label, len(threads),
+                    ' '.join('%3d%%' % (100 * d / l if l else 100)
+                             for d, l in zip(done, loads))))
+                t.join(UI_UPDATE_TIME)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return sum(done)
+
+    def upload(self, wt, file_items, print_line):
+        def transfer(remote, share, progress):
+            for file_item in share:
+                log.debug("uploading file %s, path %r over a channel",
+                          file_item.checksum, file_item.path)
+                remote.send('blob_put', file_item.checksum)
+                with wt.open_read(file_item) as data_file:
+                    remote.send_file(data_file, progress)
+            remote.send('blob_flush')
+            msg, payload = remote.recv()
+            assert msg == 'blob_flushed'
+        return self._run(transfer, file_items, print_line, "Uploading")
+
+    def download(self, wt, file_items, print_line, offsets=None):
+        """ Download `file_items`; `offsets` maps checksums to the bytes
+        of a partial download to keep. """
+        offsets = offsets or {}
+        for file_item in file_items:
+            # create folders here, the threads would race to do it
+            folder_path = path.dirname(path.join(wt.root_path,
+                                                 file_item.path))
+            if not path.isdir(folder_path):
+                os.makedirs(folder_path)
+
+        def transfer(remote, share, progress):
+            wanted = []
+            for i in share:
+                if offsets.get(i.checksum):
+                    wanted.append((i.checksum, i.size, offsets[i.checksum]))
+                else:
+                    wanted.append((i.checksum, i.size))
+            remote.send('blob_get_many', wanted)
+            for file_item in share:
+                log.debug("Receiving file %r %r over a channel",
+                          file_item.path, file_item.checksum)
+                offset = offsets.get(file_item.checksum, 0)
+                with wt.open_write(file_item, offset) as local_file:
+                    remote.recv_file(local_file, progress)
+        return self._run(transfer, file_items, print_line, "Downloading")
+
+    def compression_stats(self):
+        stats = [remote.compression_stats() for remote in self.remotes]
+        return (sum(raw for raw, wire in stats),
+                sum(wire for raw, wire in stats))
+
+    def close(self):
+        for remote in self.remotes:
+            remote.send('quit')
+            assert remote.recv()[0] == 'bye'
+
 class SyncClient(object):
-    def __init__(self, working_tree, remote, ui=DummyUi()):
+    def __init__(self, working_tree, remote, ui=DummyUi(), capabilities=None,
+                 open_channel=None):
         self.wt = working_tree
         self.remote = remote
         self.ui = ui
+        self.capabilities = dict(capabilities or {})
+        # callable that opens a blob channel, for the 'channels' capability
+        self.open_channel = open_channel
+        self.channels = None
+        self.partials = {} # checksum -> size of partial downloads
 
     def update_last_sync(self, new_value):
         self.wt.update_last_sync(new_value)
@@ -91,32 +605,141 @@ class SyncClient(object):
         log.debug("Connecting to server %r", remote_url)
         yield pipe_to_remote(remote_url)
 
-    def send_local_status(self, use_cache):
+    def negotiate(self):
+        """ Offer optional protocol features to the server; it replies
+        with the ones it accepts. """
+        if not self.capabilities:
+            return
+        self.remote.send('capabilities', self.capabilities)
+        msg, payload = self.remote.recv()
+        assert msg == 'capabilities'
+        log.debug("Server accepted capabilities %r", payload)
+        self.capabilities = payload
+        configure_remote(self.remote, payload)
+        if 'channels' in payload:
+            remotes = [self.open_channel()
+                       for c in range(payload['channels'])]
+            self.channels = ChannelPool(remotes, payload)
+
+    def send_chunks(self, file_item, progress):
+        """ Send the chunk list of a file, then the chunks the server
+        doesn't have. """
+        with self.wt.open_read(file_item) as data_file:
+            chunks = list(iter_chunks(data_file))
+        self.remote.send('file_chunks', [(chunk_checksum, size)
+                                         for offset, size, chunk_checksum
+                                         in chunks])
+
+        msg, wanted = self.remote.recv()
+        assert msg == 'want_chunks'
+        log.debug("uploading %d of %d chunks", len(wanted), len(chunks))
+        chunk_map = dict((chunk_checksum, (offset, size))
+                         for offset, size, chunk_checksum in chunks)
+        with self.wt.open_read(file_item) as data_file:
+            for chunk_checksum in wanted:
+                offset, size = chunk_map[chunk_checksum]
+                chunk_file = FileSlice(data_file, offset, size)
+                self.remote.send_file(chunk_file, progress)
+
+    def send_delta(self, file_item, sig, progress):
+        """ Upload a file as a delta against the server's signatures. """
+        with self.wt.open_read(file_item) as data_file:
+            ops = iter_delta(data_file, sig['block_size'], sig['blocks'])
+            self.remote.send_delta(ops, progress)
+
+    def receive_delta(self, file_item, progress):
+        """ Update a local file by sending signatures of its current
+        contents and applying the delta that comes back. """
+        with self.wt.open_read(file_item) as base_file:
+            block_size = block_size_for(os.fstat(base_file.fileno()).st_size)
+            blocks = signatures(base_file, block_size)
+            self.remote.send('delta_signatures', {'block_size': block_size,
+                                                  'blocks': blocks})
+            with self.wt.replace_file(file_item) as local_file:
+                apply_delta(base_file, block_size, self.remote.recv_delta(),
+                            local_file, progress)
+
+    def fetch_merkle_nodes(self, folders):
+        self.remote.send('merkle_get', folders)
+        msg, payload = self.remote.recv()
+        assert msg == 'merkle_nodes'
+        return payload
+
+    def send_local_status(self, use_cache, workers=1):
+        """
+        Send the list of local files. With the 'status_delta' or
+        'merkle' capability, only send the differences from version
+        `last_sync`: 'file_meta' for new and changed files,
+        'file_removed' for the paths of removed files. For 'merkle' the
+        differences are found by comparing Merkle trees with the server.
+        """
         log.debug("Sync session, last_sync %r", self.wt.last_sync)
 
         @cooldown(UI_UPDATE_TIME)
         def update_files_ui(n):
             print_line("Reading local files... %d" % n)
 
-        with self.ui.status_line() as print_line:
-            file_item_map = {}
-            n = 0
-            print_line("Reading local files...")
+        file_item_map = {}
+        self.local_tree = {}
+        counter = {'files': 0, 'sent': 0}
 
-            for i in self.wt.iter_files(use_cache):
+        def local_items():
+            for i in self.wt.iter_files(use_cache, workers):
                 i_for_server = FileItem(i.path, i.checksum, i.size, None)
-                self.remote.send('file_meta', i_for_server)
                 file_item_map[i.checksum] = i
+                self.local_tree[i.path] = i_for_server
+                counter['files'] += 1
+                update_files_ui(counter['files'])
+                yield i_for_server
+
+        with self.ui.status_line() as print_line:
+            print_line("Reading local files...")
+
+            if 'status_delta' in self.capabilities:
+                changes = diff_sorted(self.wt.iter_manifest(), local_items())
+                for old, new in changes:
+                    if new is None:
+                        self.remote.send_batched('file_removed', old.path)
+                    else:
+                        self.remote.send_batched('file_meta', new)
+                    counter['sent'] += 1
 
-                n += 1
-                update_files_ui(n)
-        self.ui.out("Reading local files... %d done\n" % n)
+            elif 'merkle' in self.capabilities:
+                local_merkle = build_tree(local_items())
+                for file_path, kind in find_changes(local_merkle,
+                                                    self.fetch_merkle_nodes):
+                    if kind == 'removed':
+                        self.remote.send_batched('file_removed', file_path)
+                    else:
+                        self.remote.send_batched('file_meta',
+                                                 self.local_tree[file_path])
+                    counter['sent'] += 1
 
-        log.debug("Finished sending index to server")
+            else:
+                for i_for_server in local_items():
+                    self.remote.send_batched('file_meta', i_for_server)
+                    counter['sent'] += 1
+
+        self.ui.out("Reading local files... %d done\n" % counter['files'])
+
+        log.debug("Finished sending index to server, %d entries",
+                  counter['sent'])
+        if 'resume' in self.capabilities:
+            self.partials = self.wt.partial_downloads()
+            if self.partials:
+                self.remote.send('partial_downloads', self.partials)
         self.remote.send('done')
         return file_item_map
 
-    def receive_remote_update(self, file_item_map):
+    def receive_remote_update(self, file_item_map, writers=DEFAULT_WRITERS):
+        writer_pool = WriterPool(self.wt, writers)
+        try:
+            self._receive_remote_update(file_item_map, writer_pool)
+        except:
+            writer_pool.abort()
+            raise
+
+    def _receive_remote_update(self, file_item_map, writer_pool):
         # TODO the local variables should be instance variables, and
         # this function needs to be split into many smaller ones.
         bytes_count = {'up': 0, 'down': 0}
@@ -126,6 +749,14 @@ class SyncClient(object):
                     % (pretty_bytes(bytes_count['up']),
                        pretty_bytes(bytes_count['down'])))
 
+        written = set() # paths written in this session
+        # removals are queued on the writers; they must be done before
+        # anything is written, in case a file replaces a folder or the
+        # other way around
+        removals_pending = False
+        copies = [] # (temp_path, file_item) to move into place at the end
+        copies_later = [] # copies of files written in this session
+        failed_copies = []
         with self.ui.status_line() as print_line:
             print_line(bytes_msg())
 
@@ -144,6 +775,18 @@ class SyncClient(object):
             while True:
                 msg, payload = self.remote.recv()
                 if msg == 'sync_complete':
+                    writer_pool.close()
+                    self.wt.clear_partial_downloads() # stale ones
+                    for source_path, file_item in copies_later:
+                        temp_path = self.wt.copy_to_temp(source_path,
+                                                         file_item)
+                        assert temp_path is not None, (
+                            "failed to copy %r" % source_path)
+                        copies.append((temp_path, file_item))
+                    for temp_path, file_item in copies:
+                        self.wt.move_into_place(temp_path, file_item)
+                        files_new.add(file_item)
+                        self.local_tree[file_item.path] = file_item
                     break
 
                 elif msg == 'data':
@@ -153,26 +796,142 @@ class SyncClient(object):
                     with self.wt.open_read(file_item) as data_file:
                         self.remote.send_file(data_file, progress_up)
 
-                elif msg == 'file_begin':
+                elif msg == 'data_from':
+                    checksum, offset = payload
+                    file_item = file_item_map[checksum]
+                    log.debug("resuming upload of file %s, path %r, at "
+                              "byte %d", checksum, file_item.path, offset)
+                    with self.wt.open_read(file_item) as data_file:
+                        data_file.seek(offset)
+                        self.remote.send_file(data_file, progress_up)
+
+                elif msg == 'checkpoint':
+                    # the server committed the files uploaded so far;
+                    # the others are at their old versions in it
+                    version, pending = payload
+                    tree = dict(self.local_tree)
+                    for file_path, old_item in pending.iteritems():
+                        if old_item is None:
+                            del tree[file_path]
+                        else:
+                            tree[file_path] = old_item
+                    log.debug("Checkpoint at version %d", version)
+                    self.wt.save_manifest(version, tree)
+                    self.update_last_sync(version)
+
+                elif msg == 'data_many':
+                    for checksum in payload:
+                        file_item = file_item_map[checksum]
+                        log.debug("uploading file %s, path %r",
+                                  file_item.checksum, file_item.path)
+                        with self.wt.open_read(file_item) as data_file:
+                            self.remote.send_file(data_file, progress_up)
+
+                elif msg == 'data_via_channels':
+                    file_items = [file_item_map[c] for c in payload]
+                    bytes_count['up'] += self.channels.upload(
+                        self.wt, file_items, print_line)
+                    self.remote.send('data_via_channels_done')
+
+                elif msg == 'data_chunks':
+                    file_item = file_item_map[payload]
+                    log.debug("uploading chunks of file %s, path %r",
+                              file_item.checksum, file_item.path)
+                    self.send_chunks(file_item, progress_up)
+
+                elif msg == 'data_delta':
+                    checksum, sig = payload
+                    file_item = file_item_map[checksum]
+                    log.debug("uploading delta of file %s, path %r",
+                              file_item.checksum, file_item.path)
+                    self.send_delta(file_item, sig, progress_up)
+
+                elif msg in ('file_begin', 'file_begin_at'):
+                    if msg == 'file_begin':
+                        file_item, offset = payload, 0
+                    else:
+                        file_item, offset = payload
+                    log.debug("Receiving file %r %r from byte %d",
+                              file_item.path, file_item.checksum, offset)
+                    if removals_pending:
+                        writer_pool.wait()
+                        removals_pending = False
+                    with writer_pool.open_write(file_item,
+                                                offset) as local_file:
+                        self.remote.recv_file(local_file, progress_down)
+                    written.add(file_item.path)
+                    files_new.add(file_item)
+                    self.local_tree[file_item.path] = file_item
+
+                elif msg == 'files_via_channels':
+                    writer_pool.wait() # removals must happen first
+                    removals_pending = False
+                    counts = Counter(i.checksum for i in payload)
+                    offsets = dict((c, n) for c, n in self.partials.items()
+                                   if counts[c] == 1)
+                    bytes_count['down'] += self.channels.download(
+                        self.wt, payload, print_line, offsets)
+                    for file_item in payload:
+                        written.add(file_item.path)
+                        files_new.add(file_item)
+                        self.local_tree[file_item.path] = file_item
+
+                elif msg == 'file_copy':
+                    # copies are made right away, before the source can be
+                    # removed, and moved into place at the end, after the
+                    # removals and writes they may replace
+                    source_path, file_item = payload
+                    log.debug("Copying %r to %r", source_path, file_item.path)
+                    if source_path in written:
+                        copies_later.append(payload)
+                        continue
+                    temp_path = self.wt.copy_to_temp(source_path, file_item)
+                    if temp_path is None:
+                        failed_copies.append(file_item.path)
+                    else:
+                        copies.append((temp_path, file_item))
+
+                elif msg == 'file_copy_done':
+                    self.remote.send('file_copy_failed', failed_copies)
+                    failed_copies = []
+
+                elif msg == 'file_delta_begin':
                     file_item = payload
-                    log.debug("Receiving file %r %r",
+                    log.debug("Receiving delta for file %r %r",
                               file_item.path, file_item.checksum)
-                    with self.wt.open_write(file_item) as local_file:
-                        self.remote.recv_file(local_file, progress_down)
+                    if removals_pending:
+                        writer_pool.wait()
+                        removals_pending = False
+                    self.receive_delta(file_item, progress_down)
+                    written.add(file_item.path)
                     files_new.add(payload)
+                    self.local_tree[file_item.path] = file_item
 
                 elif msg == 'file_remove':
                     file_item = payload
                     log.debug("Removing file %r", file_item.path)
-                    self.wt.remove_file(file_item)
+                    writer_pool.remove_file(file_item)
+                    removals_pending = True
                     files_del.add(payload)
+                    del self.local_tree[file_item.path]
 
                 else:
                     assert False, 'unexpected message %r' % msg
 
         self.ui.out(bytes_msg() + "\n")
+        raw_bytes, wire_bytes = self.remote.compression_stats()
+        if self.channels is not None:
+            channel_raw, channel_wire = self.channels.compression_stats()
+            raw_bytes += channel_raw
+            wire_bytes += channel_wire
+        if raw_bytes:
+            self.ui.out("Compressed %s to %s (%.1f%%)\n" % (
+                pretty_bytes(raw_bytes), pretty_bytes(wire_bytes),
+                100. * wire_bytes / raw_bytes))
 
         assert payload >= self.wt.last_sync
+        if payload != self.wt.last_sync or not self.wt.has_manifest():
+            self.wt.save_manifest(payload, self.local_tree)
         self.update_last_sync(payload)
         log.debug("Sync complete, now at version %d", payload)
 
@@ -195,21 +954,31 @@ class SyncClient(object):
         print_files_colored(files_new, 'green', size=True)
         self.ui.out("At version %d\n" % payload)
 
-    def sync_with_remote(self, use_cache=False):
+    def sync_with_remote(self, use_cache=False, workers=1,
+                         writers=DEFAULT_WRITERS):
+        if self.wt.has_manifest():
+            # the saved manifest is cheaper than asking for Merkle nodes
+            self.capabilities['status_delta'] = True
+            self.capabilities.pop('merkle', None)
+        self.negotiate()
         self.remote.send('sync', self.wt.last_sync)
         msg, payload = self.remote.recv()
         assert msg == 'waiting_for_files'
 
-        file_item_map = self.send_local_status(use_cache)
+        file_item_map = self.send_local_status(use_cache, workers)
 
-        self.receive_remote_update(file_item_map)
+        self.receive_remote_update(file_item_map, writers)
 
         self.remote.send('quit')
         assert self.remote.recv()[0] == 'bye'
+        if self.channels is not None:
+            self.channels.close()
 
-def pipe_to_remote(remote_spec):
+def pipe_to_remote(remote_spec, blob_channel=False):
     hostname, remote_path = remote_spec.split(':')
     child_args = ['ssh', hostname, 'mf-server', remote_path]
+    if blob_channel:
+        child_args[3:3] = ['--blobs']
     log.debug("running %r", child_args)
     p = Popen(child_args, bufsize=4096, stdin=PIPE, stdout=PIPE, stderr=PIPE)
     return picklemsg.Remote(p.stdout, p.stdin)
@@ -231,6 +1000,49 @@ def parse_args():
     sync_parser.add_argument("-p", "--paranoid",
         action="store_false", dest="use_cache", default=True,
         help="don't trust timestamp and size, always calculate checksum")
+    sync_parser.add_argument("-j", "--jobs",
+        type=int, dest="workers", default=DEFAULT_HASH_WORKERS,
+        help="number of files to checksum in parallel")
+    sync_parser.add_argument("--writers",
+        type=int, dest="writers", default=DEFAULT_WRITERS,
+        help="number of threads writing downloaded files")
+    sync_parser.add_argument("--delta",
+        action="store_true", dest="delta", default=False,
+        help="transfer changed files as deltas against their "
+             "previous version")
+    sync_parser.add_argument("--chunked",
+        action="store_true", dest="chunked", default=False,
+        help="upload large files in content-defined chunks, "
+             "sending only the chunks the server doesn't have")
+
+    sync_parser.add_argument("--merkle",
+        action="store_true", dest="merkle", default=False,
+        help="if the local file list from the last sync is missing, "
+             "find changes by comparing folder hashes with the server")
+
+    sync_parser.add_argument("-z", "--compress",
+        nargs='?', const='zlib', default=None, metavar="CODEC[:LEVEL]",
+        help="compress file transfers, with zlib (the default) or bz2")
+
+    sync_parser.add_argument("--checkpoint-size",
+        type=float, dest="checkpoint_size", default=None, metavar="GB",
+        help="during large uploads, commit the files uploaded so far "
+             "every GB gigabytes")
+    sync_parser.add_argument("--checkpoint-time",
+        type=float, dest="checkpoint_time", default=None, metavar="MINUTES",
+        help="during large uploads, commit the files uploaded so far "
+             "every MINUTES minutes")
+
+    sync_parser.add_argument("-n", "--streams",
+        type=int, dest="streams", default=0,
+        help="open this many extra connections to transfer files in "
+             "parallel")
+
+    watch_parser = subparsers.add_parser('watch',
+        help="journal local changes so that sync doesn't rescan the tree")
+    watch_parser.add_argument("-d", "--detach",
+        action="store_true", dest="detach", default=False,
+        help="run in the background")
 
     args = parser.parse_args()
     return args
@@ -254,10 +1066,46 @@ def main():
             wt = WorkingTree(root_path)
             remote = pipe_to_remote(wt._get_remote_url())
             ui = ColorfulUi()
-            session = SyncClient(wt, remote, ui)
-            session.sync_with_remote(use_cache=args.use_cache)
+            capabilities = {'batching': True, 'pipelining': True,
+                            'framing': picklemsg.FRAME_VERSION,
+                            'local_copy': True, 'resume': True}
+            if args.chunked:
+                capabilities['chunking'] = True
+            if args.delta:
+                capabilities['delta'] = True
+            if args.merkle:
+                capabilities['merkle'] = True
+            if args.compress:
+                codec, _, level = args.compress.partition(':')
+                capabilities['compression'] = {
+                    'codec': codec,
+                    'level': int(level or DEFAULT_COMPRESSION_LEVEL),
+                }
+            if args.streams:
+                capabilities['channels'] = args.streams
+            checkpoint = {}
+            if args.checkpoint_size:
+                checkpoint['bytes'] = int(args.checkpoint_size * 1024 ** 3)
+            if args.checkpoint_time:
+                checkpoint['seconds'] = args.checkpoint_time * 60
+            if checkpoint:
+                capabilities['checkpoint'] = checkpoint
+            open_channel = lambda: pipe_to_remote(wt._get_remote_url(),
+                                                  blob_channel=True)
+            session = SyncClient(wt, remote, ui, capabilities, open_channel)
+            session.sync_with_remote(use_cache=args.use_cache,
+                                     workers=args.workers,
+                                     writers=args.writers)
         except:
             log.exception("Exception while performing sync")
             raise
+    elif args.subcmd == 'watch':
+        from journal import InotifyWatcher, detach
+        logging.basicConfig(level=logging.INFO,
+                            filename=path.join(root_path, '.mf', 'watch.log'))
+        watcher = InotifyWatcher(root_path, load_ignore_rules(root_path))
+        if args.detach:
+            detach()
+        watcher.run()
     else:
         raise ValueError('bad param')
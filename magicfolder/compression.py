@@ -0,0 +1,65 @@
+"""
+Compression codecs, shared by the wire protocol (see
+`picklemsg.Remote.set_compression`) and blobs stored compressed in a
+`blobdb.BlobDB`. Settings are dicts like ``{'codec': 'zlib', 'level': 6}``.
+"""
+
+import zlib
+import bz2
+
+DEFAULT_COMPRESSION_LEVEL = 6
+
+class _ZlibCompressor(object):
+    """ zlib stream. With `sync_flush`, it's flushed after each chunk, so
+    the receiver can write each chunk as soon as it arrives. """
+
+    def __init__(self, level, sync_flush=True):
+        self.compressobj = zlib.compressobj(level)
+        self.sync_flush = sync_flush
+
+    def compress(self, data):
+        data = self.compressobj.compress(data)
+        if self.sync_flush:
+            data += self.compressobj.flush(zlib.Z_SYNC_FLUSH)
+        return data
+
+    def flush(self):
+        return self.compressobj.flush()
+
+class _Bz2Compressor(object):
+    def __init__(self, level, sync_flush=True):
+        # bz2 can't flush mid-stream; data comes out a block (100 to
+        # 900 KB of input) at a time
+        self.compressobj = bz2.BZ2Compressor(level)
+        self.sync_flush = False
+
+    def compress(self, data):
+        return self.compressobj.compress(data)
+
+    def flush(self):
+        return self.compressobj.flush()
+
+COMPRESSION_CODECS = {
+    # name: (compressor, decompressor, valid levels)
+    'zlib': (_ZlibCompressor, zlib.decompressobj, range(0, 10)),
+    'bz2': (_Bz2Compressor, bz2.BZ2Decompressor, range(1, 10)),
+}
+
+def valid_compression(settings):
+    """ Check compression `settings`, e.g. the payload of a
+    'compression' capability. """
+    if not isinstance(settings, dict):
+        return False
+    codec = COMPRESSION_CODECS.get(settings.get('codec'))
+    level = settings.get('level', DEFAULT_COMPRESSION_LEVEL)
+    return codec is not None and level in codec[2]
+
+def compressor(settings, sync_flush=True):
+    """ Return a new compressor object for `settings`. """
+    compressor_class = COMPRESSION_CODECS[settings['codec']][0]
+    level = settings.get('level', DEFAULT_COMPRESSION_LEVEL)
+    return compressor_class(level, sync_flush)
+
+def decompressor(codec):
+    """ Return a new decompressor object for `codec`. """
+    return COMPRESSION_CODECS[codec][1]()
@@ -0,0 +1,119 @@
+"""
+Long-lived server for an archive. It keeps one `Archive` open, so the
+latest versions, their Merkle trees and the object index stay in
+memory between syncs, and serves sessions over the Unix socket
+``ROOT/daemon.sock``. While it runs, ``mf-server`` only relays its
+stdin and stdout to the socket.
+
+Each connection starts with a line naming the service, ``sync`` or
+``blobs``, followed by the usual messages.
+"""
+
+import os
+from os import path
+import socket
+import errno
+import threading
+import logging
+
+import picklemsg
+from server import Archive, server_sync, serve_blobs, try_except_send_remote
+
+SOCKET_NAME = 'daemon.sock'
+RELAY_BUFFER = 64 * 1024
+
+log = logging.getLogger('magicfolder.daemon')
+
+def socket_path(root_path):
+    return path.join(root_path, SOCKET_NAME)
+
+class Daemon(object):
+    def __init__(self, root_path):
+        self.root_path = root_path
+        self.archive = Archive(root_path)
+        self.archive.contains_many([]) # load the object index now
+        self.archive.read_version(self.archive.get_latest_version())
+        self.listener = None
+
+    def listen(self):
+        sock_path = socket_path(self.root_path)
+        if path.exists(sock_path):
+            if connect(self.root_path) is not None:
+                raise RuntimeError("a daemon is already running")
+            os.unlink(sock_path) # left behind by a daemon that died
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(sock_path)
+        self.listener.listen(16)
+
+    def serve_forever(self):
+        if self.listener is None:
+            self.listen()
+        log.info("Serving %s", self.root_path)
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                break # closed by `shutdown`
+            t = threading.Thread(target=self.handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def shutdown(self):
+        os.unlink(socket_path(self.root_path))
+        self.listener.shutdown(socket.SHUT_RDWR)
+        self.listener.close()
+
+    def handle(self, conn):
+        in_file = conn.makefile('rb')
+        out_file = conn.makefile('wb')
+        try:
+            service = in_file.readline().strip()
+            remote = picklemsg.Remote(in_file, out_file)
+            with try_except_send_remote(remote):
+                if service == 'sync':
+                    server_sync(self.archive, remote)
+                else:
+                    assert service == 'blobs', "bad service %r" % service
+                    serve_blobs(self.archive, remote)
+                remote.flush()
+            out_file.flush()
+        finally:
+            in_file.close()
+            out_file.close()
+            conn.close()
+
+def connect(root_path):
+    """ Connect to the daemon of an archive; None if it's not running. """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path(root_path))
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def relay(sock, service, in_fd, out_fd):
+    """ Ask the daemon for `service`, then copy bytes between the file
+    descriptors and the daemon until it closes the connection. """
+    sock.sendall(service + '\n')
+
+    def forward_input():
+        while True:
+            data = os.read(in_fd, RELAY_BUFFER)
+            if not data:
+                break
+            sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+
+    t = threading.Thread(target=forward_input)
+    t.daemon = True # it may block on input after the daemon is done
+    t.start()
+    while True:
+        data = sock.recv(RELAY_BUFFER)
+        if not data:
+            break
+        while data:
+            data = data[os.write(out_fd, data):]
+    sock.close()
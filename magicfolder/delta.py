@@ -0,0 +1,178 @@
+"""
+rsync-style delta encoding. The receiver, which has a "base" version of
+a file, sends `signatures` of its blocks; the sender scans the new
+version with a rolling checksum and describes it as copies of base
+blocks and literal data (`iter_delta`); the receiver rebuilds the new
+version with `apply_delta`.
+
+Scanning is the expensive part: where the new version doesn't match the
+base, the window rolls one byte at a time in Python, which runs at
+under 1 MB/s - slower than most links the literal data would go over.
+So if more than `DELTA_MAX_LITERAL_RATIO` of the first `DELTA_PROBE`
+bytes (or more) had no match, `iter_delta` stops scanning and sends the
+rest of the file as literal data.
+"""
+
+from hashlib import md5
+from zlib import adler32
+
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+
+DELTA_FILE_SIZE = 64 * 1024 # smaller files are sent whole
+
+READ_SIZE = 4 * 1024 * 1024
+LITERAL_SIZE = 64 * 1024 # largest literal op
+DELTA_PROBE = 1024 * 1024
+DELTA_MAX_LITERAL_RATIO = .9
+
+ADLER_MOD = 65521
+
+def block_size_for(file_size):
+    """ About the square root of the file size, like rsync does. """
+    block_size = int(file_size ** .5) // 1024 * 1024
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+def weak_checksum(data):
+    return adler32(data) & 0xffffffff
+
+def strong_checksum(data):
+    return md5(data).digest()
+
+def signatures(f, block_size):
+    """ Return ``(weak, strong)`` checksums for each block of `f`. """
+    blocks = []
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        blocks.append((weak_checksum(data), strong_checksum(data)))
+    return blocks
+
+def iter_delta(f, block_size, blocks):
+    """
+    Describe the contents of `f` in terms of a base file, given the
+    `signatures` of the base. Yields ``('copy', index, count)`` for a run
+    of `count` base blocks starting at `index`, and ``('literal', data)``.
+    Gives up on finding matches once the data scanned so far is mostly
+    literal (see the module docstring).
+    """
+    index = {}
+    for i, (weak, strong) in enumerate(blocks):
+        index.setdefault(weak, {}).setdefault(strong, i)
+
+    buf = bytearray()
+    pos = 0 # start of the current window in buf
+    lit_start = 0 # start of data not yet sent, in buf
+    eof = False
+    weak = None
+    copy_run = None
+    done = 0 # bytes already dropped from buf
+    literal_size = 0 # bytes sent as literal data by the rolling scan
+    give_up = False
+
+    while True:
+        if len(buf) - pos <= block_size and not eof:
+            # keep at least one byte past the window, for rolling
+            if pos > lit_start:
+                if copy_run is not None:
+                    yield ('copy',) + copy_run
+                    copy_run = None
+                yield ('literal', str(buf[lit_start:pos]))
+            del buf[:pos]
+            done += pos
+            pos = lit_start = 0
+            data = f.read(READ_SIZE)
+            if data:
+                buf.extend(data)
+            else:
+                eof = True
+            weak = None
+            continue
+
+        n = min(block_size, len(buf) - pos)
+        if n == 0:
+            break
+
+        if weak is None:
+            weak = weak_checksum(buffer(buf, pos, n))
+            a, b = weak & 0xffff, weak >> 16
+
+        candidates = index.get(weak)
+        if candidates is not None:
+            i = candidates.get(strong_checksum(buffer(buf, pos, n)))
+            if i is not None:
+                if pos > lit_start:
+                    if copy_run is not None:
+                        yield ('copy',) + copy_run
+                        copy_run = None
+                    yield ('literal', str(buf[lit_start:pos]))
+                if copy_run is not None and sum(copy_run) == i:
+                    copy_run = (copy_run[0], copy_run[1] + 1)
+                else:
+                    if copy_run is not None:
+                        yield ('copy',) + copy_run
+                    copy_run = (i, 1)
+                pos += n
+                lit_start = pos
+                weak = None
+                continue
+
+        if pos + n == len(buf):
+            # the tail end of the file, shorter than a block
+            pos = len(buf)
+            break
+
+        # roll the window one byte forward
+        out_byte = buf[pos]
+        in_byte = buf[pos + n]
+        a = (a - out_byte + in_byte) % ADLER_MOD
+        b = (b - n * out_byte + a - 1) % ADLER_MOD
+        weak = (b << 16) | a
+        pos += 1
+
+        if pos - lit_start >= LITERAL_SIZE:
+            if copy_run is not None:
+                yield ('copy',) + copy_run
+                copy_run = None
+            yield ('literal', str(buf[lit_start:pos]))
+            literal_size += pos - lit_start
+            lit_start = pos
+            scanned = done + pos
+            if (scanned >= DELTA_PROBE and
+                    literal_size > scanned * DELTA_MAX_LITERAL_RATIO):
+                give_up = True
+                break
+
+    if copy_run is not None:
+        yield ('copy',) + copy_run
+    if give_up:
+        for i in xrange(lit_start, len(buf), LITERAL_SIZE):
+            yield ('literal', str(buf[i:i + LITERAL_SIZE]))
+        while True:
+            data = f.read(LITERAL_SIZE)
+            if not data:
+                break
+            yield ('literal', data)
+    elif pos > lit_start:
+        yield ('literal', str(buf[lit_start:pos]))
+
+def apply_delta(base_file, block_size, ops, out_file, progress=lambda b: None):
+    """ Write the file described by delta `ops` to `out_file`. `base_file`
+    must be seekable. """
+    for op in ops:
+        if op[0] == 'copy':
+            index, count = op[1:]
+            base_file.seek(index * block_size)
+            remaining = count * block_size
+            while remaining:
+                data = base_file.read(min(remaining, READ_SIZE))
+                if not data:
+                    break # the last block may be short
+                out_file.write(data)
+                remaining -= len(data)
+
+        else:
+            assert op[0] == 'literal'
+            out_file.write(op[1])
+            progress(len(op[1]))
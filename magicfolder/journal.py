@@ -0,0 +1,280 @@
+import os
+from os import path
+import sys
+import fcntl
+import errno
+import select
+import ctypes
+import ctypes.util
+import logging
+from time import time
+
+log = logging.getLogger('magicfolder.journal')
+
+FULL_SCAN_INTERVAL = 24 * 60 * 60 # one day
+FLUSH_INTERVAL = 0.2 # seconds
+
+RESCAN_ALL = '' # journal record asking for a full scan
+
+class Journal(object):
+    """
+    Paths changed in the working tree since the last scan, recorded by a
+    watcher (see `InotifyWatcher`) in ``.mf/journal`` as NUL-terminated
+    records. An empty record means "rescan everything".
+
+    The watcher holds an exclusive lock on ``.mf/watcher`` while it runs,
+    and writes its session id there once all watches are in place. A
+    scanner may only trust the journal if that watcher session was
+    already running at the time of the previous scan.
+
+    Records taken by a scanner are moved to ``.mf/journal.pending`` and
+    only dropped by `commit`, so an interrupted scan looks at them again.
+    """
+
+    def __init__(self, mf_path):
+        self.journal_path = path.join(mf_path, 'journal')
+        self.pending_path = path.join(mf_path, 'journal.pending')
+        self.watcher_path = path.join(mf_path, 'watcher')
+
+    def watcher_id(self):
+        """ Session id of the running watcher, or None. """
+        try:
+            f = open(self.watcher_path, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return f.read().strip() or None
+            else:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                return None # nobody holds the lock
+
+    def hold_watcher_lock(self):
+        """ Lock the watcher file; returns it, to be kept open. """
+        f = open(self.watcher_path, 'ab')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            raise RuntimeError("another watcher is running")
+        f.truncate(0)
+        return f
+
+    def set_watcher_id(self, lock_file, watcher_id):
+        lock_file.truncate(0)
+        lock_file.write(watcher_id + '\n')
+        lock_file.flush()
+
+    def record(self, paths):
+        if not paths:
+            return
+        with open(self.journal_path, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(''.join(p + '\0' for p in paths))
+
+    def take(self):
+        """
+        Move all records from the journal to the pending file and
+        return the set of paths in it (including ones left over from an
+        interrupted scan).
+        """
+        try:
+            f = open(self.journal_path, 'r+b')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            with f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                data = f.read()
+                if data:
+                    with open(self.pending_path, 'ab') as pending_file:
+                        pending_file.write(data)
+                        pending_file.flush()
+                        os.fsync(pending_file.fileno())
+                    f.truncate(0)
+
+        if not path.isfile(self.pending_path):
+            return set()
+        with open(self.pending_path, 'rb') as pending_file:
+            records = pending_file.read().split('\0')
+        return set(records[:-1])
+
+    def commit(self):
+        """ The scan that called `take` is done; forget its records. """
+        if path.isfile(self.pending_path):
+            os.unlink(self.pending_path)
+
+def changed_paths(journal, cache, use_cache):
+    """
+    Take the journal records and decide how to scan. Returns the
+    watcher id to store after a successful scan, and a set of changed
+    paths - or None if a full scan is required.
+    """
+    watcher_id = journal.watcher_id()
+    records = journal.take()
+    if watcher_id is None or not use_cache:
+        return watcher_id, None
+    if cache.get_meta('journal_id') != watcher_id:
+        return watcher_id, None
+    if time() - cache.get_meta('full_scan_time', 0) > FULL_SCAN_INTERVAL:
+        return watcher_id, None
+    if RESCAN_ALL in records or '.mfignore' in records:
+        return watcher_id, None
+    return watcher_id, records
+
+
+class _InotifyEvent(ctypes.Structure):
+    _fields_ = [('wd', ctypes.c_int), ('mask', ctypes.c_uint32),
+                ('cookie', ctypes.c_uint32), ('len', ctypes.c_uint32)]
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER_SIZE = ctypes.sizeof(_InotifyEvent)
+
+class InotifyWatcher(object):
+    """
+    Watch a working tree with Linux inotify and record changed paths in
+    its `Journal`. Folders matching `skip` (and ``.mf``) are not watched.
+    """
+
+    def __init__(self, root_path, skip):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+
+        self.root_path = root_path
+        self.skip = skip
+        self.journal = Journal(path.join(root_path, '.mf'))
+        self.watches = {}
+        self.changed = set()
+        self.running = False
+
+    def add_tree(self, rel_path):
+        """ Watch `rel_path` and the folders below it. """
+        if rel_path:
+            if self.skip(rel_path, True):
+                return
+            full_path = path.join(self.root_path, rel_path)
+            prefix = rel_path + '/'
+        else:
+            full_path = self.root_path
+            prefix = ''
+
+        wd = self._add_watch(self.fd, full_path, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return # gone already; the parent's event covers it
+            raise OSError(err, "inotify_add_watch failed for %r" % full_path)
+        self.watches[wd] = rel_path
+
+        try:
+            names = os.listdir(full_path)
+        except OSError:
+            return
+        for name in names:
+            if not prefix and name == '.mf':
+                continue
+            child_path = path.join(full_path, name)
+            if path.isdir(child_path) and not path.islink(child_path):
+                self.add_tree(prefix + name)
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            log.warning("inotify queue overflow, asking for a full scan")
+            self.changed.add(RESCAN_ALL)
+            return
+
+        parent = self.watches.get(wd)
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        if parent is None or not name:
+            return # events on the watched folder itself
+        if not parent and name == '.mf':
+            return
+
+        rel_path = parent + '/' + name if parent else name
+        self.changed.add(rel_path)
+        if rel_path == '.mfignore':
+            self.changed.add(RESCAN_ALL)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self.add_tree(rel_path)
+
+    def read_events(self):
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            header = _InotifyEvent.from_buffer_copy(data, offset)
+            name_start = offset + EVENT_HEADER_SIZE
+            name = data[name_start:name_start + header.len].rstrip('\0')
+            self.handle(header.wd, header.mask, name)
+            offset = name_start + header.len
+
+    def flush(self):
+        if self.changed:
+            self.journal.record(sorted(self.changed))
+            self.changed = set()
+
+    def run(self):
+        lock_file = self.journal.hold_watcher_lock()
+        try:
+            self.add_tree('')
+            watcher_id = '%d-%f' % (os.getpid(), time())
+            self.journal.set_watcher_id(lock_file, watcher_id)
+            log.info("Watching %r, session %s", self.root_path, watcher_id)
+
+            self.running = True
+            last_flush = time()
+            while self.running:
+                if select.select([self.fd], [], [], FLUSH_INTERVAL)[0]:
+                    self.read_events()
+                if time() - last_flush >= FLUSH_INTERVAL:
+                    self.flush()
+                    last_flush = time()
+
+        finally:
+            self.flush()
+            lock_file.close()
+            os.close(self.fd)
+
+    def stop(self):
+        self.running = False
+
+def detach():
+    """ Keep running in the background, detached from the terminal. """
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (sys.stdin, sys.stdout, sys.stderr):
+        os.dup2(devnull, fd.fileno())
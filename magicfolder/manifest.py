@@ -0,0 +1,213 @@
+"""
+Binary version manifest. Layout::
+
+    MAGIC
+    entries, sorted by path:
+        varint shared   - length of the prefix shared with the previous path
+        varint n        - length of the rest of the path
+        n bytes         - rest of the path
+        20 bytes        - binary SHA-1 of the file
+        varint size
+    varint 0, varint 0  - end of entries
+    index: big-endian uint64 offset of every `INDEX_INTERVAL`-th entry
+    footer: uint64 offset of the index, uint64 number of entries
+
+Indexed entries store their full path (``shared`` is 0), so a lookup
+binary-searches the index on disk and then decodes at most
+`INDEX_INTERVAL` entries. Iteration streams the entries without looking
+at the index.
+"""
+
+import struct
+from binascii import hexlify, unhexlify
+
+MAGIC = '\x89MFM\r\n\x1a\x01' # the last byte is the format version
+
+INDEX_INTERVAL = 64
+READ_SIZE = 64 * 1024
+PROBE_SIZE = 512 # enough for the first entry of a block, usually
+
+_offset_struct = struct.Struct('>Q')
+_footer_struct = struct.Struct('>QQ')
+
+def is_manifest(header):
+    """ Tell whether a file starting with `header` is a binary manifest. """
+    return header[:len(MAGIC)] == MAGIC
+
+def _encode_varint(n):
+    out = []
+    while n >= 0x80:
+        out.append(chr(n & 0x7f | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+def _decode_varint(buf, pos):
+    """ Raises IndexError if `buf` ends before the varint does. """
+    result = shift = 0
+    while True:
+        b = ord(buf[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def _decode_entry(buf, pos, prev_path):
+    """
+    Decode the entry at `pos`. Returns ``((path, checksum, size), pos)``,
+    or ``(None, pos)`` at the end of entries. Raises IndexError if the
+    entry is not all in `buf`.
+    """
+    shared, pos = _decode_varint(buf, pos)
+    suffix_len, pos = _decode_varint(buf, pos)
+    if shared == suffix_len == 0:
+        return None, pos
+    end = pos + suffix_len
+    file_path = prev_path[:shared] + buf[pos:end]
+    digest = buf[end:end + 20]
+    size, pos = _decode_varint(buf, end + 20)
+    return (file_path, hexlify(digest), size), pos
+
+def _common_prefix_len(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+class ManifestWriter(object):
+    """ Write ``(path, checksum, size)`` entries, in path order, to `fh`.
+    Call `close` to write the index. """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.offset = len(MAGIC)
+        self.index = []
+        self.count = 0
+        self.prev_path = None
+        fh.write(MAGIC)
+
+    def write(self, file_path, checksum, size):
+        if self.prev_path is not None and file_path <= self.prev_path:
+            raise ValueError("manifest paths must be unique and sorted, "
+                             "got %r after %r" % (file_path, self.prev_path))
+        if len(self.index) * INDEX_INTERVAL == self.count:
+            self.index.append(self.offset)
+            shared = 0
+        else:
+            shared = _common_prefix_len(self.prev_path, file_path)
+        record = ''.join([_encode_varint(shared),
+                          _encode_varint(len(file_path) - shared),
+                          file_path[shared:],
+                          unhexlify(checksum),
+                          _encode_varint(size)])
+        self.fh.write(record)
+        self.offset += len(record)
+        self.count += 1
+        self.prev_path = file_path
+
+    def close(self):
+        end = _encode_varint(0) * 2
+        index_offset = self.offset + len(end)
+        self.fh.write(end)
+        self.fh.write(''.join(_offset_struct.pack(o) for o in self.index))
+        self.fh.write(_footer_struct.pack(index_offset, self.count))
+
+def iter_manifest(fh):
+    """ Stream the ``(path, checksum, size)`` entries of a manifest. """
+    if not is_manifest(fh.read(len(MAGIC))):
+        raise ValueError("not a binary manifest")
+    buf = fh.read(READ_SIZE)
+    pos = 0
+    prev_path = ''
+    eof = False
+    while True:
+        try:
+            entry, new_pos = _decode_entry(buf, pos, prev_path)
+        except IndexError:
+            if eof:
+                raise ValueError("truncated manifest")
+            data = fh.read(READ_SIZE)
+            eof = not data
+            buf = buf[pos:] + data
+            pos = 0
+            continue
+        if entry is None:
+            return
+        yield entry
+        prev_path = entry[0]
+        pos = new_pos
+
+class ManifestReader(object):
+    """ Random access to a binary manifest in seekable file `fh`. """
+
+    def __init__(self, fh):
+        self.fh = fh
+        fh.seek(0)
+        if not is_manifest(fh.read(len(MAGIC))):
+            raise ValueError("not a binary manifest")
+        fh.seek(-_footer_struct.size, 2)
+        footer_offset = fh.tell()
+        self.index_offset, self.count = \
+            _footer_struct.unpack(fh.read(_footer_struct.size))
+        self.index_len = ((footer_offset - self.index_offset) //
+                          _offset_struct.size)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        self.fh.seek(0)
+        return iter_manifest(self.fh)
+
+    def _index_entry(self, i):
+        self.fh.seek(self.index_offset + i * _offset_struct.size)
+        return _offset_struct.unpack(self.fh.read(_offset_struct.size))[0]
+
+    def _read_block(self, i):
+        """ Read the bytes of the `i`-th block of `INDEX_INTERVAL`
+        entries. """
+        start = self._index_entry(i)
+        if i + 1 < self.index_len:
+            end = self._index_entry(i + 1)
+        else:
+            end = self.index_offset
+        self.fh.seek(start)
+        return self.fh.read(end - start)
+
+    def _first_path(self, i):
+        self.fh.seek(self._index_entry(i))
+        buf = self.fh.read(PROBE_SIZE)
+        while True:
+            try:
+                return _decode_entry(buf, 0, '')[0][0]
+            except IndexError:
+                data = self.fh.read(READ_SIZE)
+                if not data:
+                    raise ValueError("truncated manifest")
+                buf += data
+
+    def lookup(self, file_path):
+        """ Return ``(checksum, size)`` for `file_path`, or None. """
+        lo, hi = 0, self.index_len
+        while lo < hi: # find the last block starting at or before file_path
+            mid = (lo + hi) // 2
+            if self._first_path(mid) <= file_path:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+
+        buf = self._read_block(lo - 1)
+        pos = 0
+        prev_path = ''
+        while pos < len(buf):
+            entry, pos = _decode_entry(buf, pos, prev_path)
+            if entry is None or entry[0] > file_path:
+                break
+            if entry[0] == file_path:
+                return entry[1:]
+            prev_path = entry[0]
+        return None
@@ -0,0 +1,102 @@
+"""
+Merkle trees over file lists. Each folder is hashed from the names and
+entries of its children, so two trees can be compared top-down, looking
+only at the folders whose hashes differ.
+
+A tree is a dict ``{folder_path: (hash, children)}``, with ``''`` for
+the root. `children` maps names to ``('file', checksum, size)`` or
+``('dir', hash)``.
+"""
+
+from hashlib import sha1
+from posixpath import dirname, basename
+
+def _folder_hash(children):
+    h = sha1()
+    for name in sorted(children):
+        h.update(name + '\0' + '\0'.join(str(v) for v in children[name]))
+        h.update('\n')
+    return h.hexdigest()
+
+def build_tree(file_items):
+    """ Build the Merkle tree of an iterable of file items. """
+    children = {'': {}}
+    for i in file_items:
+        folder = dirname(i.path)
+        children.setdefault(folder, {})[basename(i.path)] = \
+            ('file', i.checksum, i.size)
+        while folder: # make sure the parent folders are listed
+            parent_children = children.setdefault(dirname(folder), {})
+            if basename(folder) in parent_children:
+                break
+            parent_children[basename(folder)] = None # hashed below
+            folder = dirname(folder)
+
+    tree = {}
+    # deeper folders first, so their hashes are known when their
+    # parents are hashed
+    for folder in sorted(children, key=lambda f: -f.count('/') - bool(f)):
+        folder_hash = _folder_hash(children[folder])
+        tree[folder] = (folder_hash, children[folder])
+        if folder:
+            children[dirname(folder)][basename(folder)] = ('dir', folder_hash)
+    return tree
+
+def root_hash(tree):
+    return tree[''][0]
+
+def _join(folder, name):
+    return folder + '/' + name if folder else name
+
+def _files_under(tree, folder):
+    for name, entry in tree[folder][1].iteritems():
+        child_path = _join(folder, name)
+        if entry[0] == 'file':
+            yield child_path
+        else:
+            for file_path in _files_under(tree, child_path):
+                yield file_path
+
+def find_changes(local_tree, fetch):
+    """
+    Compare `local_tree` with a remote tree, one level at a time.
+    `fetch` takes a list of folder paths and returns a dict with the
+    remote children of each, or None for folders that don't exist
+    remotely. Yields ``(path, kind)`` for each file that differs, where
+    `kind` is 'changed' (the local file is new or changed) or 'removed'
+    (the file only exists remotely).
+    """
+    pending = ['']
+    while pending:
+        remote_nodes = fetch(pending)
+        next_pending = []
+        for folder in pending:
+            if folder in local_tree:
+                local_children = local_tree[folder][1]
+            else:
+                local_children = {}
+            remote_children = remote_nodes.get(folder) or {}
+
+            for name in set(local_children) | set(remote_children):
+                local_entry = local_children.get(name)
+                remote_entry = remote_children.get(name)
+                if local_entry == remote_entry:
+                    continue
+                child_path = _join(folder, name)
+
+                if local_entry is not None and local_entry[0] == 'file':
+                    yield child_path, 'changed'
+                elif local_entry is not None and (remote_entry is None or
+                                                  remote_entry[0] == 'file'):
+                    # the folder only exists locally
+                    for file_path in _files_under(local_tree, child_path):
+                        yield file_path, 'changed'
+
+                if remote_entry is not None:
+                    if remote_entry[0] == 'file':
+                        if local_entry is None or local_entry[0] == 'dir':
+                            yield child_path, 'removed'
+                    else:
+                        next_pending.append(child_path)
+
+        pending = next_pending
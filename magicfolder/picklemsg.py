@@ -1,44 +1,297 @@
 import cPickle as pickle
+import struct
+from collections import deque
+from time import time
+from itertools import imap, chain
+
+from checksum import FileItem
+from compression import compressor, decompressor
 
 CHUNK_SIZE = 64 * 1024 # 64 KB
 
+BATCH_SIZE = 2000 # messages
+BATCH_TIME = 0.5 # seconds
+
+FRAME_VERSION = 1
+MAX_CHUNK_SIZE = 1024 * 1024 # 1 MB, for framed transfers
+_frame_header = struct.Struct('>cI') # kind, payload length
+RAW_FRAMES = {'file_chunk': 'C', 'file_zchunk': 'Z'} # payload is a string
+PICKLE_FRAME = 'P'
+
+COMPRESSION_PROBE = 128 * 1024 # bytes compressed before deciding
+COMPRESSION_MIN_RATIO = .9 # send raw data if it doesn't get smaller
+
+_frame_messages = dict((kind, msg) for msg, kind in RAW_FRAMES.iteritems())
+
 class Remote(object):
+    """
+    Pickled ``(msg, payload)`` messages over a pair of files. Messages
+    passed to `send_batched` are collected and sent as a single 'batch'
+    message once `BATCH_SIZE` of them pile up or `BATCH_TIME` passes, or
+    before anything else is sent or received; `recv` unpacks batches, so
+    the receiving code sees the same sequence of messages. Batching is
+    off until both ends agree on it (the 'batching' capability); until
+    then `send_batched` sends right away.
+
+    With the 'framing' capability, messages are sent as frames instead:
+    a `_frame_header` and the payload. File chunks go out as raw bytes,
+    other messages are pickled. Framed writes aren't flushed until the
+    next `recv` (or `flush`), so small messages share system calls.
+    """
+
+    batching = False
+    _out_batch = None
+    _in_batch = None
+    compression = None
+    framing = None
+    _raw_bytes = _wire_bytes = 0
+
     def __init__(self, in_file, out_file):
         self.in_unpickler = pickle.Unpickler(in_file)
         self.out_pickler = pickle.Pickler(out_file, 2) # protocol version 2
+        self.in_file = in_file
         self.out_file = out_file
 
-    def send(self, msg, payload=None):
+    def set_framing(self, version):
+        """ Switch to framed messages; both ends do it right after the
+        'capabilities' exchange. """
+        assert version == FRAME_VERSION, "bad framing version %r" % version
+        self.framing = version
+
+    def _write(self, msg, payload):
+        if self.framing:
+            kind = RAW_FRAMES.get(msg)
+            if kind is None:
+                kind = PICKLE_FRAME
+                payload = pickle.dumps((msg, payload), 2)
+            self.out_file.write(_frame_header.pack(kind, len(payload)))
+            self.out_file.write(payload)
+            return
         self.out_pickler.dump( (msg, payload) )
         self.out_file.flush()
         self.out_pickler.clear_memo()
 
+    def _read(self):
+        if self.framing:
+            self.out_file.flush()
+            header = self.in_file.read(_frame_header.size)
+            if len(header) < _frame_header.size:
+                raise EOFError
+            kind, length = _frame_header.unpack(header)
+            payload = self.in_file.read(length)
+            if kind == PICKLE_FRAME:
+                return pickle.loads(payload)
+            return _frame_messages[kind], payload
+        return self.in_unpickler.load()
+
+    def flush(self):
+        """ Send pending messages; needed after the last framed message
+        if no `recv` follows. """
+        self.flush_batch()
+        if self.framing:
+            self.out_file.flush()
+
+    def send(self, msg, payload=None):
+        self.flush_batch()
+        self._write(msg, payload)
+
+    def send_batched(self, msg, payload=None):
+        if not self.batching:
+            return self.send(msg, payload)
+        if not self._out_batch:
+            self._out_batch = []
+            self._out_batch_time = time()
+        self._out_batch.append( (msg, payload) )
+        if (len(self._out_batch) >= BATCH_SIZE or
+                time() - self._out_batch_time > BATCH_TIME):
+            self.flush_batch()
+
+    def flush_batch(self):
+        """
+        Send the pending batch. Consecutive messages with the same name
+        are grouped as ``(msg, is_file_item, payloads)`` runs; file items
+        travel as plain tuples, which pickle several times faster than
+        namedtuples.
+        """
+        if not self._out_batch:
+            return
+        batch, self._out_batch = self._out_batch, None
+        runs = []
+        last_run = (None, None, None)
+        for msg, payload in batch:
+            is_file_item = type(payload) is FileItem
+            if is_file_item:
+                payload = tuple(payload)
+            if last_run[:2] != (msg, is_file_item):
+                last_run = (msg, is_file_item, [])
+                runs.append(last_run)
+            last_run[2].append(payload)
+        self._write('batch', runs)
+
+    def _unpack_batch(self, runs):
+        self._in_batch = deque()
+        for msg, is_file_item, payloads in runs:
+            if is_file_item:
+                payloads = imap(FileItem._make, payloads)
+            self._in_batch.extend((msg, payload) for payload in payloads)
+
     def recv(self):
-        msg, payload = self.in_unpickler.load()
+        self.flush_batch()
+        if self._in_batch:
+            msg, payload = self._in_batch.popleft()
+        else:
+            msg, payload = self._read()
+            if msg == 'batch':
+                self._unpack_batch(payload)
+                msg, payload = self._in_batch.popleft()
         if msg == 'error':
             print "error from remote endpoint\n%s" % payload
         return msg, payload
 
-    def send_file(self, src_file, progress=lambda b: None):
+    def set_compression(self, settings):
+        """ Compress file chunks with ``{'codec': ..., 'level': ...}``
+        `settings`, as negotiated with the 'compression' capability. """
+        self.compression = settings
+
+    def compression_stats(self):
+        """ Return ``(raw, wire)`` byte counts of compressed transfers. """
+        return self._raw_bytes, self._wire_bytes
+
+    def _read_chunks(self, src_file, views=False):
+        """
+        Yield the contents of `src_file` in chunks. With framing, chunks
+        grow up to `MAX_CHUNK_SIZE` as the file goes on, and if `views`
+        is set and `src_file` is a real file, they're memoryviews of a
+        buffer that's reused for the next chunk.
+        """
+        chunk_size = CHUNK_SIZE
+        if self.framing and views and isinstance(src_file, file):
+            buf = memoryview(bytearray(MAX_CHUNK_SIZE))
+            read = lambda size: buf[:src_file.readinto(buf[:size])]
+        else:
+            read = src_file.read
         while True:
-            chunk = src_file.read(CHUNK_SIZE)
-            if not chunk:
+            chunk = read(chunk_size)
+            if not len(chunk):
                 break
-            self.send('file_chunk', chunk)
+            yield chunk
+            if self.framing:
+                chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+
+    def send_file(self, src_file, progress=lambda b: None):
+        """
+        Send the contents of `src_file` as 'file_chunk' messages, or
+        'file_zchunk' if compression is on. If the first
+        `COMPRESSION_PROBE` bytes don't shrink to `COMPRESSION_MIN_RATIO`,
+        the rest of the file is sent uncompressed. Codecs that can't
+        flush mid-stream (bz2) give nothing back that early, so for them
+        those bytes are first compressed on their own, to decide.
+        """
+        stream = None
+        if self.compression is not None:
+            stream = compressor(self.compression)
+        chunks = self._read_chunks(src_file, views=stream is None)
+        if stream is not None and not stream.sync_flush:
+            head = []
+            head_size = 0
+            for chunk in chunks:
+                head.append(chunk)
+                head_size += len(chunk)
+                if head_size >= COMPRESSION_PROBE:
+                    break
+            probe = compressor(self.compression)
+            probe_size = sum(len(probe.compress(chunk)) for chunk in head)
+            probe_size += len(probe.flush())
+            if probe_size > head_size * COMPRESSION_MIN_RATIO:
+                stream = None
+            chunks = chain(head, chunks)
+
+        raw_size = wire_size = 0
+        for chunk in chunks:
+            if stream is None:
+                self.send('file_chunk', chunk)
+                if self.compression is not None: # gave up compressing
+                    raw_size += len(chunk)
+                    wire_size += len(chunk)
+            else:
+                data = stream.compress(chunk)
+                raw_size += len(chunk)
+                wire_size += len(data)
+                if data:
+                    self.send('file_zchunk', data)
+                if (raw_size >= COMPRESSION_PROBE and
+                        wire_size > raw_size * COMPRESSION_MIN_RATIO):
+                    data = stream.flush()
+                    if data:
+                        self.send('file_zchunk', data)
+                    wire_size += len(data)
+                    stream = None
             progress(len(chunk))
 
+        if stream is not None:
+            data = stream.flush()
+            if data:
+                self.send('file_zchunk', data)
+            wire_size += len(data)
+        self._raw_bytes += raw_size
+        self._wire_bytes += wire_size
+        self.send('file_end')
+
+    def send_compressed_file(self, src_file, size, progress=lambda b: None):
+        """ Send `src_file`, which already holds a stream compressed with
+        the negotiated codec, as 'file_zchunk' messages. `size` is the
+        uncompressed size. """
+        for data in self._read_chunks(src_file):
+            self.send('file_zchunk', data)
+            self._wire_bytes += len(data)
+        self._raw_bytes += size
+        progress(size)
         self.send('file_end')
 
     def recv_file(self, dst_file, progress=lambda b: None):
+        stream = None
         while True:
             msg, payload = self.recv()
             if msg == 'file_end':
                 break
 
-            assert msg == 'file_chunk'
+            if msg == 'file_zchunk':
+                if stream is None:
+                    stream = decompressor(self.compression['codec'])
+                self._wire_bytes += len(payload)
+                payload = stream.decompress(payload)
+                self._raw_bytes += len(payload)
+            else:
+                assert msg == 'file_chunk'
+                if self.compression is not None:
+                    self._raw_bytes += len(payload)
+                    self._wire_bytes += len(payload)
             dst_file.write(payload)
             progress(len(payload))
 
+    def send_delta(self, ops, progress=lambda b: None):
+        """ Send the ops produced by `delta.iter_delta`. """
+        for op in ops:
+            if op[0] == 'copy':
+                self.send('delta_copy', op[1:])
+            else:
+                self.send('delta_literal', op[1])
+                progress(len(op[1]))
+
+        self.send('delta_end')
+
+    def recv_delta(self):
+        """ Receive delta ops, to be consumed by `delta.apply_delta`. """
+        while True:
+            msg, payload = self.recv()
+            if msg == 'delta_end':
+                break
+            elif msg == 'delta_copy':
+                yield ('copy',) + tuple(payload)
+            else:
+                assert msg == 'delta_literal'
+                yield ('literal', payload)
+
     def __iter__(self):
         return self
 
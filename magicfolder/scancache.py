@@ -0,0 +1,158 @@
+import os
+from os import path
+import sqlite3
+import threading
+from time import time
+import cPickle as pickle
+
+CHECKPOINT_ENTRIES = 10000
+CHECKPOINT_TIME = 10 # seconds
+COMPACT_MIN_PAGES = 1024
+
+class ScanCache(object):
+    """
+    Keyed on-disk store of ``path -> (checksum, size, time)`` for the
+    working tree scanner, backed by SQLite. The database is opened on
+    first use and looked up one path at a time, so neither startup time
+    nor memory grow with the size of the tree.
+
+    Entries are buffered and committed every `CHECKPOINT_ENTRIES` entries
+    or `CHECKPOINT_TIME` seconds, so an interrupted scan keeps most of the
+    hashes it computed. Each scan has a generation number; `finish_scan`
+    drops entries that were not seen by the current scan.
+    """
+
+    def __init__(self, db_path, legacy_path=None):
+        self.db_path = db_path
+        self.legacy_path = legacy_path
+        self._conn = None
+        self._pending = []
+        self._last_checkpoint = time()
+        self.scan = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = self._connect()
+            self._import_legacy()
+        return self._conn
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.text_factory = str
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                     "path TEXT PRIMARY KEY, checksum TEXT, "
+                     "size INTEGER, time REAL, scan INTEGER)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta ("
+                     "key TEXT PRIMARY KEY, value)")
+        conn.commit()
+        return conn
+
+    def _import_legacy(self):
+        """ Load entries from the old pickled-dict cache, then remove it. """
+        if self.legacy_path is None or not path.isfile(self.legacy_path):
+            return
+        with open(self.legacy_path, 'rb') as f:
+            legacy_cache = pickle.load(f)
+        self._conn.executemany("INSERT OR REPLACE INTO files "
+                               "VALUES (?, ?, ?, ?, 0)",
+                               ((i.path, i.checksum, i.size, i.time)
+                                for i in legacy_cache.itervalues()))
+        self._conn.commit()
+        os.unlink(self.legacy_path)
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?",
+                                (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                          (key, value))
+
+    def get(self, file_path):
+        """ Return ``(checksum, size, time)`` for `file_path`, or None. """
+        return self.conn.execute("SELECT checksum, size, time FROM files "
+                                 "WHERE path = ?", (file_path,)).fetchone()
+
+    def begin_scan(self, incremental=False):
+        """
+        Start a scan. A full scan gets a new generation number; an
+        `incremental` scan only visits some paths, so it keeps the
+        current one.
+        """
+        self.scan = self.get_meta('scan', 0)
+        if not incremental:
+            self.scan += 1
+            self.set_meta('scan', self.scan)
+            self.conn.commit()
+
+    def items(self):
+        """ Iterate over all entries as ``(path, checksum, size, time)``,
+        sorted by path. """
+        self.checkpoint()
+        return self.conn.execute("SELECT path, checksum, size, time "
+                                 "FROM files ORDER BY path")
+
+    def paths_under(self, file_path):
+        """ Return `file_path` and the paths below it, if it's a folder. """
+        self.checkpoint()
+        # in byte order, "/" is followed by "0"
+        rows = self.conn.execute("SELECT path FROM files WHERE path = ? OR "
+                                 "(path >= ? AND path < ?)",
+                                 (file_path, file_path + '/', file_path + '0'))
+        return [row[0] for row in rows]
+
+    def remove(self, file_path):
+        self.checkpoint()
+        self.conn.execute("DELETE FROM files WHERE path = ?", (file_path,))
+
+    def put(self, file_path, checksum, size, time_):
+        self._pending.append((file_path, checksum, size, time_, self.scan))
+        if (len(self._pending) >= CHECKPOINT_ENTRIES or
+                time() - self._last_checkpoint > CHECKPOINT_TIME):
+            self.checkpoint()
+
+    def checkpoint(self):
+        """ Write buffered entries to disk and commit. """
+        if self._pending:
+            self.conn.executemany("INSERT OR REPLACE INTO files "
+                                  "VALUES (?, ?, ?, ?, ?)", self._pending)
+            self._pending = []
+        self.conn.commit()
+        self._last_checkpoint = time()
+
+    def finish_scan(self):
+        """ Drop entries not seen by the scan that just completed. """
+        self.checkpoint()
+        self.conn.execute("DELETE FROM files WHERE scan < ?", (self.scan,))
+        self.conn.commit()
+
+    def needs_compaction(self):
+        free_pages = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        total_pages = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        return total_pages > COMPACT_MIN_PAGES and free_pages * 4 > total_pages
+
+    def compact_in_background(self):
+        """ Reclaim free pages on a separate connection and thread. """
+        def compact():
+            conn = sqlite3.connect(self.db_path)
+            try:
+                conn.execute("VACUUM")
+            except sqlite3.OperationalError:
+                pass # database busy; try again after the next scan
+            finally:
+                conn.close()
+
+        thread = threading.Thread(target=compact,
+                                  name='magicfolder-cache-compact')
+        thread.start()
+        return thread
+
+    def close(self):
+        if self._conn is not None:
+            self.checkpoint()
+            self._conn.close()
+            self._conn = None
@@ -2,176 +2,864 @@ import sys
 import os
 from os import path
 import traceback
-from StringIO import StringIO
+import errno
+import fcntl
+import tempfile
+import threading
 import operator
 import logging
+import json
+import argparse
+import cPickle as pickle
 from contextlib import contextmanager
 from itertools import count
+from time import time
+from collections import OrderedDict, Counter
 
 import picklemsg
 from blobdb import BlobDB
-from checksum import FileItem, read_version_file, write_version_file
+from compression import valid_compression
+from checksum import (FileItem, read_version_file, write_version_file,
+                      string_to_file_item, file_item_to_string)
+from chunking import CHUNKED_FILE_SIZE
+from merkle import build_tree
+from delta import (DELTA_FILE_SIZE, block_size_for, signatures, iter_delta,
+                   apply_delta)
 
 log = logging.getLogger('magicfolder.server')
 
-def dump_fileitems(fh, bag):
-    with write_version_file(fh) as write_file_item:
+def dump_fileitems(fh, bag, binary=False):
+    with write_version_file(fh, binary) as write_file_item:
         for i in sorted(bag, key=operator.attrgetter('path')):
             write_file_item(i)
 
 def file_item_tree(file_item_iter):
     return dict( (i.path, i) for i in file_item_iter )
 
+def dump_version_delta(fh, parent, depth, parent_bag, bag):
+    """
+    Write the difference from `parent_bag` to `bag`. The first line holds
+    the parent version number and the length of the delta chain; then
+    come ``-`` lines for removed file items and ``+`` lines for added
+    ones, in the version file text format.
+    """
+    fh.write('parent %d depth %d\n' % (parent, depth))
+    path_key = operator.attrgetter('path')
+    for i in sorted(parent_bag - bag, key=path_key):
+        fh.write('- %s\n' % file_item_to_string(i))
+    for i in sorted(bag - parent_bag, key=path_key):
+        fh.write('+ %s\n' % file_item_to_string(i))
+
+def read_delta_header(fh):
+    """ Return ``(parent, depth)`` from a version delta file. """
+    words = fh.readline().split()
+    assert words[0] == 'parent' and words[2] == 'depth', \
+        "malformed version delta header: %r" % words
+    return int(words[1]), int(words[3])
+
+def apply_version_delta(fh, tree):
+    """ Apply a version delta to a ``path -> file item`` dict. The header
+    must have been read already. """
+    for line in fh:
+        file_item = string_to_file_item(line[2:])
+        if line[0] == '-':
+            del tree[file_item.path]
+        else:
+            assert line[0] == '+', "malformed version delta line: %r" % line
+            tree[file_item.path] = file_item
+
+def read_config(root_path):
+    """ Archive settings from the optional ``config`` JSON file. """
+    config_path = path.join(root_path, 'config')
+    if not path.isfile(config_path):
+        return {}
+    with open(config_path, 'rb') as f:
+        return json.load(f)
+
+def write_config(root_path, config):
+    tmp_path = path.join(root_path, 'config.tmp')
+    with open(tmp_path, 'wb') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.rename(tmp_path, path.join(root_path, 'config'))
+
 def server_init(root_path):
     os.mkdir(path.join(root_path, 'objects'))
     os.mkdir(path.join(root_path, 'versions'))
     with open(path.join(root_path, 'versions', '0'), 'wb') as f:
         pass
 
+VERSION_CACHE_SIZE = 4 # versions (and their Merkle trees) kept in memory
+
+def _cache_put(cache, key, value):
+    cache[key] = value
+    while len(cache) > VERSION_CACHE_SIZE:
+        cache.popitem(last=False)
+
 class Archive(object):
     def __init__(self, root_path):
         assert path.isdir(root_path)
         self.root_path = root_path
-        self.data_pool = BlobDB(path.join(root_path, 'objects'))
+        self._version_cache = OrderedDict()
+        self._merkle_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.config = read_config(root_path)
+        blob_compression = self.config.get('blob_compression')
+        assert blob_compression is None or \
+            valid_compression(blob_compression), \
+            "bad blob_compression %r" % blob_compression
+        self.data_pool = BlobDB(path.join(root_path, 'objects'),
+                                path.join(root_path, 'objects.idx'),
+                                blob_compression)
+
+    @property
+    def binary_manifests(self):
+        manifest_format = self.config.get('manifest_format', 'text')
+        assert manifest_format in ('binary', 'text'), \
+            "unknown manifest_format %r" % manifest_format
+        return manifest_format == 'binary'
+
+    def version_path(self, n):
+        return path.join(self.root_path, 'versions', '%d' % n)
+
+    def delta_path(self, n):
+        return path.join(self.root_path, 'versions', '%d.delta' % n)
 
     def open_version_read(self, n):
-        return open(path.join(self.root_path, 'versions/%d' % n), 'rb')
+        return open(self.version_path(n), 'rb')
 
     def open_version_write(self, n):
-        return open(path.join(self.root_path, 'versions/%d' % n), 'wb')
+        return open(self.version_path(n), 'wb')
+
+    def _version_exists(self, n):
+        return (path.isfile(self.version_path(n)) or
+                path.isfile(self.delta_path(n)))
 
     def get_latest_version(self):
-        versions_path = path.join(self.root_path, 'versions')
-        return max(int(v) for v in os.listdir(versions_path))
+        """
+        Read the version number from ``HEAD``. Versions written after it
+        (by a sync that was interrupted before updating ``HEAD``, or by
+        an older release) are picked up too. Archives without ``HEAD``
+        fall back to listing the versions folder.
+        """
+        head_path = path.join(self.root_path, 'HEAD')
+        if path.isfile(head_path):
+            with open(head_path, 'rb') as f:
+                latest = int(f.read())
+        else:
+            versions_path = path.join(self.root_path, 'versions')
+            latest = max(int(v.split('.')[0])
+                         for v in os.listdir(versions_path)
+                         if v.split('.')[0].isdigit())
+        while self._version_exists(latest + 1):
+            latest += 1
+        return latest
+
+    def _set_head(self, n):
+        tmp_path = path.join(self.root_path, 'HEAD.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write('%d\n' % n)
+        os.rename(tmp_path, path.join(self.root_path, 'HEAD'))
+
+    @property
+    def snapshot_interval(self):
+        return self.config.get('snapshot_interval', 1)
+
+    def _delta_depth(self, n):
+        """ Number of deltas to apply on top of a snapshot to get
+        version `n`. """
+        if path.isfile(self.version_path(n)):
+            return 0
+        with open(self.delta_path(n), 'rb') as f:
+            return read_delta_header(f)[1]
+
+    def read_version(self, n):
+        """ Return the set of file items in version `n`, as a frozenset.
+        The last few versions read or written are kept in memory. """
+        with self._cache_lock:
+            if n in self._version_cache:
+                return self._version_cache[n]
+        bag = self._load_version(n)
+        with self._cache_lock:
+            _cache_put(self._version_cache, n, bag)
+        return bag
+
+    def _load_version(self, n):
+        chain = []
+        while not path.isfile(self.version_path(n)):
+            f = open(self.delta_path(n), 'rb')
+            chain.append(f)
+            n = read_delta_header(f)[0]
+
+        with self.open_version_read(n) as f:
+            tree = file_item_tree(read_version_file(f))
+        for f in reversed(chain):
+            with f:
+                apply_version_delta(f, tree)
+        return frozenset(tree.itervalues())
+
+    def write_version(self, n, bag, parent=None, parent_bag=None):
+        """
+        Store version `n` and make it the latest. If `parent` is given,
+        and the archive is configured with a ``snapshot_interval`` above
+        1, the version is stored as a delta against `parent_bag`, with a
+        full snapshot every ``snapshot_interval`` versions.
+        """
+        depth = 0
+        if parent is not None and self.snapshot_interval > 1:
+            depth = self._delta_depth(parent) + 1
+            if depth >= self.snapshot_interval:
+                depth = 0
+
+        if depth:
+            final_path, stale_path = self.delta_path(n), self.version_path(n)
+        else:
+            final_path, stale_path = self.version_path(n), self.delta_path(n)
+
+        tmp_path = path.join(self.root_path, 'version.tmp')
+        with open(tmp_path, 'wb') as f:
+            if depth:
+                dump_version_delta(f, parent, depth, parent_bag, bag)
+            else:
+                dump_fileitems(f, bag, self.binary_manifests)
+        if path.isfile(stale_path):
+            os.unlink(stale_path)
+        os.rename(tmp_path, final_path)
+        with self._cache_lock:
+            self._merkle_cache.pop(n, None)
+            _cache_put(self._version_cache, n, frozenset(bag))
+        self._set_head(n)
+
+    @contextmanager
+    def lock(self):
+        """ Hold the archive's commit lock, an exclusive lock on the
+        ``lock`` file, shared with other processes. """
+        with open(path.join(self.root_path, 'lock'), 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def commit_version(self, bag, parent, parent_bag):
+        """
+        Write `bag` as the version after `parent`, unless another sync
+        committed since `parent` was read. Returns the new version
+        number, or None if `parent` is no longer the latest version.
+        """
+        with self.lock():
+            if self.get_latest_version() != parent:
+                return None
+            self.write_version(parent + 1, bag, parent, parent_bag)
+            return parent + 1
+
+    def merkle_tree(self, n):
+        """ Return the Merkle tree of version `n`, computing it on first
+        use and caching it under ``merkle/``. """
+        if n == 0:
+            return build_tree([])
+        with self._cache_lock:
+            if n in self._merkle_cache:
+                return self._merkle_cache[n]
+        tree = self._load_merkle_tree(n)
+        with self._cache_lock:
+            _cache_put(self._merkle_cache, n, tree)
+        return tree
+
+    def _load_merkle_tree(self, n):
+        merkle_path = path.join(self.root_path, 'merkle')
+        tree_path = path.join(merkle_path, '%d' % n)
+        if path.isfile(tree_path):
+            with open(tree_path, 'rb') as f:
+                return pickle.load(f)
+
+        tree = build_tree(self.read_version(n))
+        try:
+            os.mkdir(merkle_path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        # other syncs may be saving the same tree
+        fd, tmp_path = tempfile.mkstemp(dir=merkle_path)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(tree, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, tree_path)
+        return tree
 
     def __contains__(self, checksum):
         return checksum in self.data_pool
 
+    def contains_many(self, checksums):
+        return self.data_pool.contains_many(checksums)
+
     def read_file(self, checksum):
         return self.data_pool.read_file(checksum)
 
     def write_file(self, checksum):
         return self.data_pool.write_file(checksum)
 
-def server_sync(archive, remote):
-    # TODO refactor this function as a class with several small methods
-    msg, payload = remote.recv()
-    assert msg == 'sync'
-
-    latest_version = archive.get_latest_version()
-    remote_base_version = payload
-
-    log.debug("Begin sync at version %d, client last_sync is %d",
-              latest_version, remote_base_version)
-
-    with archive.open_version_read(latest_version) as f:
-        server_bag = set(read_version_file(f))
-
-    if remote_base_version == latest_version:
-        remote_outdated = False
-        old_bag = server_bag
+    def write_partial(self, checksum, restart=False):
+        return self.data_pool.write_partial(checksum, restart)
+
+    def partial_size(self, checksum):
+        return self.data_pool.partial_size(checksum)
+
+    def write_recipe(self, checksum, chunks):
+        return self.data_pool.write_recipe(checksum, chunks)
+
+SERVER_CAPABILITIES = frozenset(['chunking', 'delta', 'status_delta',
+                                 'merkle', 'batching', 'pipelining',
+                                 'compression', 'framing', 'channels',
+                                 'local_copy', 'resume', 'checkpoint'])
+BLOB_CHANNEL_CAPABILITIES = frozenset(['compression', 'framing'])
+
+PIPELINE_WINDOW = 256 # blobs requested at a time
+MAX_CHANNELS = 8 # extra connections for blob transfers
+
+def valid_checkpoint(limits):
+    """ Check ``{'bytes': ..., 'seconds': ...}`` settings for the
+    'checkpoint' capability; either limit may be left out. """
+    return (isinstance(limits, dict) and bool(limits) and
+            all(k in ('bytes', 'seconds') and
+                isinstance(v, (int, long, float)) and v > 0
+                for k, v in limits.iteritems()))
+
+def accept_capabilities(remote, offered, allowed=SERVER_CAPABILITIES):
+    """ Reply to a 'capabilities' message with the `allowed` ones that
+    are valid, and set up `remote` to use them. """
+    accepted = dict((k, v) for k, v in offered.iteritems() if k in allowed)
+    if not valid_compression(accepted.get('compression')):
+        accepted.pop('compression', None)
+    if accepted.get('framing') != picklemsg.FRAME_VERSION:
+        accepted.pop('framing', None)
+    if not valid_checkpoint(accepted.get('checkpoint')):
+        accepted.pop('checkpoint', None)
+    channels = accepted.get('channels')
+    if isinstance(channels, (int, long)) and channels >= 1:
+        accepted['channels'] = min(channels, MAX_CHANNELS)
     else:
-        remote_outdated = True
-        old_bag = set()
-        if remote_base_version != 0:
-            with archive.open_version_read(remote_base_version) as f:
-                old_bag.update(read_version_file(f))
-
-    remote.send('waiting_for_files')
-
-    temp_version_file = StringIO()
-    client_bag = set()
-
-    while True:
+        accepted.pop('channels', None)
+    log.debug("Capabilities: %r", accepted)
+    remote.send('capabilities', accepted)
+    remote.batching = 'batching' in accepted
+    if 'compression' in accepted:
+        remote.set_compression(accepted['compression'])
+    if 'framing' in accepted:
+        remote.set_framing(accepted['framing'])
+    return accepted
+
+def send_blob(archive, remote, checksum, size, offset=0):
+    """ Send a blob's contents, starting at byte `offset`. If it's stored
+    compressed with the codec negotiated with the client, the stored
+    stream goes out as it is. """
+    if remote.compression is not None and not offset:
+        codec = remote.compression['codec']
+        with archive.data_pool.read_compressed(checksum, codec) as f:
+            if f is not None:
+                remote.send_compressed_file(f, size)
+                return
+    with archive.read_file(checksum) as f:
+        if offset:
+            f.seek(offset)
+        remote.send_file(f)
+
+def serve_blobs(archive, remote):
+    """
+    Serve a blob channel: an extra connection, opened next to a sync
+    session with the 'channels' capability, that only moves blobs.
+    Channels keep no state; the sync session says which blobs to move
+    and checks that they arrived.
+    """
+    msg, payload = remote.recv()
+    if msg == 'capabilities':
+        accept_capabilities(remote, payload, BLOB_CHANNEL_CAPABILITIES)
         msg, payload = remote.recv()
-        if msg == 'done':
-            break
-
-        assert msg == 'file_meta'
-        client_bag.add(payload)
-
-    for i in client_bag:
-        if i.checksum not in archive:
-            log.debug("Downloading data for %s (size: %r, path: %r)",
-                      i.checksum, i.size, i.path)
-            remote.send('data', i.checksum)
-            with archive.write_file(i.checksum) as bf:
+    while msg != 'quit':
+        if msg == 'blob_put':
+            log.debug("Channel receiving blob %s", payload)
+            with archive.write_partial(payload, restart=True) as (bf, offset):
                 remote.recv_file(bf)
+        elif msg == 'blob_get_many':
+            # entries are (checksum, size), or (checksum, size, offset)
+            # to resume a download
+            for entry in payload:
+                log.debug("Channel sending blob %s", entry[0])
+                send_blob(archive, remote, *entry)
+        elif msg == 'blob_flush':
+            remote.send('blob_flushed')
+        else:
+            assert False, "unexpected message %r" % msg
+        msg, payload = remote.recv()
+    remote.send('bye')
 
-    if remote_outdated:
-        log.debug("Client was at old version, performing merge")
+class SyncSession(object):
+    """
+    Server side of a sync session: receive the client's file list, ask
+    for missing blobs, merge with the latest version, commit, and send
+    the client what changed.
+    """
+
+    def __init__(self, archive, remote):
+        self.archive = archive
+        self.remote = remote
+        self.capabilities = {}
+        self.base_trees = []
+        self.base_version = 0
+        self.client_partials = {} # checksum -> bytes the client has
+        self.pending = set() # checksums of blobs still to receive
+        self.checkpoint_bytes = 0
+        self.checkpoint_time = time()
+
+    def negotiate(self):
+        """ Handle the optional 'capabilities' message; returns the
+        payload of the 'sync' message that follows. """
+        msg, payload = self.remote.recv()
+        if msg == 'capabilities':
+            self.capabilities = accept_capabilities(self.remote, payload)
+            msg, payload = self.remote.recv()
+        assert msg == 'sync'
+        return payload
+
+    def receive_client_bag(self, base_bag):
+        """
+        Receive the client's file list. With the 'status_delta' or
+        'merkle' capability the client only sends its changes since
+        `base_bag`; for 'merkle' it first asks for folders of the base
+        version's Merkle tree, to find out what changed. Returns the
+        client's file list and the file items that were sent, which may
+        need uploading.
+        """
+        send_changes = ('status_delta' in self.capabilities or
+                        'merkle' in self.capabilities)
+        if send_changes:
+            client_tree = file_item_tree(base_bag)
+        else:
+            client_tree = {}
+        received = []
+        base_merkle = None
+        while True:
+            msg, payload = self.remote.recv()
+            if msg == 'done':
+                break
+
+            elif msg == 'merkle_get':
+                assert 'merkle' in self.capabilities
+                if base_merkle is None:
+                    base_merkle = self.archive.merkle_tree(self.base_version)
+                self.remote.send('merkle_nodes', dict(
+                    (folder, base_merkle[folder][1]
+                             if folder in base_merkle else None)
+                    for folder in payload))
+
+            elif msg == 'file_removed':
+                assert send_changes
+                del client_tree[payload]
+
+            elif msg == 'partial_downloads':
+                assert 'resume' in self.capabilities
+                self.client_partials = payload
+
+            else:
+                assert msg == 'file_meta'
+                client_tree[payload.path] = payload
+                received.append(payload)
+
+        return set(client_tree.itervalues()), received
+
+    def delta_base(self, file_item):
+        """ Find a stored file at the same path as `file_item` that can
+        serve as base for a delta transfer. """
+        if ('delta' not in self.capabilities or
+                file_item.size < DELTA_FILE_SIZE):
+            return None
+        for tree in self.base_trees:
+            base = tree.get(file_item.path)
+            if (base is not None and base.checksum != file_item.checksum and
+                    base.size >= DELTA_FILE_SIZE and
+                    base.checksum in self.archive):
+                return base
+        return None
+
+    def receive_blob(self, file_item):
+        log.debug("Downloading data for %s (size: %r, path: %r)",
+                  file_item.checksum, file_item.size, file_item.path)
+        base = self.delta_base(file_item)
+        if base is not None:
+            self.receive_delta_blob(file_item, base)
+        elif ('chunking' in self.capabilities and
+                file_item.size >= CHUNKED_FILE_SIZE):
+            self.receive_chunked_blob(file_item)
+        else:
+            restart = 'resume' not in self.capabilities
+            with self.archive.write_partial(file_item.checksum,
+                                            restart) as (bf, offset):
+                if offset:
+                    log.debug("Resuming upload at byte %d", offset)
+                    self.remote.send('data_from', (file_item.checksum, offset))
+                else:
+                    self.remote.send('data', file_item.checksum)
+                self.remote.recv_file(bf)
+
+    def receive_blobs(self, file_items):
+        """
+        Receive the blobs of `file_items` that are missing from the
+        archive. With the 'pipelining' capability, blobs that are sent
+        whole are asked for in windows of `PIPELINE_WINDOW` checksums;
+        the next window is requested before the current one is read, so
+        the client can send blobs back to back.
+        """
+        seen = self.archive.contains_many(i.checksum for i in file_items)
+        wanted = []
+        for i in file_items:
+            if i.checksum in seen:
+                continue
+            seen.add(i.checksum)
+            wanted.append(i)
+
+        self.pending = set(i.checksum for i in wanted)
+
+        if 'pipelining' not in self.capabilities:
+            for i in wanted:
+                self.receive_blob(i)
+                self.blob_received(i)
+            return
+
+        whole = []
+        for i in wanted:
+            if (self.delta_base(i) is not None or
+                    ('resume' in self.capabilities and
+                     self.archive.partial_size(i.checksum)) or
+                    ('chunking' in self.capabilities and
+                     i.size >= CHUNKED_FILE_SIZE)):
+                self.receive_blob(i) # needs a conversation of its own
+                self.blob_received(i)
+            else:
+                whole.append(i)
+
+        if 'channels' in self.capabilities:
+            self.receive_blobs_via_channels(whole)
+            return
+
+        windows = [whole[n:n + PIPELINE_WINDOW]
+                   for n in range(0, len(whole), PIPELINE_WINDOW)]
+        for n, window in enumerate(windows):
+            if n == 0:
+                self.remote.send('data_many', [i.checksum for i in window])
+            if n + 1 < len(windows):
+                self.remote.send('data_many', [i.checksum
+                                               for i in windows[n + 1]])
+            for i in window:
+                log.debug("Downloading data for %s (size: %r, path: %r)",
+                          i.checksum, i.size, i.path)
+                with self.archive.write_partial(i.checksum,
+                                                restart=True) as (bf, offset):
+                    self.remote.recv_file(bf)
+                self.blob_received(i)
+
+    def receive_blobs_via_channels(self, file_items):
+        """ Have the client upload blobs over its blob channels, then
+        check that they are all stored. """
+        if not file_items:
+            return
+        self.remote.send('data_via_channels', [i.checksum for i in file_items])
+        msg, payload = self.remote.recv()
+        assert msg == 'data_via_channels_done'
+        checksums = set(i.checksum for i in file_items)
+        missing = checksums - self.archive.contains_many(checksums)
+        assert not missing, "blobs not uploaded: %r" % sorted(missing)
+
+    def send_local_copies(self, client_bag, new_files, delta_paths):
+        """
+        With the 'local_copy' capability, the client makes new files
+        whose contents it already has by copying the local file, before
+        any local file is removed. Returns the files that still need to
+        be sent: those the client doesn't have, and those it failed to
+        copy.
+        """
+        client_paths = dict((i.checksum, i.path) for i in client_bag)
+        remaining = []
+        copied = []
+        for new_file in new_files:
+            source_path = client_paths.get(new_file.checksum)
+            if source_path is None or new_file.path in delta_paths:
+                remaining.append(new_file)
+                continue
+            log.debug("Asking client to copy %r to %r",
+                      source_path, new_file.path)
+            self.remote.send_batched('file_copy', (source_path, new_file))
+            copied.append(new_file)
+        if not copied:
+            return new_files
+
+        self.remote.send('file_copy_done')
+        msg, failed = self.remote.recv()
+        assert msg == 'file_copy_failed'
+        log.debug("Client failed to copy %d files", len(failed))
+        failed = set(failed)
+        remaining += [i for i in copied if i.path in failed]
+        return sorted(remaining, key=operator.attrgetter('path'))
+
+    def receive_chunked_blob(self, file_item):
+        """ Ask for the chunk list of a blob, then only for the chunks
+        that are not stored yet. """
+        self.remote.send('data_chunks', file_item.checksum)
+        msg, chunks = self.remote.recv()
+        assert msg == 'file_chunks'
+
+        seen = self.archive.contains_many(c for c, size in chunks)
+        wanted = []
+        for chunk_checksum, size in chunks:
+            if chunk_checksum not in seen:
+                seen.add(chunk_checksum)
+                wanted.append(chunk_checksum)
+        log.debug("Blob %s has %d chunks, %d missing",
+                  file_item.checksum, len(chunks), len(wanted))
+
+        self.remote.send('want_chunks', wanted)
+        for chunk_checksum in wanted:
+            with self.archive.write_file(chunk_checksum) as bf:
+                self.remote.recv_file(bf)
+        self.archive.write_recipe(file_item.checksum, chunks)
+
+    def receive_delta_blob(self, file_item, base):
+        """ Send signatures of `base` and receive the blob as a delta. """
+        log.debug("Receiving %s as delta against %s",
+                  file_item.checksum, base.checksum)
+        block_size = block_size_for(base.size)
+        with self.archive.read_file(base.checksum) as base_file:
+            blocks = signatures(base_file, block_size)
+        self.remote.send('data_delta', (file_item.checksum,
+                                        {'block_size': block_size,
+                                         'blocks': blocks}))
+
+        with self.archive.read_file(base.checksum) as base_file:
+            with self.archive.write_file(file_item.checksum) as bf:
+                apply_delta(base_file, block_size,
+                            self.remote.recv_delta(), bf)
+
+    def send_delta_file(self, file_item):
+        """ Send a file that the client has an older version of, as a
+        delta against that version. """
+        log.debug("Sending file %s for path %r as delta",
+                  file_item.checksum, file_item.path)
+        self.remote.send('file_delta_begin', file_item)
+        msg, payload = self.remote.recv()
+        assert msg == 'delta_signatures'
+        with self.archive.read_file(file_item.checksum) as f:
+            self.remote.send_delta(iter_delta(f, payload['block_size'],
+                                              payload['blocks']))
+
+    def merge(self, old_bag, client_bag, server_bag):
+        """ Merge the client's changes since `old_bag` with the server's;
+        files changed on both sides are kept, the server's copy under a
+        new name. """
         for file_item in old_bag - client_bag:
             log.debug("Removed by client: %r", file_item)
         for file_item in client_bag - old_bag:
             log.debug("Added by client: %r", file_item)
 
-        if old_bag == client_bag:
-            current_version = latest_version
-            log.debug("Client was outdated but had no changes, "
-                      "staying at version %d", current_version)
-
-            new_server_bag = server_bag
-
-        else:
-            current_version = latest_version + 1
-            m = calculate_merge(old_bag, client_bag, server_bag)
-            new_tree, conflict = m
-
-            new_server_bag = set(new_tree.itervalues())
-
-            for i in conflict:
-                for c in count(1):
-                    new_path = '%s.%d' % (i.path, c)
-                    if new_path not in new_tree:
-                        break
-                renamed_file = FileItem(new_path, i.checksum, i.size, i.time)
-                new_tree[renamed_file.path] = renamed_file
-                new_server_bag.add(renamed_file)
-
-            log.debug("Client was outdated and had changes, "
-                      "creating new version %d", current_version)
-            with archive.open_version_write(current_version) as f:
-                dump_fileitems(f, new_server_bag)
-
-        for removed_file in client_bag - new_server_bag:
-            assert removed_file.checksum in archive
-            log.debug("Asking client to remove %s (size: %r, path: %r)",
-                      removed_file.checksum, removed_file.size,
-                      removed_file.path)
-            remote.send('file_remove', removed_file)
-
-        for new_file in new_server_bag - client_bag:
-            log.debug("Sending file %s for path %r",
-                      new_file.checksum, new_file.path)
-            remote.send('file_begin', new_file)
-            with archive.read_file(new_file.checksum) as f:
-                remote.send_file(f)
-
-    else:
-        if server_bag == client_bag:
-            current_version = latest_version
-            log.debug("Client has no changes, staying at version %d",
-                      current_version)
+        new_tree, conflict = calculate_merge(old_bag, client_bag, server_bag)
+        new_server_bag = set(new_tree.itervalues())
+        for i in conflict:
+            for c in count(1):
+                new_path = '%s.%d' % (i.path, c)
+                if new_path not in new_tree:
+                    break
+            renamed_file = FileItem(new_path, i.checksum, i.size, i.time)
+            new_tree[renamed_file.path] = renamed_file
+            new_server_bag.add(renamed_file)
+        return new_server_bag
+
+    def blob_received(self, file_item):
+        """ Note that the blob of `file_item` is stored. With the
+        'checkpoint' capability, commit a checkpoint once enough data
+        or time went by since the last one. """
+        self.pending.discard(file_item.checksum)
+        if 'checkpoint' not in self.capabilities or not self.pending:
+            return
+        self.checkpoint_bytes += file_item.size
+        limits = self.capabilities['checkpoint']
+        if (self.checkpoint_bytes >= limits.get('bytes', float('inf')) or
+                time() - self.checkpoint_time >=
+                limits.get('seconds', float('inf'))):
+            self.checkpoint()
+            self.checkpoint_bytes = 0
+            self.checkpoint_time = time()
+
+    def checkpoint(self):
+        """
+        Commit the client's changes whose blobs are stored. If the
+        version is made directly on top of the client's base version,
+        the client saves it as its ``last_sync``, with the paths still
+        pending at their old versions, and the rest of the sync carries
+        on from there.
+        """
+        old_tree = file_item_tree(self.old_bag)
+        bag = set()
+        pending_paths = {} # path -> file item in the checkpoint, or None
+        for i in self.client_bag:
+            if i.checksum in self.pending:
+                pending_paths[i.path] = old_tree.get(i.path)
+                if pending_paths[i.path] is not None:
+                    bag.add(pending_paths[i.path])
+            else:
+                bag.add(i)
+
+        version, new_bag = self.commit(bag)
+        if version == self.latest_version:
+            return
+        log.debug("Checkpoint: committed version %d, %d blobs pending",
+                  version, len(self.pending))
+        if self.latest_version == self.base_version:
+            self.remote.send('checkpoint', (version, pending_paths))
+            self.base_version = version
+            self.old_bag = new_bag
+        self.latest_version = version
+        self.server_bag = new_bag
+
+    def commit(self, client_bag):
+        """
+        Commit the client's changes from `old_bag` to `client_bag` on
+        top of the latest version, merging them again if another sync
+        commits first. Returns the version number, which stays the same
+        if there is nothing to commit, and its file list. Afterwards,
+        `latest_version` and `server_bag` are those of the parent.
+        """
+        # Blobs are received without holding any lock, so other syncs
+        # can run alongside; if one of them commits first, merge again
+        # with the version it made.
+        while True:
+            if self.old_bag == client_bag:
+                log.debug("Client has no changes, staying at version %d",
+                          self.latest_version)
+                return self.latest_version, self.server_bag
+
+            if self.base_version == self.latest_version:
+                new_server_bag = client_bag
+            else:
+                log.debug("Client was at old version, performing merge")
+                new_server_bag = self.merge(self.old_bag, client_bag,
+                                            self.server_bag)
+
+            version = self.archive.commit_version(
+                new_server_bag, self.latest_version, self.server_bag)
+            if version is not None:
+                log.debug("Client has changes, created new version %d",
+                          version)
+                return version, new_server_bag
+
+            self.latest_version = self.archive.get_latest_version()
+            log.debug("Another sync committed first, merging with "
+                      "version %d", self.latest_version)
+            self.server_bag = self.archive.read_version(self.latest_version)
+
+    def run(self):
+        archive = self.archive
+        remote = self.remote
+
+        self.base_version = self.negotiate()
+        self.latest_version = archive.get_latest_version()
+
+        log.debug("Begin sync at version %d, client last_sync is %d",
+                  self.latest_version, self.base_version)
+
+        self.server_bag = archive.read_version(self.latest_version)
+
+        if self.base_version == self.latest_version:
+            self.old_bag = self.server_bag
+        elif self.base_version == 0:
+            self.old_bag = set()
         else:
-            current_version = latest_version + 1
-            log.debug("Client has changes, creating new version %d",
-                      current_version)
-            with archive.open_version_write(current_version) as f:
-                dump_fileitems(f, client_bag)
-
-        new_server_bag = client_bag
+            self.old_bag = archive.read_version(self.base_version)
+
+        remote.send('waiting_for_files')
+
+        client_bag, received = self.receive_client_bag(self.old_bag)
+        self.client_bag = client_bag
+        self.base_trees = [file_item_tree(self.old_bag),
+                           file_item_tree(self.server_bag)]
+
+        self.receive_blobs(received)
+
+        current_version, new_server_bag = self.commit(client_bag)
+        server_bag = self.server_bag
+
+        if self.base_version != self.latest_version:
+            client_tree = file_item_tree(client_bag)
+            path_key = operator.attrgetter('path')
+            new_files = sorted(new_server_bag - client_bag, key=path_key)
+            delta_paths = set()
+            if 'delta' in self.capabilities:
+                for new_file in new_files:
+                    old_file = client_tree.get(new_file.path)
+                    if (old_file is not None and
+                            min(old_file.size, new_file.size) >=
+                            DELTA_FILE_SIZE):
+                        delta_paths.add(new_file.path)
+
+            if 'local_copy' in self.capabilities:
+                new_files = self.send_local_copies(client_bag, new_files,
+                                                   delta_paths)
+
+            for removed_file in sorted(client_bag - new_server_bag,
+                                       key=path_key):
+                if removed_file.path in delta_paths:
+                    continue # the delta replaces it
+                assert removed_file.checksum in archive
+                log.debug("Asking client to remove %s (size: %r, path: %r)",
+                          removed_file.checksum, removed_file.size,
+                          removed_file.path)
+                remote.send_batched('file_remove', removed_file)
+
+            channel_files = []
+            sent_paths = {} # checksum -> path, to copy duplicates from
+            duplicates = []
+            # a partial download can only be resumed into one of the
+            # files with its contents
+            checksum_count = Counter(i.checksum for i in new_files)
+            for new_file in new_files:
+                if new_file.path in delta_paths:
+                    self.send_delta_file(new_file)
+                    continue
+                if ('local_copy' in self.capabilities and
+                        new_file.checksum in sent_paths):
+                    duplicates.append((sent_paths[new_file.checksum],
+                                       new_file))
+                    continue
+                sent_paths[new_file.checksum] = new_file.path
+                if 'channels' in self.capabilities:
+                    channel_files.append(new_file)
+                    continue
+                log.debug("Sending file %s for path %r",
+                          new_file.checksum, new_file.path)
+                offset = 0
+                if checksum_count[new_file.checksum] == 1:
+                    offset = self.client_partials.get(new_file.checksum, 0)
+                if 0 < offset <= new_file.size:
+                    remote.send('file_begin_at', (new_file, offset))
+                else:
+                    offset = 0
+                    remote.send('file_begin', new_file)
+                send_blob(archive, remote, new_file.checksum, new_file.size,
+                          offset)
+            if channel_files:
+                log.debug("Client fetches %d files over its channels",
+                          len(channel_files))
+                remote.send('files_via_channels', channel_files)
+            for source_path, new_file in duplicates:
+                remote.send_batched('file_copy', (source_path, new_file))
+
+        log.debug("Sync complete")
+        remote.send('sync_complete', current_version)
+
+        remote.send('commit_diff', {
+            'added': new_server_bag - server_bag,
+            'removed': server_bag - new_server_bag,
+        })
 
-    log.debug("Sync complete")
-    remote.send('sync_complete', current_version)
-
-    remote.send('commit_diff', {
-        'added': new_server_bag - server_bag,
-        'removed': server_bag - new_server_bag,
-    })
+        msg, payload = remote.recv()
+        assert msg == 'quit'
+        remote.send('bye')
 
-    msg, payload = remote.recv()
-    assert msg == 'quit'
-    remote.send('bye')
+def server_sync(archive, remote):
+    SyncSession(archive, remote).run()
 
 def calculate_merge(old_bag, client_bag, server_bag):
     """
@@ -201,7 +889,9 @@ def calculate_merge(old_bag, client_bag, server_bag):
      -----------+-------------+-------------+-------------+
         changed | keep client | keep client | keep both * |
 
-    "keep both" means conflict, and one of the files must be renamed.
+    "keep both" means conflict, and one of the files must be renamed,
+    unless both sides made the same change (as when a sync commits a
+    checkpoint, then merges the rest of its changes with it).
 
     """
     client_tree = file_item_tree(client_bag)
@@ -229,9 +919,10 @@ def calculate_merge(old_bag, client_bag, server_bag):
         new_tree[p] = server_tree[p]
 
     for p in client_paths & server_paths - old_paths:
-        # new files on both (conflict)
+        # new files on both (conflict, unless they're the same)
         new_tree[p] = client_tree[p]
-        conflict.add(server_tree[p])
+        if server_tree[p] != client_tree[p]:
+            conflict.add(server_tree[p])
 
     for p in old_paths:
         old_item = old_tree.get(p)
@@ -273,11 +964,15 @@ def calculate_merge(old_bag, client_bag, server_bag):
                 # don't delete, use client version
                 new_tree[p] = client_item
 
-            else:
+            elif server_item != client_item:
                 # changed on both; conflict
                 new_tree[p] = client_item
                 conflict.add(server_item)
 
+            else:
+                # same change on both
+                new_tree[p] = client_item
+
     return new_tree, conflict
 
 
@@ -292,14 +987,50 @@ def try_except_send_remote(remote):
         except:
             error_report = "[exception while formatting traceback]"
         remote.send('error', error_report)
+        remote.flush()
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root_path",
+        help="path of the server archive")
+    parser.add_argument("--blobs",
+        action="store_true", dest="blobs", default=False,
+        help="serve a blob channel instead of a sync session")
+    parser.add_argument("--daemon",
+        action="store_true", dest="daemon", default=False,
+        help="keep running, serving sessions over ROOT/daemon.sock")
+    parser.add_argument("-d", "--detach",
+        action="store_true", dest="detach", default=False,
+        help="with --daemon, run in the background")
+    return parser.parse_args()
 
 def main():
-    assert len(sys.argv) == 2
-    root_path = path.join(sys.argv[1])
+    """ Serve a sync session (or a blob channel) on stdin/stdout; if a
+    daemon is running for the archive, relay to it. """
+    args = parse_args()
+    root_path = args.root_path
 
     logging.basicConfig(level=logging.DEBUG,
                         filename=path.join(root_path, 'debug.log'))
-    remote = picklemsg.Remote(sys.stdin, sys.stdout)
 
+    from daemon import Daemon, connect, relay
+    if args.daemon:
+        daemon = Daemon(root_path)
+        daemon.listen()
+        if args.detach:
+            from journal import detach
+            detach()
+        daemon.serve_forever()
+        return
+
+    sock = connect(root_path)
+    if sock is not None:
+        relay(sock, 'blobs' if args.blobs else 'sync',
+              sys.stdin.fileno(), sys.stdout.fileno())
+        return
+
+    remote = picklemsg.Remote(sys.stdin, sys.stdout)
     with try_except_send_remote(remote):
-        server_sync(Archive(root_path), remote)
+        serve = serve_blobs if args.blobs else server_sync
+        serve(Archive(root_path), remote)
+        remote.flush()
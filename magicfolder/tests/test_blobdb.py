@@ -2,6 +2,7 @@ import unittest
 import tempfile
 import shutil
 import os
+import zlib
 from os import path
 from hashlib import sha1
 
@@ -59,3 +60,291 @@ class BackupTest(unittest.TestCase):
                         '401c39cd3c0d373f0a7a' in test_backup)
         self.assertTrue('62a837970950bf34fb0c'
                         '00000000000000000000' not in test_backup)
+
+    def test_recipe(self):
+        db = BlobDB(self.tmpdir)
+        backup_the_files(db)
+        whole = data['f1'] + data['f2']
+        chunks = [(sha['f1'], len(data['f1'])), (sha['f2'], len(data['f2']))]
+        db.write_recipe(sha1(whole).hexdigest(), chunks)
+
+        self.assertTrue(sha1(whole).hexdigest() in db)
+        self.assertEqual(db.read_recipe(sha1(whole).hexdigest()), chunks)
+        with db.read_file(sha1(whole).hexdigest()) as f:
+            self.assertEqual(f.read(3), 'fil')
+            self.assertEqual(f.read(), whole[3:])
+
+    def test_recipe_seek(self):
+        db = BlobDB(self.tmpdir)
+        backup_the_files(db)
+        whole = data['f1'] + data['f2']
+        chunks = [(sha['f1'], len(data['f1'])), (sha['f2'], len(data['f2']))]
+        db.write_recipe(sha1(whole).hexdigest(), chunks)
+        with db.read_file(sha1(whole).hexdigest()) as f:
+            for offset in [10, 0, 8, 3, len(whole)]:
+                f.seek(offset)
+                self.assertEqual(f.read(), whole[offset:])
+
+    def test_bad_recipe(self):
+        db = BlobDB(self.tmpdir)
+        backup_the_files(db)
+        chunks = [(sha['f1'], len(data['f1']))]
+        self.assertRaises(AssertionError, db.write_recipe, sha['f2'], chunks)
+        self.assertFalse(sha['f2'] in db and db.read_recipe(sha['f2']))
+
+    def test_partial_upload(self):
+        db = BlobDB(self.tmpdir, compression={'codec': 'zlib', 'level': 6})
+        def upload(data, fail=False):
+            with db.write_partial(sha['f3']) as (f, offset):
+                f.write(data[offset:])
+                if fail:
+                    raise IOError("connection lost")
+            return offset
+
+        self.assertRaises(IOError, upload, data['f3'][:4], fail=True)
+        self.assertEqual(db.partial_size(sha['f3']), 4)
+        self.assertFalse(sha['f3'] in db)
+        self.assertEqual(upload(data['f3']), 4)
+        self.assertEqual(db.partial_size(sha['f3']), 0)
+        with db.read_file(sha['f3']) as f:
+            self.assertEqual(f.read(), data['f3'])
+
+        # a partial upload that doesn't add up is thrown away
+        self.assertRaises(IOError, upload, 'file', fail=True)
+        self.assertRaises(AssertionError, upload, 'fileX')
+        self.assertEqual(db.partial_size(sha['f3']), 0)
+
+    def test_failed_write_cleaned_up(self):
+        db = BlobDB(self.tmpdir)
+        def write():
+            with db.write_file(sha['f1']) as f:
+                f.write('file')
+                raise IOError("connection lost")
+        self.assertRaises(IOError, write)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_compressed_blobs(self):
+        zlib_settings = {'codec': 'zlib', 'level': 6}
+        backup_the_files(BlobDB(self.tmpdir), ['f1'])
+        db = BlobDB(self.tmpdir, compression=zlib_settings)
+        backup_the_files(db, ['f2', 'f3'])
+        big = 'compressible ' * 20000
+        with db.write_file() as f:
+            f.write(big)
+        big_sha = sha1(big).hexdigest()
+
+        self.assertTrue(path.isfile(db.blob_path(sha['f2'], 'zlib')))
+        self.assertTrue(path.getsize(db.blob_path(big_sha, 'zlib')) <
+                        len(big) / 10)
+        self.assertEqual(sorted(db.iter_checksums()),
+                         sorted(sha.values() + [big_sha]))
+        for name in data:
+            self.assertTrue(sha[name] in db)
+            with db.read_file(sha[name]) as f:
+                self.assertEqual(f.read(), data[name])
+        with db.read_file(big_sha) as f:
+            for offset in [100000, 5, 200000, len(big)]:
+                f.seek(offset)
+                self.assertEqual(f.read(7), big[offset:offset + 7])
+
+        with db.read_compressed(sha['f2'], 'zlib') as f:
+            self.assertEqual(zlib.decompress(f.read()), data['f2'])
+        with db.read_compressed(sha['f1'], 'zlib') as f:
+            self.assertTrue(f is None)
+
+        # recipes over compressed chunks
+        whole = data['f2'] + data['f3']
+        chunks = [(sha['f2'], len(data['f2'])), (sha['f3'], len(data['f3']))]
+        db.write_recipe(sha1(whole).hexdigest(), chunks)
+        with db.read_file(sha1(whole).hexdigest()) as f:
+            f.seek(12)
+            self.assertEqual(f.read(), whole[12:])
+
+class PackTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def loose_files(self):
+        return [name for bucket in os.listdir(self.tmpdir) if len(bucket) == 2
+                for name in os.listdir(path.join(self.tmpdir, bucket))]
+
+    def test_repack(self):
+        db = BlobDB(self.tmpdir)
+        backup_the_files(db, ['f1', 'f2'])
+        big = 'x' * 1000
+        with db.write_file() as f:
+            f.write(big)
+        big_sha = sha1(big).hexdigest()
+
+        self.assertEqual(db.repack(max_size=100), 2)
+        self.assertEqual(self.loose_files(), [big_sha[2:]])
+        self.assertEqual(len(os.listdir(db.pack_folder)), 2)
+
+        backup_the_files(db, ['f3'])
+        self.assertEqual(db.repack(max_size=100), 1)
+        # the first pack is small enough to be merged in
+        self.assertEqual(len(db.packs()), 1)
+        self.assertEqual(db.repack(max_size=100), 0)
+
+        for db in [db, BlobDB(self.tmpdir)]:
+            for name in data:
+                self.assertTrue(sha[name] in db)
+                with db.read_file(sha[name]) as f:
+                    f.seek(2)
+                    self.assertEqual(f.read(), data[name][2:])
+            self.assertFalse(sha1('missing').hexdigest() in db)
+            self.assertEqual(sorted(db.iter_checksums()),
+                             sorted(sha.values() + [big_sha]))
+
+    def test_pack_count_stays_logarithmic(self):
+        db = BlobDB(self.tmpdir)
+        big = 'x' * 1000
+        with db.write_file() as f:
+            f.write(big)
+        db.repack(max_size=2000)
+        big_pack = db.packs()[0].pack_path
+
+        contents = ['blob %03d' % i for i in range(40)]
+        for content in contents:
+            with db.write_file() as f:
+                f.write(content)
+            db.repack(max_size=100)
+            self.assertTrue(len(db.packs()) <= 6)
+        # far bigger than everything else, so never rewritten
+        self.assertTrue(big_pack in [pack.pack_path for pack in db.packs()])
+
+        db = BlobDB(self.tmpdir)
+        for content in contents + [big]:
+            with db.read_file(sha1(content).hexdigest()) as f:
+                self.assertEqual(f.read(), content)
+        self.assertEqual(len(list(db.iter_checksums())), 41)
+
+    def test_packed_reader_is_bounded(self):
+        db = BlobDB(self.tmpdir)
+        backup_the_files(db)
+        db.repack()
+        with db.read_file(sha['f2']) as f:
+            self.assertEqual(f.read(4), 'file')
+            self.assertEqual(f.read(), ' two')
+            self.assertEqual(f.read(), '')
+            f.seek(100)
+            self.assertEqual(f.read(), '')
+
+    def test_repack_compressed(self):
+        db = BlobDB(self.tmpdir, compression={'codec': 'zlib'})
+        backup_the_files(db)
+        db.repack()
+        self.assertEqual(self.loose_files(), [])
+        with db.read_file(sha['f1']) as f:
+            self.assertEqual(f.read(), data['f1'])
+        with db.read_compressed(sha['f1'], 'zlib') as f:
+            self.assertEqual(zlib.decompress(f.read()), data['f1'])
+        with db.read_compressed(sha['f1'], 'bz2') as f:
+            self.assertTrue(f is None)
+
+        # recipes over packed chunks
+        whole = data['f2'] + data['f3']
+        chunks = [(sha['f2'], len(data['f2'])), (sha['f3'], len(data['f3']))]
+        db.write_recipe(sha1(whole).hexdigest(), chunks)
+        with db.read_file(sha1(whole).hexdigest()) as f:
+            self.assertEqual(f.read(), whole)
+
+class ObjectIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db_path = path.join(self.tmpdir, 'objects')
+        self.index_path = path.join(self.tmpdir, 'objects.idx')
+        os.mkdir(self.db_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def indexed_db(self):
+        return BlobDB(self.db_path, self.index_path)
+
+    def test_index_built_from_store(self):
+        backup_the_files(BlobDB(self.db_path), ['f1', 'f2'])
+        db = self.indexed_db()
+        self.assertTrue(sha['f1'] in db.index)
+        self.assertFalse(sha['f3'] in db.index)
+        self.assertEqual(os.path.getsize(self.index_path), 40)
+        self.assertEqual(db.contains_many(sha.values()),
+                         set([sha['f1'], sha['f2']]))
+
+    def test_index_updated_on_write(self):
+        db = self.indexed_db()
+        self.assertFalse(sha['f1'] in db)
+        backup_the_files(db, ['f1'])
+        self.assertTrue(sha['f1'] in db.index)
+        self.assertTrue(sha['f1'] in self.indexed_db().index)
+
+        whole = data['f1'] + data['f1']
+        db.write_recipe(sha1(whole).hexdigest(),
+                        [(sha['f1'], len(data['f1']))] * 2)
+        self.assertTrue(sha1(whole).hexdigest() in self.indexed_db().index)
+
+    def backdate_index(self):
+        mtime = path.getmtime(self.db_path) - 10
+        os.utime(self.index_path, (mtime, mtime))
+
+    def test_stale_index(self):
+        self.indexed_db().contains_many([])
+        # written without updating the index
+        backup_the_files(BlobDB(self.db_path), ['f2'])
+        self.backdate_index()
+        db = self.indexed_db()
+        self.assertEqual(db.contains_many([sha['f1'], sha['f2']]),
+                         set([sha['f2']]))
+        self.assertEqual(os.path.getsize(self.index_path), 20)
+
+    def test_stale_index_noticed_while_open(self):
+        db = self.indexed_db()
+        self.assertFalse(sha['f2'] in db)
+        backup_the_files(BlobDB(self.db_path), ['f2'])
+        self.backdate_index()
+        self.assertTrue(sha['f2'] in db)
+
+    def test_index_is_authoritative(self):
+        db = self.indexed_db()
+        db.contains_many([])
+        backup_the_files(db, ['f1'])
+        mtime = path.getmtime(self.db_path)
+        # slipped into the store without bumping its mtime
+        backup_the_files(BlobDB(self.db_path), ['f2'])
+        os.utime(self.db_path, (mtime, mtime))
+        self.assertFalse(sha['f2'] in db)
+        self.assertFalse(sha['f2'] in self.indexed_db())
+        self.assertEqual(db.contains_many([sha['f1'], sha['f2']]),
+                         set([sha['f1']]))
+
+    def test_log_merged_into_index(self):
+        from magicfolder import blobdb
+        self.addCleanup(setattr, blobdb, 'INDEX_LOG_MERGE',
+                        blobdb.INDEX_LOG_MERGE)
+        blobdb.INDEX_LOG_MERGE = 2
+        db = self.indexed_db()
+        backup_the_files(db)
+        self.assertEqual(os.path.getsize(self.index_path + '.log'), 60)
+
+        db = self.indexed_db()
+        self.assertEqual(db.contains_many(sha.values()), set(sha.values()))
+        self.assertEqual(os.path.getsize(self.index_path + '.log'), 0)
+        with open(self.index_path, 'rb') as f:
+            index_data = f.read()
+        self.assertEqual(index_data,
+                         ''.join(sorted(sha1(d).digest()
+                                        for d in data.values())))
+
+    def test_contains_many_large(self):
+        stored = sorted(sha1(str(i)).digest() for i in range(0, 2000, 3))
+        with open(self.index_path, 'wb') as f:
+            f.write(''.join(stored))
+        db = self.indexed_db()
+        queries = [sha1(str(i)).hexdigest() for i in range(2000)]
+        expected = set(sha1(str(i)).hexdigest() for i in range(0, 2000, 3))
+        self.assertEqual(db.index.contains_many(queries), expected)
+        for checksum in queries[::7]:
+            self.assertEqual(checksum in db.index, checksum in expected)
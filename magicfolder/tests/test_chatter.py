@@ -315,7 +315,7 @@ class ServerChatterTest(unittest.TestCase):
         })
         self.chat_server(test_chat)
         self.assertEqual(set(os.listdir(self.tmp_path + '/objects')),
-                         set(['83', 'ba']))
+                         set(['83', 'ba', 'partial']))
 
     def test_download_files(self):
         def test_chat(server):
@@ -454,14 +454,14 @@ class ServerChatterTest(unittest.TestCase):
 
             server.expect('file_remove', f1)
 
-            server.expect('file_begin', f2a_rename)
-            server.expect('file_chunk', f2a_data)
-            server.expect('file_end', None)
-
             server.expect('file_begin', f3_rename)
             server.expect('file_chunk', f3_data)
             server.expect('file_end', None)
 
+            server.expect('file_begin', f2a_rename)
+            server.expect('file_chunk', f2a_data)
+            server.expect('file_end', None)
+
             server.expect('sync_complete', 3)
             server.expect('commit_diff', {'added': set([f2b, f2a_rename,
                                                         f3a, f3_rename]),
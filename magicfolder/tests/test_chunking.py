@@ -0,0 +1,51 @@
+import unittest
+import os
+from StringIO import StringIO
+
+from magicfolder import chunking
+from magicfolder.chunking import iter_chunks, FileSlice
+
+class ChunkingTest(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(6 * 1024 * 1024)
+
+    def chunks(self, data):
+        return list(iter_chunks(StringIO(data)))
+
+    def test_chunks_cover_the_file(self):
+        chunks = self.chunks(self.data)
+        offset = 0
+        for chunk_offset, size, checksum in chunks:
+            self.assertEqual(chunk_offset, offset)
+            self.assertTrue(size <= chunking.MAX_CHUNK_SIZE)
+            offset += size
+        self.assertEqual(offset, len(self.data))
+        for chunk_offset, size, checksum in chunks[:-1]:
+            self.assertTrue(size >= chunking.MIN_CHUNK_SIZE)
+
+    def test_boundaries_follow_content(self):
+        chunks = self.chunks(self.data)
+        edited = self.data[:1000] + 'inserted' + self.data[1000:]
+        edited_chunks = self.chunks(edited)
+        unchanged = (set(c[2] for c in chunks) &
+                     set(c[2] for c in edited_chunks))
+        self.assertEqual(len(unchanged), len(chunks) - 1)
+
+    def test_small_and_empty_files(self):
+        self.assertEqual(self.chunks(''), [])
+        [(offset, size, checksum)] = self.chunks('hello')
+        self.assertEqual((offset, size), (0, 5))
+
+    def test_low_entropy_data(self):
+        chunks = self.chunks('\0' * (9 * 1024 * 1024))
+        self.assertEqual([size for offset, size, checksum in chunks],
+                         [4 * 1024 * 1024, 4 * 1024 * 1024, 1024 * 1024])
+
+    def test_file_slice(self):
+        f = FileSlice(StringIO('0123456789'), 3, 5)
+        self.assertEqual(f.read(2), '34')
+        self.assertEqual(f.read(), '567')
+        self.assertEqual(f.read(), '')
+
+if __name__ == '__main__':
+    unittest.main()
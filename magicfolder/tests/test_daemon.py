@@ -0,0 +1,84 @@
+import unittest
+import tempfile
+import shutil
+import os
+from os import path
+import threading
+
+from magicfolder.picklemsg import Remote
+from magicfolder.server import server_init
+from magicfolder.client import SyncClient, WorkingTree, client_init
+from magicfolder.daemon import Daemon, connect, relay
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.server_root = path.join(self.tmp_path, 'server')
+        os.mkdir(self.server_root)
+        server_init(self.server_root)
+        self.daemon = Daemon(self.server_root)
+        self.daemon.listen()
+        self.daemon_thread = threading.Thread(
+            target=self.daemon.serve_forever)
+        self.daemon_thread.start()
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.daemon_thread.join()
+        shutil.rmtree(self.tmp_path)
+
+    def client(self, name):
+        client_root = path.join(self.tmp_path, name)
+        os.mkdir(client_root)
+        client_init(client_root, 'unused')
+        return client_root
+
+    def sync_via_socket(self, client_root):
+        sock = connect(self.server_root)
+        sock.sendall('sync\n')
+        remote = Remote(sock.makefile('rb'), sock.makefile('wb', 0))
+        SyncClient(WorkingTree(client_root), remote).sync_with_remote()
+        sock.close()
+
+    def sync_via_relay(self, client_root):
+        c2r_read, c2r_write = os.pipe()
+        r2c_read, r2c_write = os.pipe()
+        relay_thread = threading.Thread(target=relay, args=(
+            connect(self.server_root), 'sync', c2r_read, r2c_write))
+        relay_thread.start()
+        remote = Remote(os.fdopen(r2c_read, 'rb'), os.fdopen(c2r_write, 'wb'))
+        SyncClient(WorkingTree(client_root), remote).sync_with_remote()
+        relay_thread.join()
+        remote.out_file.close()
+        remote.in_file.close()
+        os.close(c2r_read)
+        os.close(r2c_write)
+
+    def test_sync_sessions(self):
+        client_one = self.client('one')
+        with open(path.join(client_one, 'file'), 'wb') as f:
+            f.write('hello')
+        self.sync_via_socket(client_one)
+
+        client_two = self.client('two')
+        self.sync_via_relay(client_two)
+        with open(path.join(client_two, 'file'), 'rb') as f:
+            self.assertEqual(f.read(), 'hello')
+        # the latest version came from memory
+        self.assertTrue(1 in self.daemon.archive._version_cache)
+
+    def test_already_running(self):
+        self.assertRaises(RuntimeError, Daemon(self.server_root).listen)
+
+    def test_stale_socket(self):
+        self.daemon.shutdown()
+        self.daemon_thread.join()
+        with open(path.join(self.server_root, 'daemon.sock'), 'wb'):
+            pass
+        self.assertTrue(connect(self.server_root) is None)
+        self.daemon = Daemon(self.server_root)
+        self.daemon.listen()
+        self.daemon_thread = threading.Thread(
+            target=self.daemon.serve_forever)
+        self.daemon_thread.start()
+        self.assertTrue(connect(self.server_root) is not None)
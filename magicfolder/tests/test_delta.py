@@ -0,0 +1,89 @@
+import unittest
+import os
+import random
+from StringIO import StringIO
+from zlib import adler32
+
+from magicfolder import delta
+from magicfolder.delta import (signatures, iter_delta, apply_delta,
+                               block_size_for, weak_checksum, ADLER_MOD)
+
+def roundtrip(base, target, block_size=2048):
+    blocks = signatures(StringIO(base), block_size)
+    ops = list(iter_delta(StringIO(target), block_size, blocks))
+    out = StringIO()
+    apply_delta(StringIO(base), block_size, ops, out)
+    return out.getvalue(), ops
+
+def literal_bytes(ops):
+    return sum(len(op[1]) for op in ops if op[0] == 'literal')
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(0)
+        self.base = os.urandom(200 * 1024 + 123)
+
+    def test_rolling_checksum_matches_adler32(self):
+        data = bytearray(os.urandom(100))
+        n = 16
+        weak = weak_checksum(buffer(data, 0, n))
+        a, b = weak & 0xffff, weak >> 16
+        for pos in range(len(data) - n):
+            out_byte, in_byte = data[pos], data[pos + n]
+            a = (a - out_byte + in_byte) % ADLER_MOD
+            b = (b - n * out_byte + a - 1) % ADLER_MOD
+            self.assertEqual((b << 16) | a,
+                             adler32(str(data[pos + 1:pos + 1 + n]))
+                             & 0xffffffff)
+
+    def test_identical(self):
+        out, ops = roundtrip(self.base, self.base)
+        self.assertEqual(out, self.base)
+        self.assertEqual(ops, [('copy', 0, len(self.base) // 2048 + 1)])
+
+    def test_edits(self):
+        target = (self.base[:5000] + 'inserted' + self.base[5000:90000] +
+                  self.base[95000:150000] + 'x' + self.base[150001:])
+        out, ops = roundtrip(self.base, target)
+        self.assertEqual(out, target)
+        self.assertTrue(literal_bytes(ops) < 5 * 2048)
+
+    def test_unrelated_and_empty(self):
+        target = os.urandom(10000)
+        out, ops = roundtrip(self.base, target)
+        self.assertEqual(out, target)
+        self.assertEqual(literal_bytes(ops), len(target))
+
+        self.assertEqual(roundtrip('', target)[0], target)
+        self.assertEqual(roundtrip(self.base, '')[0], '')
+
+    def test_large_target(self):
+        # spans several reads of the sender's buffer
+        target = self.base * 30
+        out, ops = roundtrip(self.base, target, 4096)
+        self.assertEqual(out, target)
+        self.assertTrue(literal_bytes(ops) < 30 * 4096)
+
+    def test_gives_up_on_unrelated_data(self):
+        self.addCleanup(setattr, delta, 'DELTA_PROBE', delta.DELTA_PROBE)
+        delta.DELTA_PROBE = 128 * 1024
+        # the base comes after the probe, so it's not looked for
+        target = os.urandom(300 * 1024) + self.base
+        out, ops = roundtrip(self.base, target)
+        self.assertEqual(out, target)
+        self.assertEqual(literal_bytes(ops), len(target))
+        self.assertTrue(max(len(op[1]) for op in ops) <= delta.LITERAL_SIZE)
+
+        # mostly matching so far: keep scanning
+        target = self.base + os.urandom(300 * 1024) + self.base
+        out, ops = roundtrip(self.base, target)
+        self.assertEqual(out, target)
+        self.assertTrue(literal_bytes(ops) < 300 * 1024 + 2 * 2048)
+
+    def test_block_size(self):
+        self.assertEqual(block_size_for(0), 2048)
+        self.assertEqual(block_size_for(100 * 1024 * 1024), 10240)
+        self.assertEqual(block_size_for(10 ** 12), 128 * 1024)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+import threading
+import sys
+from time import time, sleep
+
+import py
+
+from magicfolder.journal import Journal, InotifyWatcher, RESCAN_ALL
+from magicfolder.checksum import repo_file_events, IgnoreRules
+
+class JournalScanTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = py.path.local.mkdtemp()
+        self.tmp.mkdir('.mf')
+        self.tmp.join('fa', 'one').write("file one", ensure=True)
+        self.tmp.join('fb', 'two').write("file two", ensure=True)
+        self.journal = Journal(str(self.tmp.join('.mf')))
+        self.lock_file = self.journal.hold_watcher_lock()
+        self.journal.set_watcher_id(self.lock_file, 'session-1')
+
+    def tearDown(self):
+        self.lock_file.close()
+        self.tmp.remove()
+
+    def scan(self):
+        return dict((i.path, i.size)
+                    for i in repo_file_events(str(self.tmp), True))
+
+    def test_only_journaled_paths_are_rescanned(self):
+        assert self.scan() == {'fa/one': 8, 'fb/two': 8}
+
+        # not journaled, so not noticed
+        self.tmp.join('fa', 'one').write("file one, changed")
+        assert self.scan() == {'fa/one': 8, 'fb/two': 8}
+
+        self.journal.record(['fa/one'])
+        assert self.scan() == {'fa/one': 17, 'fb/two': 8}
+
+    def test_removed_and_new_folders(self):
+        self.scan()
+        self.tmp.join('fb').remove()
+        self.tmp.join('fc', 'sub', 'three').write("three", ensure=True)
+        self.journal.record(['fb', 'fc'])
+        assert self.scan() == {'fa/one': 8, 'fc/sub/three': 5}
+
+    def test_journaled_paths_respect_ignore_rules(self):
+        self.tmp.join('.mfignore').write("fc/\n")
+        self.scan()
+        self.tmp.join('fc', 'three').write("three", ensure=True)
+        self.tmp.join('fa', 'new').write("new")
+        self.journal.record(['fc', 'fc/three', 'fa/new'])
+        assert self.scan() == {'fa/one': 8, 'fa/new': 3, 'fb/two': 8,
+                               '.mfignore': 4}
+
+    def test_full_scan_without_watcher(self):
+        self.scan()
+        self.lock_file.close()
+        self.tmp.join('fa', 'one').write("file one, changed")
+        assert self.scan() == {'fa/one': 17, 'fb/two': 8}
+
+    def test_full_scan_after_watcher_restart(self):
+        self.scan()
+        self.journal.set_watcher_id(self.lock_file, 'session-2')
+        self.tmp.join('fa', 'one').write("file one, changed")
+        assert self.scan() == {'fa/one': 17, 'fb/two': 8}
+
+    def test_full_scan_on_request(self):
+        self.scan()
+        self.tmp.join('fa', 'one').write("file one, changed")
+        self.journal.record([RESCAN_ALL])
+        assert self.scan() == {'fa/one': 17, 'fb/two': 8}
+
+    def test_interrupted_scan_keeps_records(self):
+        self.scan()
+        self.tmp.join('fa', 'one').write("file one, changed")
+        self.journal.record(['fa/one'])
+        events = repo_file_events(str(self.tmp), True)
+        next(events)
+        events.close()
+        assert self.scan() == {'fa/one': 17, 'fb/two': 8}
+
+class InotifyWatcherTest(unittest.TestCase):
+    def setUp(self):
+        if not sys.platform.startswith('linux'):
+            raise unittest.SkipTest("inotify is only available on Linux")
+        self.tmp = py.path.local.mkdtemp()
+        self.tmp.mkdir('.mf')
+        self.tmp.join('fa', 'one').write("file one", ensure=True)
+        self.journal = Journal(str(self.tmp.join('.mf')))
+        self.watcher = InotifyWatcher(str(self.tmp), IgnoreRules(['skip/']))
+        self.thread = threading.Thread(target=self.watcher.run)
+        self.thread.start()
+        self.wait_for(self.journal.watcher_id)
+
+    def tearDown(self):
+        self.watcher.stop()
+        self.thread.join()
+        self.tmp.remove()
+
+    def wait_for(self, condition):
+        t0 = time()
+        while time() - t0 < 5:
+            value = condition()
+            if value:
+                return value
+            sleep(.05)
+        assert False, "timed out"
+
+    def test_changes_are_journaled(self):
+        self.tmp.join('fa', 'one').write("changed")
+        self.tmp.join('new', 'sub').ensure(dir=True)
+        self.wait_for(lambda: 'new' in self.journal.take())
+        self.tmp.join('new', 'sub', 'two').write("two")
+        self.tmp.join('skip', 'x').write("x", ensure=True)
+        self.tmp.join('skip', 'y').write("y")
+        self.tmp.join('.mf', 'z').write("z")
+        records = self.wait_for(
+            lambda: 'new/sub/two' in self.journal.take() and
+                    self.journal.take())
+        assert 'fa/one' in records
+        assert 'skip/y' not in records
+        assert '.mf/z' not in records and '.mf' not in records
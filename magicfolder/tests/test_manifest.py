@@ -0,0 +1,120 @@
+import unittest
+import tempfile
+import shutil
+import os
+from os import path
+from StringIO import StringIO
+from hashlib import sha1
+
+from magicfolder import manifest
+from magicfolder.manifest import ManifestWriter, ManifestReader, iter_manifest
+from magicfolder.checksum import FileItem, read_version_file
+from magicfolder.server import Archive, server_init, dump_fileitems
+from magicfolder.admin import migrate_manifests
+
+def entries(n):
+    return sorted((('folder %d/file %d.txt' % (i % 7, i),
+                    sha1(str(i)).hexdigest(), i * 1000)
+                   for i in range(n)))
+
+def write_manifest(items):
+    f = StringIO()
+    writer = ManifestWriter(f)
+    for item in items:
+        writer.write(*item)
+    writer.close()
+    f.seek(0)
+    return f
+
+class ManifestTest(unittest.TestCase):
+    def test_roundtrip(self):
+        items = entries(1000)
+        f = write_manifest(items)
+        self.assertEqual(list(iter_manifest(f)), items)
+
+    def test_empty(self):
+        f = write_manifest([])
+        self.assertEqual(list(iter_manifest(f)), [])
+        self.assertEqual(ManifestReader(f).lookup('a'), None)
+
+    def test_smaller_than_text(self):
+        items = entries(1000)
+        f = write_manifest(items)
+        text = StringIO()
+        dump_fileitems(text, [FileItem(p, c, s, None) for p, c, s in items])
+        self.assertTrue(len(f.getvalue()) < len(text.getvalue()) / 2)
+
+    def test_streaming_with_small_reads(self):
+        self.patch_read_size(7)
+        items = entries(300)
+        f = write_manifest(items)
+        self.assertEqual(list(iter_manifest(f)), items)
+
+    def test_lookup(self):
+        self.patch_read_size(7)
+        items = entries(1000)
+        reader = ManifestReader(write_manifest(items))
+        self.assertEqual(len(reader), 1000)
+        for file_path, checksum, size in items[::37] + items[-1:]:
+            self.assertEqual(reader.lookup(file_path), (checksum, size))
+        self.assertEqual(reader.lookup(''), None)
+        self.assertEqual(reader.lookup('folder 3'), None)
+        self.assertEqual(reader.lookup('folder 3/file 4.txt'), None)
+        self.assertEqual(reader.lookup('zzz'), None)
+
+    def test_unsorted_paths_rejected(self):
+        writer = ManifestWriter(StringIO())
+        writer.write('b', sha1('b').hexdigest(), 1)
+        self.assertRaises(ValueError, writer.write,
+                          'a', sha1('a').hexdigest(), 1)
+        self.assertRaises(ValueError, writer.write,
+                          'b', sha1('b').hexdigest(), 1)
+
+    def test_truncated(self):
+        data = write_manifest(entries(100)).getvalue()
+        f = StringIO(data[:len(data) // 2])
+        self.assertRaises(ValueError, list, iter_manifest(f))
+
+    def test_read_version_file_autodetects(self):
+        bag = set(FileItem(p, c, s, None) for p, c, s in entries(50))
+        for binary in (False, True):
+            f = StringIO()
+            dump_fileitems(f, bag, binary)
+            f.seek(0)
+            self.assertEqual(manifest.is_manifest(f.getvalue()), binary)
+            self.assertEqual(set(read_version_file(f)), bag)
+
+    def patch_read_size(self, size):
+        for name in ('READ_SIZE', 'PROBE_SIZE'):
+            self.addCleanup(setattr, manifest, name, getattr(manifest, name))
+            setattr(manifest, name, size)
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        server_init(self.tmp_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_migrate(self):
+        bag = set(FileItem(p, c, s, None) for p, c, s in entries(50))
+        with open(path.join(self.tmp_path, 'versions', '1'), 'wb') as f:
+            dump_fileitems(f, bag)
+
+        archive = Archive(self.tmp_path)
+        self.assertFalse(archive.binary_manifests)
+        self.assertEqual(migrate_manifests(archive), 2)
+        self.assertEqual(sorted(os.listdir(self.tmp_path)),
+                         ['config', 'lock', 'objects', 'versions'])
+
+        with archive.open_version_read(1) as f:
+            self.assertTrue(manifest.is_manifest(f.read()))
+            f.seek(0)
+            self.assertEqual(set(read_version_file(f)), bag)
+        self.assertTrue(Archive(self.tmp_path).binary_manifests)
+
+        migrate_manifests(archive, binary=False)
+        with archive.open_version_read(1) as f:
+            self.assertFalse(manifest.is_manifest(f.read()))
+        self.assertFalse(Archive(self.tmp_path).binary_manifests)
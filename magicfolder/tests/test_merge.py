@@ -63,7 +63,7 @@ class MergeTest(unittest.TestCase):
         new_tree, conflict = calculate_merge(
                     set([f1]), set([f1, f2a]), set([f1, f2a]))
         self.assertEqual(new_tree, {'file_1': f1, 'file_2': f2a})
-        self.assertEqual(conflict, set([f2a]))
+        self.assertEqual(conflict, set())
 
     def test_remove_client(self):
         new_tree, conflict = calculate_merge(
@@ -117,4 +117,4 @@ class MergeTest(unittest.TestCase):
         new_tree, conflict = calculate_merge(
                     set([f1, f2]), set([f1, f2a]), set([f1, f2a]))
         self.assertEqual(new_tree, {'file_1': f1, 'file_2': f2a})
-        self.assertEqual(conflict, set([f2a]))
+        self.assertEqual(conflict, set())
@@ -0,0 +1,60 @@
+import unittest
+from hashlib import sha1
+
+from magicfolder.checksum import FileItem
+from magicfolder.merkle import build_tree, root_hash, find_changes
+
+def file_item(file_path, data):
+    return FileItem(file_path, sha1(data).hexdigest(), len(data), None)
+
+def changes(local_items, remote_items):
+    remote_tree = build_tree(remote_items)
+    queries = []
+    def fetch(folders):
+        queries.append(sorted(folders))
+        return dict((f, remote_tree[f][1] if f in remote_tree else None)
+                    for f in folders)
+    found = sorted(find_changes(build_tree(local_items), fetch))
+    return found, queries
+
+class MerkleTest(unittest.TestCase):
+    def setUp(self):
+        self.items = [file_item('a/b/c/%d' % i, str(i)) for i in range(5)]
+        self.items += [file_item('a/x/%d' % i, str(i)) for i in range(5)]
+        self.items += [file_item('top', 'top')]
+
+    def test_hash_depends_on_content(self):
+        self.assertEqual(root_hash(build_tree(self.items)),
+                         root_hash(build_tree(reversed(self.items))))
+        changed = self.items[:-1] + [file_item('top', 'other')]
+        self.assertNotEqual(root_hash(build_tree(self.items)),
+                            root_hash(build_tree(changed)))
+        self.assertEqual(build_tree([])[''][1], {})
+
+    def test_no_changes(self):
+        self.assertEqual(changes(self.items, self.items), ([], [['']]))
+
+    def test_descends_into_changed_folders(self):
+        local = list(self.items)
+        local[2] = file_item('a/b/c/2', 'changed')
+        found, queries = changes(local, self.items)
+        self.assertEqual(found, [('a/b/c/2', 'changed')])
+        self.assertEqual(queries, [[''], ['a'], ['a/b'], ['a/b/c']])
+
+    def test_added_and_removed_folders(self):
+        local = self.items[5:] + [file_item('new/folder/f', 'f')]
+        found, queries = changes(local, self.items)
+        self.assertEqual(found, [('a/b/c/%d' % i, 'removed')
+                                 for i in range(5)] +
+                                [('new/folder/f', 'changed')])
+        self.assertEqual(queries, [[''], ['a'], ['a/b'], ['a/b/c']])
+
+    def test_file_replaced_by_folder(self):
+        local = self.items[:-1] + [file_item('top/inner', 'x')]
+        found, queries = changes(local, self.items)
+        self.assertEqual(found, [('top', 'removed'),
+                                 ('top/inner', 'changed')])
+
+        found, queries = changes(self.items, local)
+        self.assertEqual(found, [('top', 'changed'),
+                                 ('top/inner', 'removed')])
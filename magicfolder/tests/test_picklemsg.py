@@ -0,0 +1,135 @@
+import unittest
+import os
+import select
+from StringIO import StringIO
+
+from magicfolder import picklemsg
+from magicfolder.picklemsg import Remote
+from magicfolder.compression import valid_compression
+
+class BatchingTest(unittest.TestCase):
+    def roundtrip(self, send):
+        out_file = StringIO()
+        sender = Remote(StringIO(), out_file)
+        send(sender)
+        receiver = Remote(StringIO(out_file.getvalue()), StringIO())
+        return out_file.getvalue(), receiver
+
+    def test_batched_messages_arrive_in_order(self):
+        def send(remote):
+            remote.batching = True
+            for i in range(10):
+                remote.send_batched('item', i)
+            remote.send('done', 'now')
+            remote.send_batched('item', 10)
+            remote.flush_batch()
+
+        data, receiver = self.roundtrip(send)
+        self.assertEqual(data.count('batch'), 2)
+        self.assertEqual([receiver.recv() for c in range(12)],
+                         [('item', i) for i in range(10)] +
+                         [('done', 'now'), ('item', 10)])
+
+    def test_batch_size(self):
+        self.addCleanup(setattr, picklemsg, 'BATCH_SIZE',
+                        picklemsg.BATCH_SIZE)
+        picklemsg.BATCH_SIZE = 4
+        def send(remote):
+            remote.batching = True
+            for i in range(10):
+                remote.send_batched('item', i)
+
+        data, receiver = self.roundtrip(send)
+        self.assertEqual(data.count('batch'), 2)
+        self.assertEqual([receiver.recv() for c in range(8)],
+                         [('item', i) for i in range(8)])
+
+    def test_no_batching_until_negotiated(self):
+        def send(remote):
+            remote.send_batched('item', 1)
+
+        data, receiver = self.roundtrip(send)
+        self.assertFalse('batch' in data)
+        self.assertEqual(receiver.recv(), ('item', 1))
+
+class CompressionTest(unittest.TestCase):
+    def transfer(self, data, settings):
+        out_file = StringIO()
+        sender = Remote(StringIO(), out_file)
+        sender.set_compression(settings)
+        sender.send_file(StringIO(data))
+        receiver = Remote(StringIO(out_file.getvalue()), StringIO())
+        receiver.set_compression(settings)
+        received = StringIO()
+        receiver.recv_file(received)
+        self.assertEqual(received.getvalue(), data)
+        return out_file.getvalue(), receiver
+
+    def test_compressible_data(self):
+        data = 'hello compression ' * 100000
+        for codec in ['zlib', 'bz2']:
+            wire, receiver = self.transfer(data, {'codec': codec, 'level': 6})
+            self.assertTrue('file_zchunk' in wire)
+            raw_bytes, wire_bytes = receiver.compression_stats()
+            self.assertEqual(raw_bytes, len(data))
+            self.assertTrue(wire_bytes < len(data) / 10)
+
+    def test_incompressible_data_sent_raw(self):
+        data = os.urandom(picklemsg.COMPRESSION_PROBE * 4)
+        for codec in ['zlib', 'bz2']:
+            wire, receiver = self.transfer(data, {'codec': codec,
+                                                  'level': 6})
+            self.assertTrue('file_chunk' in wire)
+            raw_bytes, wire_bytes = receiver.compression_stats()
+            self.assertTrue(wire_bytes < raw_bytes * 1.01)
+
+    def test_valid_compression(self):
+        self.assertTrue(valid_compression({'codec': 'zlib'}))
+        self.assertTrue(valid_compression({'codec': 'bz2', 'level': 9}))
+        self.assertFalse(valid_compression({'codec': 'bz2', 'level': 0}))
+        self.assertFalse(valid_compression({'codec': 'lzma'}))
+        self.assertFalse(valid_compression(True))
+
+class FramingTest(unittest.TestCase):
+    def test_framed_messages(self):
+        out_file = StringIO()
+        sender = Remote(StringIO(), out_file)
+        sender.send('capabilities', {'framing': picklemsg.FRAME_VERSION})
+        sender.set_framing(picklemsg.FRAME_VERSION)
+        sender.send('file_begin', 'x')
+        sender.send_file(StringIO('a' * 500000))
+        sender.send('done')
+
+        receiver = Remote(StringIO(out_file.getvalue()), StringIO())
+        self.assertEqual(receiver.recv(),
+                         ('capabilities', {'framing': 1}))
+        receiver.set_framing(picklemsg.FRAME_VERSION)
+        self.assertEqual(receiver.recv(), ('file_begin', 'x'))
+        received = StringIO()
+        receiver.recv_file(received)
+        self.assertEqual(received.getvalue(), 'a' * 500000)
+        self.assertEqual(receiver.recv(), ('done', None))
+        self.assertRaises(EOFError, receiver.recv)
+        # chunk sizes double: 64 + 128 + 256 + 64 KB
+        self.assertEqual(out_file.getvalue().count('C\x00'), 4)
+
+    def test_writes_coalesced_until_recv(self):
+        read_fd, write_fd = os.pipe()
+        in_file = os.fdopen(read_fd, 'rb')
+        out_file = os.fdopen(write_fd, 'wb', 1024 * 1024)
+        self.addCleanup(in_file.close)
+        self.addCleanup(out_file.close)
+        sender = Remote(StringIO(), out_file)
+        sender.set_framing(picklemsg.FRAME_VERSION)
+        with open(__file__, 'rb') as f:
+            sender.send_file(f)
+        receiver = Remote(in_file, StringIO())
+        receiver.set_framing(picklemsg.FRAME_VERSION)
+
+        self.assertEqual(select.select([read_fd], [], [], 0)[0], [])
+        sender.flush()
+        self.assertEqual(select.select([read_fd], [], [], 0)[0], [read_fd])
+        received = StringIO()
+        receiver.recv_file(received)
+        with open(__file__, 'rb') as f:
+            self.assertEqual(received.getvalue(), f.read())
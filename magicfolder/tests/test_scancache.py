@@ -0,0 +1,93 @@
+import unittest
+import tempfile
+import shutil
+import os
+from os import path
+import cPickle as pickle
+
+from magicfolder.scancache import ScanCache
+from magicfolder.checksum import FileItem, repo_file_events
+
+class ScanCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.db_path = path.join(self.tmp_path, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_lookup(self):
+        cache = ScanCache(self.db_path)
+        cache.begin_scan()
+        cache.put('a/b', 'c' * 40, 13, 1234.5)
+        cache.finish_scan()
+        cache.close()
+
+        cache = ScanCache(self.db_path)
+        self.assertEqual(cache.get('a/b'), ('c' * 40, 13, 1234.5))
+        self.assertEqual(cache.get('a/c'), None)
+
+    def test_interrupted_scan_keeps_checkpoints(self):
+        cache = ScanCache(self.db_path)
+        cache.begin_scan()
+        cache.put('one', 'c' * 40, 1, 1.0)
+        cache.checkpoint()
+        cache.put('two', 'd' * 40, 2, 2.0)
+        del cache # never finished or closed
+
+        cache = ScanCache(self.db_path)
+        self.assertEqual(cache.get('one'), ('c' * 40, 1, 1.0))
+
+    def test_finish_scan_drops_unseen_entries(self):
+        cache = ScanCache(self.db_path)
+        cache.begin_scan()
+        cache.put('one', 'c' * 40, 1, 1.0)
+        cache.put('two', 'd' * 40, 2, 2.0)
+        cache.finish_scan()
+        cache.begin_scan()
+        cache.put('two', 'd' * 40, 2, 2.0)
+        cache.finish_scan()
+        self.assertEqual(cache.get('one'), None)
+        self.assertEqual(cache.get('two'), ('d' * 40, 2, 2.0))
+
+    def test_non_ascii_path(self):
+        cache = ScanCache(self.db_path)
+        cache.begin_scan()
+        cache.put('caf\xe9', 'c' * 40, 1, 1.0)
+        cache.checkpoint()
+        self.assertEqual(cache.get('caf\xe9'), ('c' * 40, 1, 1.0))
+
+    def test_import_legacy_pickle(self):
+        legacy_path = path.join(self.tmp_path, 'cache')
+        with open(legacy_path, 'wb') as f:
+            pickle.dump({'one': FileItem('one', 'c' * 40, 1, 1.0)}, f, 2)
+
+        cache = ScanCache(self.db_path, legacy_path)
+        self.assertEqual(cache.get('one'), ('c' * 40, 1, 1.0))
+        self.assertFalse(path.exists(legacy_path))
+
+class RepoCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        os.mkdir(path.join(self.tmp_path, '.mf'))
+        with open(path.join(self.tmp_path, 'file'), 'wb') as f:
+            f.write('some data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_cached_checksum_is_reused(self):
+        [item] = list(repo_file_events(self.tmp_path))
+        cache = ScanCache(path.join(self.tmp_path, '.mf', 'cache.db'))
+        cache.begin_scan()
+        cache.put('file', 'f' * 40, item.size, item.time)
+        cache.close()
+
+        [cached_item] = list(repo_file_events(self.tmp_path, use_cache=True))
+        self.assertEqual(cached_item.checksum, 'f' * 40)
+
+        [fresh_item] = list(repo_file_events(self.tmp_path, use_cache=False))
+        self.assertEqual(fresh_item, item)
+
+if __name__ == '__main__':
+    unittest.main()
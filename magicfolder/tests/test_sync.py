@@ -4,14 +4,18 @@ import shutil
 import os
 from os import path
 import threading
+import time
 from Queue import Queue
 from hashlib import sha1
 from contextlib import contextmanager
 
 from magicfolder.picklemsg import Remote
 from magicfolder.blobdb import BlobDB
-from magicfolder.client import SyncClient, WorkingTree
-from magicfolder.server import Archive, server_sync, try_except_send_remote
+from magicfolder.client import SyncClient, WorkingTree, diff_sorted
+from magicfolder.server import (Archive, server_sync, serve_blobs,
+                                try_except_send_remote, write_config)
+from magicfolder.checksum import FileItem, read_version_file, CHUNK_SIZE
+from magicfolder.manifest import is_manifest
 
 def sha1hex(s):
     return sha1(s).hexdigest()
@@ -21,32 +25,81 @@ class TestRemote(Remote):
         self.in_queue = in_queue
         self.out_queue = out_queue
 
-    def send(self, msg, payload=None):
+    def _write(self, msg, payload):
         self.out_queue.put( (msg, payload) )
 
-    def recv(self):
-        msg, payload = self.in_queue.get()
-        if msg == 'error':
-            print "error from remote endpoint\n%s" % payload
-        return msg, payload
+    def _read(self):
+        msg = self.in_queue.get()
+        if msg is None: # the other end hung up
+            raise EOFError
+        return msg
 
 def do_server_loop(root_path, in_queue, out_queue):
     remote = TestRemote(in_queue, out_queue)
     with try_except_send_remote(remote):
         server_sync(Archive(root_path), remote)
 
-def do_client_sync(root_path, in_queue, out_queue):
+def do_blob_channel(root_path, in_queue, out_queue):
     remote = TestRemote(in_queue, out_queue)
-    SyncClient(WorkingTree(root_path), remote).sync_with_remote()
+    with try_except_send_remote(remote):
+        serve_blobs(Archive(root_path), remote)
+
+def do_client_sync(root_path, in_queue, out_queue, capabilities=None,
+                   open_channel=None):
+    remote = TestRemote(in_queue, out_queue)
+    client = SyncClient(WorkingTree(root_path), remote,
+                        capabilities=capabilities, open_channel=open_channel)
+    client.sync_with_remote()
 
-def do_client_server(client_root, server_root):
+def do_client_server(client_root, server_root, capabilities=None):
     c2s = Queue()
     s2c = Queue()
     server_thread = threading.Thread(target=do_server_loop,
                                      args=(server_root, c2s, s2c))
     server_thread.start()
-    do_client_sync(client_root, s2c, c2s)
+    channel_threads = []
+    to_server = [c2s]
+    def open_channel():
+        c2s = Queue()
+        s2c = Queue()
+        to_server.append(c2s)
+        channel_threads.append(threading.Thread(target=do_blob_channel,
+                                                args=(server_root, c2s, s2c)))
+        channel_threads[-1].start()
+        return TestRemote(s2c, c2s)
+    try:
+        do_client_sync(client_root, s2c, c2s, capabilities, open_channel)
+    except:
+        for queue in to_server:
+            queue.put(None) # hang up
+        raise
+    finally:
+        server_thread.join()
+        for t in channel_threads:
+            t.join()
+    return len(channel_threads)
+
+def do_client_server_pipes(client_root, server_root, capabilities):
+    """ Like `do_client_server`, with real `Remote` objects over pipes. """
+    c2s_read, c2s_write = os.pipe()
+    s2c_read, s2c_write = os.pipe()
+    server_remote = Remote(os.fdopen(c2s_read, 'rb'),
+                           os.fdopen(s2c_write, 'wb'))
+    client_remote = Remote(os.fdopen(s2c_read, 'rb'),
+                           os.fdopen(c2s_write, 'wb'))
+    def server_loop():
+        with try_except_send_remote(server_remote):
+            server_sync(Archive(server_root), server_remote)
+            server_remote.flush()
+    server_thread = threading.Thread(target=server_loop)
+    server_thread.start()
+    client = SyncClient(WorkingTree(client_root), client_remote,
+                        capabilities=capabilities)
+    client.sync_with_remote()
     server_thread.join()
+    for remote in [server_remote, client_remote]:
+        remote.in_file.close()
+        remote.out_file.close()
 
 class FullSyncTest(unittest.TestCase):
     def setUp(self):
@@ -63,8 +116,9 @@ class FullSyncTest(unittest.TestCase):
         os.mkdir(self.server_objects_path)
         os.mkdir(self.server_versions_path)
 
-    def run_loop(self):
-        do_client_server(self.client_root, self.server_root)
+    def run_loop(self, capabilities=None):
+        return do_client_server(self.client_root, self.server_root,
+                                capabilities)
 
     def tearDown(self):
         shutil.rmtree(self.client_tmp_path)
@@ -143,6 +197,594 @@ class FullSyncTest(unittest.TestCase):
         with open(path.join(self.client_root, 'path_three'), 'rb') as f:
             self.assertEqual(f.read(), "me three")
 
+    def test_binary_manifests(self):
+        write_config(self.server_root, {'manifest_format': 'binary'})
+        self.server_fixtures(1, {'path_one': "hello world"})
+        self.run_loop()
+
+        with open(path.join(self.client_root, 'path_two'), 'wb') as f:
+            f.write("hi there")
+        self.run_loop()
+
+        with open(path.join(self.server_versions_path, '2'), 'rb') as f:
+            self.assertTrue(is_manifest(f.read()))
+            f.seek(0)
+            self.assertEqual(sorted(i.path for i in read_version_file(f)),
+                             ['path_one', 'path_two'])
+
+        shutil.rmtree(self.client_root)
+        os.makedirs(self.client_root + '/.mf')
+        with open(self.client_root + '/.mf/last_sync', 'wb') as f:
+            f.write("0\n")
+        self.run_loop()
+        with open(path.join(self.client_root, 'path_two'), 'rb') as f:
+            self.assertEqual(f.read(), "hi there")
+
+    def test_chunked_upload(self):
+        from magicfolder import server
+        self.patch(server, 'CHUNKED_FILE_SIZE', 1024 * 1024)
+        self.server_fixtures(1, {})
+        big_data = os.urandom(3 * 1024 * 1024)
+        with open(path.join(self.client_root, 'big'), 'wb') as f:
+            f.write(big_data)
+        self.run_loop({'chunking': True})
+
+        server_objs = BlobDB(self.server_objects_path)
+        chunks = server_objs.read_recipe(sha1hex(big_data))
+        self.assertTrue(len(chunks) > 1)
+        with server_objs.read_file(sha1hex(big_data)) as f:
+            self.assertEqual(f.read(), big_data)
+
+        uploaded = []
+        orig_write_file = BlobDB.write_file
+        def write_file(db, checksum=None):
+            uploaded.append(checksum)
+            return orig_write_file(db, checksum)
+        self.patch(BlobDB, 'write_file', write_file)
+
+        big_data_2 = big_data[:100] + 'x' + big_data[100:]
+        with open(path.join(self.client_root, 'big'), 'wb') as f:
+            f.write(big_data_2)
+        self.run_loop({'chunking': True})
+
+        new_chunks = server_objs.read_recipe(sha1hex(big_data_2))
+        self.assertEqual(uploaded, [new_chunks[0][0]])
+        self.assertEqual(new_chunks[1:], chunks[1:])
+        with server_objs.read_file(sha1hex(big_data_2)) as f:
+            self.assertEqual(f.read(), big_data_2)
+
+    def test_delta_transfers(self):
+        delta_sizes = []
+        orig_send_delta = Remote.send_delta
+        def send_delta(remote, ops, progress=lambda b: None):
+            ops = list(ops)
+            delta_sizes.append(sum(len(op[1]) for op in ops
+                                   if op[0] == 'literal'))
+            return orig_send_delta(remote, ops, progress)
+        self.patch(Remote, 'send_delta', send_delta)
+
+        data_1 = os.urandom(300 * 1024)
+        self.server_fixtures(1, {'big': data_1, 'small': "hi"})
+        self.run_loop({'delta': True})
+        self.assertEqual(delta_sizes, [])
+
+        # upload: the server has version 1 of 'big'
+        data_2 = data_1[:1000] + 'client edit' + data_1[1000:]
+        with open(path.join(self.client_root, 'big'), 'wb') as f:
+            f.write(data_2)
+        os.chmod(path.join(self.client_root, 'big'), 0640)
+        self.run_loop({'delta': True})
+        self.assertEqual(len(delta_sizes), 1)
+        self.assertTrue(delta_sizes[0] < 20 * 1024)
+        with BlobDB(self.server_objects_path).read_file(sha1hex(data_2)) as f:
+            self.assertEqual(f.read(), data_2)
+
+        # download: the client has version 2 of 'big'
+        data_3 = data_2[:200000] + 'server edit' + data_2[200000:]
+        self.server_fixtures(3, {'big': data_3, 'small': "hi"})
+        self.run_loop({'delta': True})
+        self.assertEqual(len(delta_sizes), 2)
+        self.assertTrue(delta_sizes[1] < 20 * 1024)
+        with open(path.join(self.client_root, 'big'), 'rb') as f:
+            self.assertEqual(f.read(), data_3)
+        self.assertEqual(os.stat(path.join(self.client_root, 'big')).st_mode
+                         & 0777, 0640)
+        self.assertEqual(set(os.listdir(self.client_root)),
+                         set(['.mf', 'big', 'small']))
+
+    def test_status_delta(self):
+        self.server_fixtures(1, {
+            'path_one': "hello world",
+            'path_two': "hi there",
+            'path_three': "me three",
+        })
+        self.run_loop()
+        self.assertTrue(path.isfile(path.join(self.client_root,
+                                              '.mf/manifest-1')))
+
+        sent = []
+        orig_send = TestRemote.send
+        def send(remote, msg, payload=None):
+            if msg in ('file_meta', 'file_removed'):
+                sent.append((msg, payload))
+            return orig_send(remote, msg, payload)
+        self.patch(TestRemote, 'send', send)
+
+        os.unlink(path.join(self.client_root, 'path_one'))
+        with open(path.join(self.client_root, 'path_two'), 'wb') as f:
+            f.write("hi again")
+        self.run_loop()
+
+        self.assertEqual(sorted(sent), [
+            ('file_meta', FileItem('path_two', sha1hex("hi again"), 8, None)),
+            ('file_removed', 'path_one'),
+        ])
+        self.assertEqual(Archive(self.server_root).read_version(2), set([
+            FileItem('path_three', sha1hex("me three"), 8, None),
+            FileItem('path_two', sha1hex("hi again"), 8, None),
+        ]))
+        mf_files = os.listdir(path.join(self.client_root, '.mf'))
+        self.assertEqual([n for n in mf_files if n.startswith('manifest')],
+                         ['manifest-2'])
+
+        # changes from the server are included in the saved manifest
+        self.server_fixtures(3, {'path_two': "hi again", 'path_four': "4"})
+        del sent[:]
+        self.run_loop()
+        self.run_loop()
+        self.assertEqual(sent, [])
+        self.assertEqual(set(os.listdir(self.client_root)),
+                         set(['.mf', 'path_two', 'path_four']))
+
+    def test_merkle(self):
+        self.server_fixtures(1, {
+            'one/path_one': "hello world",
+            'one/path_two': "hi there",
+            'two/path_three': "me three",
+        })
+        self.run_loop()
+        os.unlink(path.join(self.client_root, '.mf/manifest-1'))
+
+        sent = []
+        orig_send = TestRemote.send
+        def send(remote, msg, payload=None):
+            sent.append(msg)
+            return orig_send(remote, msg, payload)
+        self.patch(TestRemote, 'send', send)
+
+        os.unlink(path.join(self.client_root, 'one/path_one'))
+        with open(path.join(self.client_root, 'two/path_three'), 'wb') as f:
+            f.write("me three again")
+        self.run_loop({'merkle': True})
+
+        self.assertEqual(sent.count('merkle_get'), 2)
+        self.assertEqual(sent.count('file_meta'), 1)
+        self.assertEqual(sent.count('file_removed'), 1)
+        self.assertEqual(Archive(self.server_root).read_version(2), set([
+            FileItem('one/path_two', sha1hex("hi there"), 8, None),
+            FileItem('two/path_three', sha1hex("me three again"), 14, None),
+        ]))
+        self.assertTrue(path.isfile(path.join(self.server_root,
+                                              'merkle', '1')))
+
+    def test_batching(self):
+        self.server_fixtures(1, dict(('path %d' % i, str(i))
+                                     for i in range(10)))
+        self.run_loop()
+
+        frames = []
+        orig_write = TestRemote._write
+        def _write(remote, msg, payload):
+            frames.append(msg)
+            return orig_write(remote, msg, payload)
+        self.patch(TestRemote, '_write', _write)
+
+        for i in range(5):
+            os.unlink(path.join(self.client_root, 'path %d' % i))
+        for i in range(20, 25):
+            with open(path.join(self.client_root, 'path %d' % i), 'wb') as f:
+                f.write(str(i))
+        os.unlink(path.join(self.client_root, '.mf/manifest-1'))
+        self.run_loop({'batching': True})
+
+        self.assertEqual(frames.count('batch'), 1)
+        self.assertFalse('file_meta' in frames)
+        self.assertEqual(sorted(i.path for i in
+                                Archive(self.server_root).read_version(2)),
+                         sorted('path %d' % i
+                                for i in range(5, 10) + range(20, 25)))
+
+        self.server_fixtures(3, {})
+        del frames[:]
+        self.run_loop({'batching': True})
+        self.assertEqual(frames.count('batch'), 1)
+        self.assertFalse('file_remove' in frames)
+        self.assertEqual(os.listdir(self.client_root), ['.mf'])
+
+    def test_pipelined_upload(self):
+        from magicfolder import server
+        self.patch(server, 'PIPELINE_WINDOW', 2)
+        self.server_fixtures(1, {})
+
+        requests = []
+        orig_write = TestRemote._write
+        def _write(remote, msg, payload):
+            if msg.startswith('data'):
+                requests.append((msg, payload))
+            return orig_write(remote, msg, payload)
+        self.patch(TestRemote, '_write', _write)
+
+        for i in range(5):
+            with open(path.join(self.client_root, 'path %d' % i), 'wb') as f:
+                f.write(str(i))
+        with open(path.join(self.client_root, 'copy of 4'), 'wb') as f:
+            f.write('4')
+        self.run_loop({'pipelining': True})
+
+        self.assertEqual([msg for msg, payload in requests],
+                         ['data_many'] * 3)
+        self.assertEqual(sum(len(payload) for msg, payload in requests), 5)
+        server_objs = BlobDB(self.server_objects_path)
+        for i in range(5):
+            with server_objs.read_file(sha1hex(str(i))) as f:
+                self.assertEqual(f.read(), str(i))
+
+    def test_compression(self):
+        self.server_fixtures(1, {'down': 'down ' * 1000})
+
+        frames = []
+        orig_write = TestRemote._write
+        def _write(remote, msg, payload):
+            frames.append(msg)
+            return orig_write(remote, msg, payload)
+        self.patch(TestRemote, '_write', _write)
+
+        with open(path.join(self.client_root, 'up'), 'wb') as f:
+            f.write('up ' * 1000)
+        self.run_loop({'compression': {'codec': 'zlib', 'level': 6}})
+
+        self.assertTrue('file_zchunk' in frames)
+        self.assertFalse('file_chunk' in frames)
+        with open(path.join(self.client_root, 'down'), 'rb') as f:
+            self.assertEqual(f.read(), 'down ' * 1000)
+        server_objs = BlobDB(self.server_objects_path)
+        with server_objs.read_file(sha1hex('up ' * 1000)) as f:
+            self.assertEqual(f.read(), 'up ' * 1000)
+
+    def test_compressed_blobs_served_as_stored(self):
+        write_config(self.server_root,
+                     {'blob_compression': {'codec': 'zlib', 'level': 9}})
+        archive = Archive(self.server_root)
+        with archive.write_file(sha1hex('down ' * 1000)) as f:
+            f.write('down ' * 1000)
+        self.server_fixtures(1, {'down': 'down ' * 1000})
+
+        with open(path.join(self.client_root, 'up'), 'wb') as f:
+            f.write('up ' * 1000)
+        frames = []
+        orig_write = TestRemote._write
+        def _write(remote, msg, payload):
+            frames.append((msg, payload))
+            return orig_write(remote, msg, payload)
+        self.patch(TestRemote, '_write', _write)
+        self.run_loop({'compression': {'codec': 'zlib', 'level': 1}})
+
+        server_objs = Archive(self.server_root).data_pool
+        stored_path = server_objs.blob_path(sha1hex('down ' * 1000), 'zlib')
+        with open(stored_path, 'rb') as f:
+            self.assertTrue(('file_zchunk', f.read()) in frames)
+        self.assertTrue(path.isfile(
+            server_objs.blob_path(sha1hex('up ' * 1000), 'zlib')))
+        with open(path.join(self.client_root, 'down'), 'rb') as f:
+            self.assertEqual(f.read(), 'down ' * 1000)
+
+    def test_unknown_compression_refused(self):
+        self.server_fixtures(1, {'down': 'down'})
+        self.run_loop({'compression': {'codec': 'lzma', 'level': 6}})
+        with open(path.join(self.client_root, 'down'), 'rb') as f:
+            self.assertEqual(f.read(), 'down')
+
+    def test_framing_over_pipes(self):
+        self.server_fixtures(1, {'down': 'down ' * 100000,
+                                 'small': 'small'})
+        with open(path.join(self.client_root, 'up'), 'wb') as f:
+            f.write('up ' * 100000)
+        do_client_server_pipes(self.client_root, self.server_root,
+                               {'batching': True, 'pipelining': True,
+                                'framing': 1})
+
+        with open(path.join(self.client_root, 'down'), 'rb') as f:
+            self.assertEqual(f.read(), 'down ' * 100000)
+        self.assertEqual(sorted(i.path for i in
+                                Archive(self.server_root).read_version(2)),
+                         ['down', 'small', 'up'])
+        server_objs = BlobDB(self.server_objects_path)
+        with server_objs.read_file(sha1hex('up ' * 100000)) as f:
+            self.assertEqual(f.read(), 'up ' * 100000)
+
+    def test_blob_channels(self):
+        self.server_fixtures(1, dict(('down %d' % i, 'down' * i)
+                                     for i in range(10)))
+        for i in range(10):
+            with open(path.join(self.client_root, 'up %d' % i), 'wb') as f:
+                f.write('up' * i)
+        self.assertEqual(self.run_loop({'channels': 3, 'framing': 1}), 3)
+
+        for i in range(10):
+            with open(path.join(self.client_root, 'down %d' % i), 'rb') as f:
+                self.assertEqual(f.read(), 'down' * i)
+        server_objs = BlobDB(self.server_objects_path)
+        for i in range(10):
+            with server_objs.read_file(sha1hex('up' * i)) as f:
+                self.assertEqual(f.read(), 'up' * i)
+        self.assertEqual(len(Archive(self.server_root).read_version(2)), 20)
+
+    def test_channels_capped(self):
+        self.server_fixtures(1, {'down': 'down'})
+        self.assertEqual(self.run_loop({'channels': 100}), 8)
+        with open(path.join(self.client_root, 'down'), 'rb') as f:
+            self.assertEqual(f.read(), 'down')
+
+    def test_writer_pool(self):
+        from magicfolder import client
+        self.patch(client, 'WRITER_BUFFER_SIZE', 10)
+        files = dict(('folder %d/sub/file %d' % (i % 3, i), 'data' * i)
+                     for i in range(30))
+        self.server_fixtures(1, files)
+        self.run_loop()
+        for file_path, data in files.iteritems():
+            with open(path.join(self.client_root, file_path), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+        # removals that empty a folder, and writes into the same folder
+        files = dict(('folder %d/sub/new %d' % (i % 3, i), 'new' * i)
+                     for i in range(30))
+        files['folder 0/sub/file 3'] = 'changed'
+        self.server_fixtures(2, files)
+        self.run_loop()
+        for file_path, data in files.iteritems():
+            with open(path.join(self.client_root, file_path), 'rb') as f:
+                self.assertEqual(f.read(), data)
+        self.assertEqual(len(os.listdir(path.join(self.client_root,
+                                                  'folder 1/sub'))), 10)
+
+    def test_writer_pool_file_replaced_by_folder(self):
+        orig_remove_file = WorkingTree.remove_file
+        def remove_file(wt, file_item):
+            time.sleep(.3)
+            return orig_remove_file(wt, file_item)
+        self.patch(WorkingTree, 'remove_file', remove_file)
+
+        self.server_fixtures(1, {'a': 'file'})
+        self.run_loop()
+        self.server_fixtures(2, {'a/b': 'in a folder'})
+        self.run_loop()
+        with open(path.join(self.client_root, 'a/b'), 'rb') as f:
+            self.assertEqual(f.read(), 'in a folder')
+        self.server_fixtures(3, {'a': 'file again'})
+        self.run_loop()
+        with open(path.join(self.client_root, 'a'), 'rb') as f:
+            self.assertEqual(f.read(), 'file again')
+
+    def test_writer_pool_errors(self):
+        from magicfolder.client import WriterPool
+        wt = WorkingTree(self.client_root)
+        pool = WriterPool(wt, 2)
+        item = FileItem('missing', sha1hex(''), 0, None)
+        pool.remove_file(item)
+        self.assertRaises(OSError, pool.close)
+
+    def test_local_copy(self):
+        self.server_fixtures(1, {'old/name': 'moved', 'same': 'same'})
+        self.run_loop({'local_copy': True})
+
+        frames = []
+        orig_write = TestRemote._write
+        def _write(remote, msg, payload):
+            frames.append(msg)
+            return orig_write(remote, msg, payload)
+        self.patch(TestRemote, '_write', _write)
+
+        # moved, duplicated, and overwritten with another file's contents
+        self.server_fixtures(2, {'new/name': 'moved', 'same': 'moved',
+                                 'copy 1': 'new', 'copy 2': 'new'})
+        self.run_loop({'local_copy': True})
+
+        self.assertEqual(frames.count('file_begin'), 1)
+        self.assertEqual(frames.count('file_copy'), 3)
+        self.assertFalse(path.exists(path.join(self.client_root, 'old')))
+        for name, data in [('new/name', 'moved'), ('same', 'moved'),
+                           ('copy 1', 'new'), ('copy 2', 'new')]:
+            with open(path.join(self.client_root, name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+        self.assertEqual(os.listdir(path.join(self.client_root,
+                                              '.mf', 'copies')), [])
+        wt = WorkingTree(self.client_root)
+        self.assertEqual(sorted(i.path for i in wt.iter_manifest()),
+                         ['copy 1', 'copy 2', 'new/name', 'same'])
+
+    def test_failed_local_copy(self):
+        self.server_fixtures(1, {'a': 'data'})
+        self.run_loop({'local_copy': True})
+        self.patch(WorkingTree, 'copy_to_temp', lambda *args: None)
+        self.server_fixtures(2, {'b': 'data'})
+        self.run_loop({'local_copy': True})
+        self.assertEqual(sorted(os.listdir(self.client_root)), ['.mf', 'b'])
+        with open(path.join(self.client_root, 'b'), 'rb') as f:
+            self.assertEqual(f.read(), 'data')
+
+    def test_concurrent_commit(self):
+        self.server_fixtures(1, {'base': 'base'})
+        self.run_loop()
+        other_root = path.join(self.client_tmp_path, 'other')
+        shutil.copytree(self.client_root, other_root)
+        with open(path.join(self.client_root, 'one'), 'wb') as f:
+            f.write('one')
+        with open(path.join(other_root, 'two'), 'wb') as f:
+            f.write('two')
+
+        # the other client commits while the first one uploads
+        orig_commit_version = Archive.commit_version
+        calls = []
+        def commit_version(archive, *args):
+            calls.append(args)
+            if len(calls) == 1:
+                do_client_server(other_root, self.server_root)
+            return orig_commit_version(archive, *args)
+        self.patch(Archive, 'commit_version', commit_version)
+        self.run_loop()
+
+        self.assertEqual(len(calls), 3) # the first client retried once
+        self.assertEqual(sorted(os.listdir(self.server_versions_path)),
+                         ['1', '2', '3'])
+        with open(path.join(self.server_versions_path, '3'), 'rb') as f:
+            self.assertEqual(sorted(i.path for i in read_version_file(f)),
+                             ['base', 'one', 'two'])
+        with open(path.join(self.client_root, 'two'), 'rb') as f:
+            self.assertEqual(f.read(), 'two')
+        with open(path.join(self.client_root, '.mf/last_sync'), 'rb') as f:
+            self.assertEqual(f.read(), "3\n")
+
+    def cut_next_transfer(self, skip=0):
+        """ Stop the next file transfer, after skipping `skip` of them,
+        after its first chunk, as if the connection was lost. """
+        orig_send_file = TestRemote.send_file
+        transfers = []
+        def send_file(remote, src_file, progress=lambda b: None):
+            transfers.append(src_file)
+            if len(transfers) <= skip:
+                return orig_send_file(remote, src_file, progress)
+            TestRemote.send_file = orig_send_file
+            remote.send('file_chunk', src_file.read(CHUNK_SIZE))
+            remote.out_queue.put(None)
+            raise IOError("connection lost")
+        self.patch(TestRemote, 'send_file', send_file)
+
+    def record_messages(self):
+        messages = []
+        orig_write = TestRemote._write
+        def _write(remote, msg, payload):
+            messages.append(msg)
+            return orig_write(remote, msg, payload)
+        self.patch(TestRemote, '_write', _write)
+        return messages
+
+    def test_resume_upload(self):
+        self.server_fixtures(1, {})
+        big = os.urandom(3 * CHUNK_SIZE)
+        with open(path.join(self.client_root, 'big'), 'wb') as f:
+            f.write(big)
+        capabilities = {'resume': True, 'pipelining': True}
+        self.cut_next_transfer()
+        self.assertRaises(IOError, self.run_loop, capabilities)
+        server_db = BlobDB(self.server_objects_path)
+        self.assertEqual(server_db.partial_size(sha1hex(big)), CHUNK_SIZE)
+
+        messages = self.record_messages()
+        self.run_loop(capabilities)
+        self.assertEqual(messages.count('data_from'), 1)
+        self.assertEqual(messages.count('file_chunk'), 2)
+        with server_db.read_file(sha1hex(big)) as f:
+            self.assertEqual(f.read(), big)
+        self.assertEqual(server_db.partial_size(sha1hex(big)), 0)
+
+    def test_resume_download(self):
+        big = os.urandom(3 * CHUNK_SIZE)
+        self.server_fixtures(1, {'big': big})
+        capabilities = {'resume': True}
+        self.cut_next_transfer()
+        self.assertRaises(EOFError, self.run_loop, capabilities)
+        self.assertEqual(os.listdir(self.client_root), ['.mf'])
+        partial_path = path.join(self.client_root, '.mf', 'partial')
+        self.assertEqual(os.listdir(partial_path), [sha1hex(big)])
+        self.assertEqual(path.getsize(path.join(partial_path, sha1hex(big))),
+                         CHUNK_SIZE)
+
+        messages = self.record_messages()
+        self.run_loop(capabilities)
+        self.assertEqual(messages.count('file_begin_at'), 1)
+        self.assertEqual(messages.count('file_chunk'), 2)
+        with open(path.join(self.client_root, 'big'), 'rb') as f:
+            self.assertEqual(f.read(), big)
+        self.assertEqual(os.listdir(partial_path), [])
+        with open(path.join(self.client_root, '.mf/last_sync'), 'rb') as f:
+            self.assertEqual(f.read(), "1\n")
+
+    def test_checkpoints(self):
+        self.server_fixtures(1, {'old': 'old', 'gone': 'gone'})
+        self.run_loop()
+        os.unlink(path.join(self.client_root, 'gone'))
+        files = dict(('file %d' % n, os.urandom(1000)) for n in range(4))
+        files['old'] = 'changed'
+        for name, data in files.iteritems():
+            with open(path.join(self.client_root, name), 'wb') as f:
+                f.write(data)
+
+        # a checkpoint after each blob; the fourth upload fails
+        capabilities = {'checkpoint': {'bytes': 1}}
+        self.cut_next_transfer(skip=3)
+        self.assertRaises(IOError, self.run_loop, capabilities)
+        self.assertEqual(sorted(os.listdir(self.server_versions_path)),
+                         ['1', '2', '3', '4'])
+        with open(path.join(self.client_root, '.mf/last_sync'), 'rb') as f:
+            self.assertEqual(f.read(), "4\n")
+        with open(path.join(self.server_versions_path, '4'), 'rb') as f:
+            checkpoint = set(i.path for i in read_version_file(f))
+        self.assertEqual(len(checkpoint), 4) # 3 uploaded, 1 pending
+        self.assertFalse('gone' in checkpoint)
+        wt = WorkingTree(self.client_root)
+        self.assertEqual(set(i.path for i in wt.iter_manifest()), checkpoint)
+
+        messages = self.record_messages()
+        self.run_loop(capabilities)
+        self.assertEqual(messages.count('data'), 2)
+        with open(path.join(self.server_versions_path, '5'), 'rb') as f:
+            self.assertEqual(sorted(i.path for i in read_version_file(f)),
+                             sorted(files))
+
+    def test_checkpoint_merged(self):
+        self.server_fixtures(1, {})
+        other_root = path.join(self.client_tmp_path, 'other')
+        shutil.copytree(self.client_root, other_root)
+        for n in range(3):
+            with open(path.join(self.client_root, 'file %d' % n), 'wb') as f:
+                f.write('data %d' % n)
+        with open(path.join(other_root, 'other'), 'wb') as f:
+            f.write('other')
+
+        # another client commits before the first checkpoint, so the
+        # checkpoints are merged and the client isn't told about them
+        orig_commit_version = Archive.commit_version
+        calls = []
+        def commit_version(archive, *args):
+            calls.append(args)
+            if len(calls) == 1:
+                do_client_server(other_root, self.server_root)
+            return orig_commit_version(archive, *args)
+        self.patch(Archive, 'commit_version', commit_version)
+        self.run_loop({'checkpoint': {'bytes': 1}})
+
+        with open(path.join(self.client_root, '.mf/last_sync'), 'rb') as f:
+            last_sync = int(f.read())
+        with open(path.join(self.server_versions_path, str(last_sync)),
+                  'rb') as f:
+            self.assertEqual(sorted(i.path for i in read_version_file(f)),
+                             ['file 0', 'file 1', 'file 2', 'other'])
+        self.assertEqual(sorted(os.listdir(self.client_root)),
+                         ['.mf', 'file 0', 'file 1', 'file 2', 'other'])
+
+    def test_diff_sorted(self):
+        a1, a2 = FileItem('a', 'x', 1, None), FileItem('a', 'y', 1, None)
+        b, c, d = [FileItem(p, 'x', 1, None) for p in 'bcd']
+        self.assertEqual(list(diff_sorted([a1, b, d], [a2, c, d])),
+                         [(a1, a2), (b, None), (None, c)])
+        self.assertEqual(list(diff_sorted([], [b])), [(None, b)])
+        self.assertEqual(list(diff_sorted([b], [])), [(b, None)])
+
+    def patch(self, obj, name, value):
+        orig = getattr(obj, name)
+        setattr(obj, name, value)
+        self.addCleanup(setattr, obj, name, orig)
 
 if __name__ == '__main__':
     unittest.main()
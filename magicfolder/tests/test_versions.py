@@ -0,0 +1,89 @@
+import unittest
+import tempfile
+import shutil
+import os
+import random
+from os import path
+from hashlib import sha1
+
+from magicfolder.checksum import FileItem
+from magicfolder.server import Archive, server_init, write_config
+
+def file_item(name, data):
+    return FileItem(name, sha1(data).hexdigest(), len(data), None)
+
+class VersionStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        server_init(self.tmp_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def write_history(self, archive, n_versions):
+        rnd = random.Random(0)
+        bags = [set()]
+        for n in range(1, n_versions + 1):
+            tree = dict((i.path, i) for i in bags[-1])
+            for c in range(rnd.randint(1, 10)):
+                name = 'file %d' % rnd.randint(0, 30)
+                if name in tree and rnd.random() < .3:
+                    del tree[name]
+                else:
+                    tree[name] = file_item(name, str(rnd.random()))
+            bag = set(tree.itervalues())
+            archive.write_version(n, bag, n - 1, bags[-1])
+            bags.append(bag)
+        return bags
+
+    def test_snapshots_only_by_default(self):
+        archive = Archive(self.tmp_path)
+        bags = self.write_history(archive, 5)
+        self.assertEqual(sorted(os.listdir(path.join(self.tmp_path,
+                                                     'versions'))),
+                         ['0', '1', '2', '3', '4', '5'])
+        self.assertEqual(archive.read_version(5), bags[5])
+
+    def test_delta_chain(self):
+        write_config(self.tmp_path, {'snapshot_interval': 4})
+        archive = Archive(self.tmp_path)
+        bags = self.write_history(archive, 10)
+
+        self.assertEqual(sorted(os.listdir(path.join(self.tmp_path,
+                                                     'versions'))),
+                         ['0', '1.delta', '10.delta', '2.delta', '3.delta',
+                          '4', '5.delta', '6.delta', '7.delta', '8',
+                          '9.delta'])
+        for n, bag in enumerate(bags):
+            self.assertEqual(Archive(self.tmp_path).read_version(n), bag)
+
+    def test_head(self):
+        archive = Archive(self.tmp_path)
+        self.assertEqual(archive.get_latest_version(), 0)
+        self.write_history(archive, 3)
+        with open(path.join(self.tmp_path, 'HEAD'), 'rb') as f:
+            self.assertEqual(f.read(), "3\n")
+        self.assertEqual(archive.get_latest_version(), 3)
+
+        # a version written without updating HEAD
+        with archive.open_version_write(4) as f:
+            pass
+        self.assertEqual(archive.get_latest_version(), 4)
+
+    def test_rewrite_version(self):
+        write_config(self.tmp_path, {'snapshot_interval': 4})
+        archive = Archive(self.tmp_path)
+        bags = self.write_history(archive, 2)
+        # a version left behind by an interrupted sync is overwritten
+        archive.write_version(2, bags[1])
+        self.assertFalse(path.exists(archive.delta_path(2)))
+        self.assertEqual(archive.read_version(2), bags[1])
+
+    def test_commit_version(self):
+        archive = Archive(self.tmp_path)
+        bags = self.write_history(archive, 2)
+        new_bag = set([file_item('new', 'new')])
+        self.assertEqual(archive.commit_version(new_bag, 1, bags[1]), None)
+        self.assertEqual(archive.get_latest_version(), 2)
+        self.assertEqual(archive.commit_version(new_bag, 2, bags[2]), 3)
+        self.assertEqual(Archive(self.tmp_path).read_version(3), new_bag)
@@ -1,6 +1,10 @@
 import unittest
+import os
 import py
-from magicfolder.checksum import repo_file_events
+from magicfolder import checksum
+from magicfolder.checksum import repo_file_events, walk_repo, IgnoreRules
+
+no_skip = lambda p, is_dir: False
 
 class WalkTest(unittest.TestCase):
     def setUp(self):
@@ -39,5 +43,121 @@ class WalkTest(unittest.TestCase):
         self.tmp.join('.mfignore').write('image*\n')
         assert self.walk_repo() == set(['fb/photo.png', '.mfignore'])
 
+    def test_anchored_and_folder_excludes(self):
+        self.tmp.join('fb', 'fa', 'nested.txt').write("nested", ensure=True)
+        self.tmp.join('image.png').write("top level")
+
+        # anchored folder: only the top-level 'fa' is pruned
+        self.tmp.join('.mfignore').write('/fa\n')
+        assert self.walk_repo() == set(['fb/photo.png', 'fb/fa/nested.txt',
+                                        'image.png', '.mfignore'])
+
+        # anchored glob
+        self.tmp.join('.mfignore').write('fa/*.png\n')
+        assert self.walk_repo() == set(['fa/image.jpg', 'fb/photo.png',
+                                        'fb/fa/nested.txt', 'image.png',
+                                        '.mfignore'])
+
+        # folder-only pattern does not match files of the same name
+        self.tmp.join('fc').write("a file named fc")
+        self.tmp.join('fb', 'fc').mkdir().join('x').write("x")
+        self.tmp.join('.mfignore').write('fc/\nfa/\n')
+        assert self.walk_repo() == set(['fb/photo.png', 'image.png', 'fc',
+                                        '.mfignore'])
+
+    def test_ignored_folders_are_not_descended(self):
+        seen = []
+        def skip(p, is_dir):
+            seen.append(p)
+            return p == 'fa'
+        entries = list(walk_repo(str(self.tmp), skip))
+        assert [e.path for e in entries] == ['fb/photo.png']
+        assert 'fa/image.jpg' not in seen
+
+    def test_ignore_rules(self):
+        rules = IgnoreRules(['*.tmp', 'cache*', 'Thumbs.db', '*~', '',
+                             'build/', '/docs/*.pdf', 'a?c', '[!x]yz',
+                             'logs/**/old'])
+        assert rules('x/y/file.tmp')
+        assert rules('cachedir', True)
+        assert rules('sub/Thumbs.db')
+        assert rules('notes.txt~')
+        assert not rules('notes.txt')
+        assert rules('sub/build', True)
+        assert not rules('sub/build', False)
+        assert rules('docs/manual.pdf')
+        assert not rules('other/docs/manual.pdf')
+        assert not rules('docs/sub/manual.pdf')
+        assert rules('sub/abc')
+        assert not rules('sub/abbc')
+        assert rules('ayz') and not rules('xyz')
+        assert rules('logs/2010/01/old', True)
+        assert not IgnoreRules([])('anything')
+
+    def test_parallel_hashing(self):
+        for c in range(50):
+            self.tmp.join('fc', 'file%02d' % c).write("data %d" % c,
+                                                       ensure=True)
+        serial = list(repo_file_events(str(self.tmp)))
+        parallel = list(repo_file_events(str(self.tmp), workers=4))
+        assert parallel == serial
+        assert [i.path for i in serial] == sorted(i.path for i in serial)
+
+    def test_cache_with_workers(self):
+        first = list(repo_file_events(str(self.tmp), workers=3))
+        self.tmp.join('fb', 'photo.png').write("file three, changed")
+        second = list(repo_file_events(str(self.tmp), True, workers=3))
+        assert [i.path for i in second] == [i.path for i in first]
+        assert second[0] == first[0]
+        assert second[2].checksum != first[2].checksum
+
+    def test_walk_entries(self):
+        entries = list(walk_repo(str(self.tmp), no_skip))
+        assert [e.path for e in entries] == ['fa/image.jpg', 'fa/image.png',
+                                             'fb/photo.png']
+        photo_stat = self.tmp.join('fb', 'photo.png').stat()
+        assert entries[2].size == photo_stat.size == len("file three")
+        assert entries[2].time == photo_stat.mtime
+        assert entries[2].inode == photo_stat.ino
+
+    def test_walk_is_sorted_by_path(self):
+        self.tmp.join('top.txt').write("top")
+        self.tmp.join('fa.txt').write("fa")
+        self.tmp.join('fa', 'sub', 'deep.txt').write("deep", ensure=True)
+        expected = []
+        for parent, dir_names, file_names in os.walk(str(self.tmp)):
+            if parent == str(self.tmp):
+                dir_names.remove('.mf')
+            rel = os.path.relpath(parent, str(self.tmp))
+            for name in file_names:
+                expected.append(os.path.normpath(os.path.join(rel, name)))
+        walked = [e.path for e in walk_repo(str(self.tmp), no_skip)]
+        assert walked == sorted(expected)
+        assert walked[:2] == ['fa.txt', 'fa/image.jpg']
+
+    def test_walk_subfolder(self):
+        self.tmp.join('fa', 'sub', 'deep.txt').write("deep", ensure=True)
+        walked = [e.path for e in walk_repo(str(self.tmp), no_skip, 'fa')]
+        assert walked == ['fa/image.jpg', 'fa/image.png', 'fa/sub/deep.txt']
+
+    def test_symlinks(self):
+        self.tmp.join('link_to_fa').mksymlinkto(self.tmp.join('fa'))
+        self.tmp.join('link.png').mksymlinkto(self.tmp.join('fb', 'photo.png'))
+        walked = dict((e.path, e.size)
+                      for e in walk_repo(str(self.tmp), no_skip))
+        assert 'link_to_fa/image.jpg' not in walked
+        assert walked['link.png'] == len("file three")
+
+    def test_walk_without_scandir(self):
+        self.tmp.join('link_to_fa').mksymlinkto(self.tmp.join('fa'))
+        with_scandir = list(walk_repo(str(self.tmp), no_skip))
+        orig_scandir = checksum.scandir
+        checksum.scandir = None
+        try:
+            without_scandir = list(walk_repo(str(self.tmp), no_skip))
+        finally:
+            checksum.scandir = orig_scandir
+        assert without_scandir == with_scandir
+
 if __name__ == '__main__':
     unittest.main()
@@ -17,7 +17,9 @@ setup(
     author_email="public@grep.ro",
     packages=find_packages(),
     install_requires=['argparse'],
+    extras_require={'scandir': ['scandir']},
     url="http://github.com/alex-morega/MagicFolder",
     entry_points={'console_scripts': ['mf = magicfolder.client:main',
-                                      'mf-server = magicfolder.server:main']},
+                                      'mf-server = magicfolder.server:main',
+                                      'mf-admin = magicfolder.admin:main']},
 )